@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the memory used by the output of get_ts_data with and without compact=True on a synthetic SQLite Hydrotel database.
+
+Run with: python benchmarks/bench_compact.py
+"""
+import os
+import tempfile
+import sqlalchemy
+from pyhydrotel import parameters as param
+from pyhydrotel import HydrotelClient
+from pyhydrotel.tests.synthetic import create_hydrotel_db
+
+###############################
+### Parameters
+
+n_sites = 40
+mtypes = ['flow', 'water level', 'rainfall']
+from_date = '2018-01-01'
+to_date = '2018-07-01'
+resample_code = 'H'
+
+###############################
+### Benchmark
+
+
+def mb(data):
+    return data.memory_usage(deep=True).sum() / 1024**2 if hasattr(data, 'columns') else data.memory_usage(deep=True) / 1024**2
+
+
+if __name__ == '__main__':
+    path = tempfile.mkdtemp()
+    param.cache_dir = os.path.join(path, 'cache')
+    engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(path, 'hydrotel.db'))
+    create_hydrotel_db(engine, n_sites=n_sites, from_date=from_date, to_date=to_date, freq='15min')
+    client = HydrotelClient('local', 'hydrotel', engine=engine)
+
+    tsdata1 = client.get_ts_data(mtypes, None, from_date, to_date, resample_code, server_agg=True)
+    tsdata2 = client.get_ts_data(mtypes, None, from_date, to_date, resample_code, server_agg=True, compact=True)
+    wide1 = tsdata1.unstack([0, 1])
+    wide2 = client.get_ts_data(mtypes, None, from_date, to_date, resample_code, server_agg=True, pivot=True, compact=True)
+
+    print('rows: {:,}'.format(len(tsdata1)))
+    print('Series:           {:7.1f} MB -> {:7.1f} MB'.format(mb(tsdata1), mb(tsdata2)))
+    print('long DataFrame:   {:7.1f} MB -> {:7.1f} MB'.format(mb(tsdata1.reset_index()), mb(tsdata2.reset_index())))
+    print('pivoted:          {:7.1f} MB -> {:7.1f} MB'.format(mb(wide1), mb(wide2)))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of get_ts_data with and without the local tile cache on a synthetic SQLite Hydrotel database.
+
+Run with: python benchmarks/bench_tiles.py
+"""
+import os
+import time
+import tempfile
+import sqlalchemy
+from pyhydrotel import parameters as param
+from pyhydrotel import HydrotelClient
+from pyhydrotel.tests.synthetic import create_hydrotel_db
+
+###############################
+### Parameters
+
+n_sites = 20
+mtypes = ['flow', 'rainfall']
+from_date = '2018-01-15'
+to_date = '2018-05-15'
+repeats = 3
+
+###############################
+### Benchmark
+
+
+def timeit(fun):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    path = tempfile.mkdtemp()
+    param.cache_dir = os.path.join(path, 'cache')
+    engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(path, 'hydrotel.db'))
+    create_hydrotel_db(engine, n_sites=n_sites, from_date='2018-01-01', to_date='2018-06-01', freq='5min')
+
+    client = HydrotelClient('local', 'hydrotel', engine=engine)
+    tile_client = HydrotelClient('local', 'hydrotel', engine=engine, tile_cache=True)
+    client.get_sites_mtypes()
+
+    no_cache = timeit(lambda: client.get_ts_data(mtypes, None, from_date, to_date, server_agg=True))
+
+    start = time.perf_counter()
+    tile_client.get_ts_data(mtypes, None, from_date, to_date)
+    cold = time.perf_counter() - start
+
+    warm = timeit(lambda: tile_client.get_ts_data(mtypes, None, from_date, to_date))
+
+    print('sites: {}, tiles: {}, cache size: {:.1f} MB'.format(n_sites, len(tile_client.get_tile_cache().manifest), tile_client.get_tile_cache().size() / 1024**2))
+    print('no cache:   {:.3f} s'.format(no_cache))
+    print('cold cache: {:.3f} s'.format(cold))
+    print('warm cache: {:.3f} s ({:.1f}x)'.format(warm, no_cache / warm))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the write_ts_data throughput against row-by-row inserts on a synthetic SQLite Hydrotel database.
+
+Run with: python benchmarks/bench_write.py
+"""
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from pyhydrotel import parameters as param
+from pyhydrotel import HydrotelClient
+from pyhydrotel.tests.synthetic import create_hydrotel_db
+
+###############################
+### Parameters
+
+n_sites = 20
+mtypes = ['flow', 'rainfall']
+from_date = '2019-01-01'
+to_date = '2019-02-01'
+freq = '5min'
+batch_size = 50000
+
+###############################
+### Benchmark
+
+
+def new_data(client, from_date, to_date):
+    site_point = client.get_sites_mtypes(mtypes).reset_index()
+    dates = pd.date_range(from_date, to_date, freq=freq)
+    index = pd.MultiIndex.from_product([site_point.ExtSiteID.unique(), mtypes, dates], names=['ExtSiteID', 'MType', 'DateTime'])
+    index = index[index.droplevel('DateTime').isin(site_point.set_index(['ExtSiteID', 'MType']).index)]
+    return pd.Series(np.random.default_rng(0).normal(10, 3, len(index)), index=index, name='Value')
+
+
+if __name__ == '__main__':
+    path = tempfile.mkdtemp()
+    param.cache_dir = os.path.join(path, 'cache')
+    engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(path, 'hydrotel.db'))
+    create_hydrotel_db(engine, n_sites=n_sites, from_date='2018-01-01', to_date='2018-01-02', freq='1h')
+    client = HydrotelClient('local', 'hydrotel', engine=engine)
+
+    ## Row by row
+    data1 = new_data(client, '2018-06-01', '2018-06-04')
+    site_point = client.get_sites_mtypes(mtypes).reset_index().set_index(['ExtSiteID', 'MType']).Point
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for (site, mtype, dt), val in data1.items():
+            conn.execute(sqlalchemy.text("insert into Samples (Point, DT, SampleValue) values (:p, :dt, :val)"), {'p': int(site_point[(site, mtype)]), 'dt': dt.strftime('%Y-%m-%d %H:%M:%S'), 'val': val})
+    row_time = time.perf_counter() - start
+
+    ## Bulk insert
+    data2 = new_data(client, from_date, to_date)
+    start = time.perf_counter()
+    client.write_ts_data(data2, batch_size=batch_size)
+    insert_time = time.perf_counter() - start
+
+    ## Bulk upsert of the same samples
+    start = time.perf_counter()
+    client.write_ts_data(data2 + 1, batch_size=batch_size)
+    upsert_time = time.perf_counter() - start
+
+    print('row by row:  {:>9,.0f} rows/s ({:,} rows)'.format(len(data1) / row_time, len(data1)))
+    print('bulk insert: {:>9,.0f} rows/s ({:,} rows)'.format(len(data2) / insert_time, len(data2)))
+    print('bulk upsert: {:>9,.0f} rows/s ({:,} rows)'.format(len(data2) / upsert_time, len(data2)))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the main pyhydrotel functions on synthetic SQLite Hydrotel databases of several sizes (see tests.synthetic.scales). Needs pytest-benchmark.
+
+Run with: pytest benchmarks/test_benchmarks.py
+
+The scales can be set with the PYHYDROTEL_BENCH_SCALES environment variable (e.g. small,medium,large) and the databases are kept in PYHYDROTEL_BENCH_DIR (if set) so that they are only generated once.
+"""
+import os
+import itertools
+import pytest
+import pandas as pd
+from pyhydrotel import parameters as param
+from pyhydrotel import HydrotelClient
+from pyhydrotel.tests.synthetic import create_scale_db, scales, site_names
+
+pytest.importorskip('pytest_benchmark')
+
+###############################
+### Parameters
+
+bench_scales = os.environ.get('PYHYDROTEL_BENCH_SCALES', 'small,medium').split(',')
+
+mtypes = ['flow', 'rainfall']
+n_query_sites = 5
+
+_counter = itertools.count()
+
+###############################
+### Fixtures
+
+
+@pytest.fixture(scope='session')
+def bench_dir(tmp_path_factory):
+    path = os.environ.get('PYHYDROTEL_BENCH_DIR')
+    if path is None:
+        path = str(tmp_path_factory.mktemp('bench'))
+    return path
+
+
+@pytest.fixture(scope='session', params=bench_scales)
+def client(request, bench_dir, tmp_path_factory):
+    engine = create_scale_db(bench_dir, request.param)
+    client = HydrotelClient('bench', request.param, engine=engine)
+    client.scale = scales[request.param]
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(param, 'cache_dir', str(tmp_path_factory.mktemp('cache')))
+        yield client
+    client.close()
+
+
+@pytest.fixture(scope='session')
+def query_sites(client):
+    return site_names(client.scale['n_sites'])[:n_query_sites]
+
+###############################
+### Benchmarks
+
+
+def test_get_mtypes(benchmark, client):
+    def run():
+        client.invalidate_catalog()
+        return client.get_mtypes()
+
+    mtypes1 = benchmark(run)
+    assert len(mtypes1) >= client.scale['n_mtypes']
+
+
+def test_get_sites_mtypes(benchmark, client, query_sites):
+    client.get_sites_mtypes()
+    sites_mtypes = benchmark(client.get_sites_mtypes, mtypes, query_sites)
+    assert not sites_mtypes.empty
+
+
+def test_get_sites_mtypes_cold(benchmark, client, query_sites):
+    def run():
+        client.invalidate_catalog()
+        return client.get_sites_mtypes(mtypes, query_sites)
+
+    sites_mtypes = benchmark(run)
+    assert not sites_mtypes.empty
+
+
+def test_get_sites_mtypes_repeated(benchmark, client, query_sites):
+    client.invalidate_catalog()
+    client.get_sites_mtypes(mtypes, query_sites)
+    sites_mtypes = benchmark(client.get_sites_mtypes, mtypes, query_sites)
+    assert not sites_mtypes.empty
+
+
+def test_get_sites_mtypes_all(benchmark, client):
+    sites_mtypes = benchmark(client.get_sites_mtypes)
+    assert len(sites_mtypes) >= client.scale['n_sites'] * client.scale['n_mtypes']
+
+
+@pytest.mark.parametrize('resample_code', [None, 'H', 'D'])
+def test_get_ts_data(benchmark, client, query_sites, resample_code):
+    client.get_sites_mtypes()
+    to_date = client.scale['to_date']
+    from_date = str((pd.Timestamp(to_date) - pd.Timedelta('30D')).date())
+    tsdata = benchmark(client.get_ts_data, mtypes, query_sites, from_date, to_date, resample_code, server_agg=True)
+    assert not tsdata.empty
+
+
+def test_get_ts_data_pivot(benchmark, client):
+    client.get_sites_mtypes()
+    to_date = client.scale['to_date']
+    from_date = str((pd.Timestamp(to_date) - pd.Timedelta('30D')).date())
+    tsdata = benchmark(client.get_ts_data, mtypes, None, from_date, to_date, 'D', server_agg=True, pivot=True)
+    assert tsdata.shape[1] == client.scale['n_sites'] * len(mtypes)
+
+
+def test_create_site_mtype(benchmark, client, query_sites):
+    ref_point = int(client.get_sites_mtypes('flow', query_sites[1]).Point.iloc[0])
+
+    def run():
+        return client.create_site_mtype(query_sites[1], ref_point, 'Bench {}'.format(next(_counter)))
+
+    new1 = benchmark.pedantic(run, rounds=5)
+    assert len(new1) == 1
+
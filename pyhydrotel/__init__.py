@@ -1 +1,6 @@
-from pyhydrotel.core import get_sites_mtypes, get_ts_data, get_mtypes, create_site_mtype
+from pyhydrotel.core import get_sites_mtypes, get_ts_data, get_mtypes, create_site_mtype, create_site_mtypes, iter_ts_data, get_ts_updates, get_ts_availability, write_ts_data, export_ts_data, extract_ts_data
+from pyhydrotel.client import HydrotelClient, get_client
+from pyhydrotel.query import HydrotelQuery
+from pyhydrotel.federation import HydrotelFederation
+from pyhydrotel.catalog import get_catalog, refresh_catalog, invalidate_catalog, get_point_extents
+from pyhydrotel.instrument import add_hook, remove_hook
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio versions of the Hydrotel readers.
+
+The readers run on a bounded pool of worker threads that share the pooled engine of a HydrotelClient, so many concurrent requests from an event loop share a small number of connections without blocking the loop. Requests beyond the pool size wait in the event loop rather than holding a thread.
+"""
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pyhydrotel import parameters as param
+from pyhydrotel.client import HydrotelClient, get_client
+
+######################################
+### Parameters
+
+_clients = {}
+_lock = threading.Lock()
+_end = object()
+
+
+######################################
+### Class
+
+
+class AsyncHydrotelClient(object):
+    """
+    Class with async versions of the HydrotelClient readers.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    client : HydrotelClient or None
+        An existing client to use. It is not closed by aclose. None creates a client from server, database, and kwargs that is closed by aclose.
+    max_concurrency : int or None
+        The maximum number of readers running at the same time, which is also the number of worker threads. None uses parameters.max_connections.
+    kwargs
+        Passed to HydrotelClient.
+    """
+    def __init__(self, server=None, database=None, client=None, max_concurrency=None, **kwargs):
+        self._owns_client = client is None
+        if client is None:
+            client = HydrotelClient(server, database, **kwargs)
+        if max_concurrency is None:
+            max_concurrency = param.max_connections
+
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix='pyhydrotel')
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "AsyncHydrotelClient(server='{server}', database='{database}')".format(server=self.client.server, database=self.client.database)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def _semaphore(self):
+        """
+        Method to return the semaphore of the running event loop. An asyncio.Semaphore is bound to one loop, so each loop (e.g. of consecutive asyncio.run calls) gets its own.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._semaphores[loop] = semaphore
+
+        return semaphore
+
+    async def _run(self, fun, *args, **kwargs):
+        """
+        Method to run a blocking function on the worker threads.
+        """
+        async with self._semaphore():
+            return await self._call(fun, *args, **kwargs)
+
+    async def _call(self, fun, *args, **kwargs):
+        """
+        Method to run a blocking function on the worker threads without taking a slot of the semaphore.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fun, *args, **kwargs))
+
+    async def aclose(self):
+        """
+        Method to shut down the worker threads. The pooled connections are only closed if the client was created by this object, so a shared client (e.g. of get_client) stays usable.
+        """
+        with _lock:
+            for key, client in list(_clients.items()):
+                if client is self:
+                    del _clients[key]
+
+        self._executor.shutdown(wait=False)
+        if self._owns_client:
+            self.client.close()
+
+    async def get_mtypes(self):
+        """
+        Async version of HydrotelClient.get_mtypes.
+        """
+        return await self._run(self.client.get_mtypes)
+
+    async def get_sites_mtypes(self, mtypes=None, sites=None):
+        """
+        Async version of HydrotelClient.get_sites_mtypes.
+        """
+        return await self._run(self.client.get_sites_mtypes, mtypes, sites)
+
+    async def get_ts_data(self, mtypes, sites, **kwargs):
+        """
+        Async version of HydrotelClient.get_ts_data. The keyword arguments are the same.
+        """
+        return await self._run(self.client.get_ts_data, mtypes, sites, **kwargs)
+
+    async def get_ts_updates(self, mtypes=None, sites=None, **kwargs):
+        """
+        Async version of HydrotelClient.get_ts_updates. The keyword arguments are the same.
+        """
+        return await self._run(self.client.get_ts_updates, mtypes, sites, **kwargs)
+
+    async def iter_ts_data(self, mtypes, sites, **kwargs):
+        """
+        Async generator version of HydrotelClient.iter_ts_data. The keyword arguments are the same. Each chunk is fetched on a worker thread. The generator holds a pooled connection between chunks, so it takes one slot of max_concurrency until it is exhausted or closed.
+        """
+        async with self._semaphore():
+            gen = self.client.iter_ts_data(mtypes, sites, **kwargs)
+            try:
+                while True:
+                    chunk = await self._call(next, gen, _end)
+                    if chunk is _end:
+                        break
+                    yield chunk
+            finally:
+                await self._call(gen.close)
+
+
+######################################
+### Functions
+
+
+def get_async_client(server, database):
+    """
+    Function to return the shared AsyncHydrotelClient of a server and database.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+
+    Returns
+    -------
+    AsyncHydrotelClient
+    """
+    key = (server.lower(), database.lower())
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = AsyncHydrotelClient(client=get_client(server, database))
+            _clients[key] = client
+
+    return client
+
+
+async def get_mtypes(server, database):
+    """
+    Async version of core.get_mtypes.
+    """
+    return await get_async_client(server, database).get_mtypes()
+
+
+async def get_sites_mtypes(server, database, mtypes=None, sites=None):
+    """
+    Async version of core.get_sites_mtypes.
+    """
+    return await get_async_client(server, database).get_sites_mtypes(mtypes, sites)
+
+
+async def get_ts_data(server, database, mtypes, sites, **kwargs):
+    """
+    Async version of core.get_ts_data. The keyword arguments are the same.
+    """
+    return await get_async_client(server, database).get_ts_data(mtypes, sites, **kwargs)
+
+
+async def get_ts_updates(server, database, mtypes=None, sites=None, **kwargs):
+    """
+    Async version of core.get_ts_updates. The keyword arguments are the same.
+    """
+    return await get_async_client(server, database).get_ts_updates(mtypes, sites, **kwargs)
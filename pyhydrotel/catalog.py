@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for caching the Hydrotel metadata catalog (the Sites, Objects, and Points tables) in memory and on disk.
+"""
+import os
+import re
+import time
+import threading
+import pandas as pd
+import sqlalchemy
+from pdsql.util import create_engine
+from pyhydrotel import parameters as param
+from pyhydrotel.util import chunks, since_where_stmts, since_join_stmt, bulk_keys
+
+######################################
+### Parameters
+
+catalog_file = 'catalog.pkl'
+extents_file = 'extents.pkl'
+
+extents_stmt = "select Point, min(DT) as FromDate, max(DT) as ToDate from {tab} where {where} group by Point"
+extents_batch = 500
+
+## The lock only guards the in-memory caches and the pickle files; the queries run outside of it
+_catalogs = {}
+_subsets = {}
+_extents = {}
+_checked = {}
+_lock = threading.RLock()
+
+max_subsets = 256
+
+## One lock per server/database so that a catalog is only loaded once at a time
+_load_locks = {}
+
+
+######################################
+### Functions
+
+
+def _key(server, database):
+    """
+    Function to make the cache key of a server/database combination.
+    """
+    return (server.lower(), database.lower())
+
+
+def _load_lock(key):
+    """
+    Function to return the lock used while loading the catalog of a server/database combination.
+    """
+    with _lock:
+        return _load_locks.setdefault(key, threading.Lock())
+
+
+def _store_path(server, database, cache_dir=None):
+    """
+    Function to return the local folder used to store the cached data of a server/database combination. Returns None if the on-disk cache is disabled.
+    """
+    if cache_dir is None:
+        cache_dir = param.cache_dir
+    if not cache_dir:
+        return None
+
+    name = re.sub(r'[^\w\-]+', '_', '_'.join(_key(server, database)))
+
+    return os.path.join(cache_dir, name)
+
+
+def _save_pickle(obj, path):
+    """
+    Function to write an object to a pickle file without leaving a partial file behind on failure.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        pd.to_pickle(obj, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def _read_stmts(server, database, stmts, con=None):
+    """
+    Function to run select statements with pd.read_sql_query on one open connection. pd.read_sql on an engine would check whether each statement is a table name first, which is an extra round trip per statement.
+    """
+    engine = None
+    if con is None:
+        engine = create_engine('mssql', server, database)
+        con = engine
+    try:
+        if isinstance(con, sqlalchemy.engine.Engine):
+            with con.connect() as conn:
+                return [pd.read_sql_query(stmt, conn) for stmt in stmts]
+        return [pd.read_sql_query(stmt, con) for stmt in stmts]
+    finally:
+        if engine is not None:
+            engine.dispose()
+
+
+def _table_stmt(table, cols):
+    """
+    Function to create the statement that selects columns of a whole table.
+    """
+    return "select {cols} from {tab}".format(cols=', '.join('[' + c + ']' for c in cols), tab=table)
+
+
+def _load_catalog(server, database, con=None):
+    """
+    Function to read the Sites, Objects, and Points tables from the Hydrotel database.
+    """
+    stmts = [_table_stmt(param.sites_tab, param.sites_col), _table_stmt(param.objects_tab, param.objects_col), _table_stmt(param.points_tab, param.points_col)]
+    sites1, objects1, points1 = _read_stmts(server, database, stmts, con)
+
+    return {'sites': sites1, 'objects': objects1, 'points': points1, 'loaded': time.time()}
+
+
+def cached_catalog(server, database, ttl=None, cache_dir=None):
+    """
+    Function to return the Hydrotel metadata catalog from the memory or disk cache without querying the database. Returns None if no catalog younger than the ttl is cached.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    ttl : int or None
+        The number of seconds that a cached catalog remains valid. None uses parameters.catalog_ttl.
+    cache_dir : str or None
+        The folder for the on-disk snapshot. None uses parameters.cache_dir.
+
+    Returns
+    -------
+    dict or None
+        The same output as get_catalog.
+    """
+    if ttl is None:
+        ttl = param.catalog_ttl
+    key = _key(server, database)
+    store = _store_path(server, database, cache_dir)
+
+    with _lock:
+        ## Memory
+        cat = _catalogs.get(key)
+        if (cat is not None) and (time.time() - cat['loaded'] < ttl):
+            return cat
+
+        ## Disk
+        if store is not None:
+            path = os.path.join(store, catalog_file)
+            if os.path.isfile(path):
+                try:
+                    cat = pd.read_pickle(path)
+                except Exception:
+                    cat = None
+                if (cat is not None) and (time.time() - cat['loaded'] < ttl):
+                    _catalogs[key] = cat
+                    return cat
+
+    return None
+
+
+def _sql_str_list(values):
+    """
+    Function to convert a list of str to a comma separated list of quoted SQL strings.
+    """
+    return ', '.join("'" + str(v).replace("'", "''") + "'" for v in values)
+
+
+def load_catalog_subset(server, database, mtypes=None, sites=None, con=None):
+    """
+    Function to read only the rows of the Sites, Objects, and Points tables that can match the requested sites and mtypes. The site matching of get_sites_mtypes is translated into SQL predicates: the trimmed Sites.ExtSysId, the groundwater well number at the start of the Sites.Name (via LIKE), and the trimmed Objects.ExtSysID that overrides the site's. The predicates can return a few more rows than needed (e.g. longer well numbers), so the output must still go through the same filtering as the full catalog. The subset is not cached.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    mtypes : list of str or None
+        The measurement types. None does not filter by mtype.
+    sites : list of str or None
+        The sites (ExtSiteIDs). None does not filter by site.
+    con : SQLAlchemy connectable (engine/connection) or None
+        The connection to use for reading the database. None lets pdsql create one.
+
+    Returns
+    -------
+    dict
+        The same output as get_catalog.
+    """
+    ## Sites
+    if sites is not None:
+        sites = [str(s).strip() for s in sites]
+        gw_sites = [s.upper() for s in sites if re.fullmatch(r'[A-Za-z]+\d+/\d+', s)]
+        site_where = ["ltrim(rtrim(ExtSysId)) in ({sites})".format(sites=_sql_str_list(sites))]
+        site_where.extend("upper(Name) like '{gw}%'".format(gw=gw.replace("'", "''")) for gw in gw_sites)
+        site_where = '(' + ' or '.join(site_where) + ')'
+        sites_stmt = "select {cols} from {tab} where {where}".format(cols=', '.join(param.sites_col), tab=param.sites_tab, where=site_where)
+    else:
+        sites_stmt = _table_stmt(param.sites_tab, param.sites_col)
+
+    ## Objects
+    object_where = []
+    if sites is not None:
+        object_where.append("(Site in (select Site from {tab} where {where}) or ltrim(rtrim(ExtSysID)) in ({sites}))".format(tab=param.sites_tab, where=site_where, sites=_sql_str_list(sites)))
+    if mtypes is not None:
+        object_where.append("lower(Name) in ({mtypes})".format(mtypes=_sql_str_list([m.lower() for m in mtypes])))
+    object_where = ' and '.join(object_where) if object_where else '1 = 1'
+
+    objects_stmt = "select {cols} from {tab} where {where}".format(cols=', '.join(param.objects_col), tab=param.objects_tab, where=object_where)
+
+    ## Points
+    points_stmt = "select {cols} from {tab} where Object in (select Object from {obj_tab} where {where})".format(cols=', '.join(param.points_col), tab=param.points_tab, obj_tab=param.objects_tab, where=object_where)
+
+    sites1, objects1, points1 = _read_stmts(server, database, [sites_stmt, objects_stmt, points_stmt], con)
+
+    return {'sites': sites1, 'objects': objects1, 'points': points1, 'loaded': time.time()}
+
+
+def get_catalog_subset(server, database, mtypes=None, sites=None, ttl=None, con=None):
+    """
+    Function to return the rows of the Sites, Objects, and Points tables that can match the requested sites and mtypes (see load_catalog_subset). The subsets are kept in memory by their sites and mtypes, so repeating a lookup does not query the database until the subset is older than the ttl. invalidate_catalog also removes them.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    mtypes : list of str or None
+        The measurement types. None does not filter by mtype.
+    sites : list of str or None
+        The sites (ExtSiteIDs). None does not filter by site.
+    ttl : int or None
+        The number of seconds that a cached subset remains valid. None uses parameters.catalog_ttl.
+    con : SQLAlchemy connectable (engine/connection) or None
+        The connection to use for reading the database. None lets pdsql create one.
+
+    Returns
+    -------
+    dict
+        The same output as get_catalog.
+    """
+    if ttl is None:
+        ttl = param.catalog_ttl
+    sub_key = (_key(server, database), None if mtypes is None else tuple(sorted(set(m.lower() for m in mtypes))), None if sites is None else tuple(sorted(set(str(s).strip() for s in sites))))
+
+    with _lock:
+        cat = _subsets.get(sub_key)
+        if (cat is not None) and (time.time() - cat['loaded'] < ttl):
+            return cat
+
+    cat = load_catalog_subset(server, database, mtypes, sites, con)
+
+    with _lock:
+        _subsets.pop(sub_key, None)
+        _subsets[sub_key] = cat
+        while len(_subsets) > max_subsets:
+            _subsets.pop(next(iter(_subsets)))
+
+    return cat
+
+
+def get_catalog(server, database, refresh=False, ttl=None, cache_dir=None, con=None):
+    """
+    Function to return the Hydrotel metadata catalog (the Sites, Objects, and Points tables). The catalog is kept in memory and as a snapshot on disk and is only reloaded from the database once it is older than the ttl.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    refresh : bool
+        Should the catalog be reloaded from the database regardless of its age?
+    ttl : int or None
+        The number of seconds that a cached catalog remains valid. None uses parameters.catalog_ttl.
+    cache_dir : str or None
+        The folder for the on-disk snapshot. None uses parameters.cache_dir. If that is also None or empty, then no snapshot is written.
+    con : SQLAlchemy connectable (engine/connection) or None
+        The connection to use for reading the database. None lets pdsql create one.
+
+    Returns
+    -------
+    dict
+        sites, objects, and points DataFrames and the loaded time (in seconds since the epoch). The DataFrames are shared, so copy them before modifying them.
+    """
+    if ttl is None:
+        ttl = param.catalog_ttl
+    key = _key(server, database)
+    store = _store_path(server, database, cache_dir)
+
+    if not refresh:
+        cat = cached_catalog(server, database, ttl, cache_dir)
+        if cat is not None:
+            return cat
+
+    with _load_lock(key):
+        ## Another thread might have loaded it in the meantime
+        if not refresh:
+            cat = cached_catalog(server, database, ttl, cache_dir)
+            if cat is not None:
+                return cat
+
+        ## Database
+        cat = _load_catalog(server, database, con)
+
+        with _lock:
+            _catalogs[key] = cat
+            if store is not None:
+                _save_pickle(cat, os.path.join(store, catalog_file))
+
+    return cat
+
+
+def refresh_catalog(server, database, cache_dir=None, con=None):
+    """
+    Function to reload the Hydrotel metadata catalog from the database and update the memory and disk caches.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    cache_dir : str or None
+        The folder for the on-disk snapshot. None uses parameters.cache_dir.
+    con : SQLAlchemy connectable (engine/connection) or None
+        The connection to use for reading the database. None lets pdsql create one.
+
+    Returns
+    -------
+    dict
+        The same output as get_catalog.
+    """
+    return get_catalog(server, database, refresh=True, cache_dir=cache_dir, con=con)
+
+
+def invalidate_catalog(server=None, database=None, cache_dir=None):
+    """
+    Function to remove the cached Hydrotel metadata catalog (and the cached subsets, see get_catalog_subset) from memory and disk. The next call that needs the catalog will reload it from the database.
+
+    Parameters
+    ----------
+    server : str or None
+        The server where the Hydrotel database lays. None removes the catalogs of all servers and databases held in memory.
+    database : str or None
+        The name of the Hydrotel database.
+    cache_dir : str or None
+        The folder for the on-disk snapshot. None uses parameters.cache_dir.
+
+    Returns
+    -------
+    None
+    """
+    with _lock:
+        if server is None:
+            keys = list(_catalogs.keys())
+        else:
+            keys = [_key(server, database)]
+
+        for sub_key in [k for k in _subsets if (server is None) or (k[0] in keys)]:
+            _subsets.pop(sub_key)
+
+        for key in keys:
+            _catalogs.pop(key, None)
+            store = _store_path(key[0], key[1], cache_dir)
+            if store is not None:
+                path = os.path.join(store, catalog_file)
+                if os.path.isfile(path):
+                    os.remove(path)
+
+
+def _query_extents(server, database, where_list, con=None):
+    """
+    Function to run the extents statement over batches of where conditions that are joined by OR.
+    """
+    stmts = [extents_stmt.format(tab=param.data_tab, where=' or '.join(where)) for where in chunks(where_list, extents_batch)]
+    ext_list = _read_stmts(server, database, stmts, con)
+
+    ext1 = pd.concat(ext_list)
+    ext1['FromDate'] = pd.to_datetime(ext1['FromDate'])
+    ext1['ToDate'] = pd.to_datetime(ext1['ToDate'])
+
+    return ext1.set_index('Point')
+
+
+def _cached_extents(key, store):
+    """
+    Function to return the extents index of a server/database combination from memory or disk. Returns None if there is none. Must be called with the lock held.
+    """
+    ext0 = _extents.get(key)
+    if (ext0 is None) and (store is not None):
+        path = os.path.join(store, extents_file)
+        if os.path.isfile(path):
+            try:
+                ext0 = pd.read_pickle(path)
+            except Exception:
+                ext0 = None
+            if ext0 is not None:
+                _extents[key] = ext0
+
+    return ext0
+
+
+def _combine_extents(ext0, ext1, reset_points=()):
+    """
+    Function to widen the extents of the index ext0 by the extents ext1. The extents of the reset_points are replaced by those in ext1 (or NaT). The widening does not depend on the order of the updates, so concurrent updates can be combined in any order.
+    """
+    index = ext0.index.union(pd.Index(reset_points, dtype='int64')).union(ext1.index).rename('Point')
+    ext2 = ext0.reindex(index).astype('datetime64[ns]')
+    ext2.loc[ext2.index.isin(reset_points)] = pd.NaT
+    ext1 = ext1.reindex(index).astype('datetime64[ns]')
+    ext2['FromDate'] = pd.concat([ext2['FromDate'], ext1['FromDate']], axis=1).min(axis=1)
+    ext2['ToDate'] = pd.concat([ext2['ToDate'], ext1['ToDate']], axis=1).max(axis=1)
+
+    return ext2
+
+
+def get_point_extents(server, database, points, refresh=False, cache_dir=None, con=None):
+    """
+    Function to return the first and last sample dates of Points. The extents are kept in an index in memory and on disk. Points that are not in the index are scanned in full once; Points already in the index are only updated from the samples newer than their stored ToDate (the watermark), and not at all if they were updated by this process within the last parameters.extents_ttl seconds.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    points : list of int
+        The Points to return.
+    refresh : bool
+        Should the extents of the points be recalculated from all of their samples? Needed if samples older than the watermark have been added or removed.
+    cache_dir : str or None
+        The folder for the on-disk index. None uses parameters.cache_dir.
+    con : SQLAlchemy connectable (engine/connection) or None
+        The connection to use for reading the database. None lets pdsql create one.
+
+    Returns
+    -------
+    DataFrame
+        Point, FromDate, ToDate
+    """
+    points = pd.unique(pd.Series(points, dtype='int64')).tolist()
+    key = _key(server, database)
+    store = _store_path(server, database, cache_dir)
+
+    ## Load the index
+    with _lock:
+        ext0 = _cached_extents(key, store)
+    if ext0 is None:
+        ext0 = pd.DataFrame(columns=['FromDate', 'ToDate'], index=pd.Index([], name='Point', dtype='int64'), dtype='datetime64[ns]')
+
+    with _lock:
+        checked = _checked.get(key, {})
+        now = time.time()
+        fresh = set(p for p in points if now - checked.get(p, 0) < param.extents_ttl)
+
+    if refresh:
+        new_points = points
+        old_points = []
+    else:
+        new_points = [p for p in points if p not in ext0.index]
+        old_points = [p for p in points if (p in ext0.index) and (p not in fresh)]
+
+    if new_points or old_points:
+        points1 = new_points + old_points
+
+        ## Query the database without holding the lock
+        if (con is not None) and (len(points1) > param.bulk_key_threshold):
+            ## Join against a temp table of the points and their watermarks
+            wm = pd.concat([pd.Series(pd.NaT, index=new_points, dtype='datetime64[ns]'), ext0.loc[old_points].ToDate.astype('datetime64[ns]')])
+            keys = pd.DataFrame({'Point': wm.index.astype('int64'), 'Watermark': wm.values})
+            with bulk_keys(con, keys, 'keys_extents') as (conn, keys_table):
+                stmt = since_join_stmt(param.data_tab, keys_table, 'extents')
+                ext1 = pd.read_sql_query(stmt, conn)
+            ext1['FromDate'] = pd.to_datetime(ext1['FromDate'])
+            ext1['ToDate'] = pd.to_datetime(ext1['ToDate'])
+            ext1 = ext1.set_index('Point')
+        else:
+            ## Full scan of the new points
+            where_list = ['Point in ({points})'.format(points=str(b)[1:-1]) for b in chunks(new_points, extents_batch)]
+
+            ## Incremental update of the indexed points
+            where_list.extend(since_where_stmts(ext0.loc[old_points].ToDate))
+
+            ext1 = _query_extents(server, database, where_list, con)
+
+        ## Update the index, combined with the updates of other threads
+        with _lock:
+            ext0 = _cached_extents(key, store)
+            if ext0 is None:
+                ext0 = pd.DataFrame(columns=['FromDate', 'ToDate'], index=pd.Index([], name='Point', dtype='int64'), dtype='datetime64[ns]')
+            ext2 = _combine_extents(ext0, ext1, new_points)
+            _extents[key] = ext2
+            if store is not None:
+                _save_pickle(ext2, os.path.join(store, extents_file))
+            _checked.setdefault(key, {}).update(dict.fromkeys(points1, now))
+    else:
+        ext2 = ext0
+
+    return ext2.reindex(pd.Index(points, name='Point', dtype='int64')).reset_index()
+
+
+def merge_point_extents(server, database, extents, cache_dir=None):
+    """
+    Function to widen the indexed extents of Points by the dates of samples that have just been written (e.g. by write_ts_data). Points that are not in the index are left out, as they are scanned in full on their first request.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    extents : DataFrame
+        Point, FromDate, ToDate of the written samples.
+    cache_dir : str or None
+        The folder for the on-disk index. None uses parameters.cache_dir.
+
+    Returns
+    -------
+    None
+    """
+    key = _key(server, database)
+    store = _store_path(server, database, cache_dir)
+
+    with _lock:
+        ext0 = _cached_extents(key, store)
+        if ext0 is None:
+            return
+
+        ext1 = extents.set_index('Point')[['FromDate', 'ToDate']]
+        ext1 = ext1[ext1.index.isin(ext0.index)]
+        if ext1.empty:
+            return
+
+        ext2 = _combine_extents(ext0, ext1)
+
+        _extents[key] = ext2
+        if store is not None:
+            _save_pickle(ext2, os.path.join(store, extents_file))
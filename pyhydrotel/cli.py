@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+The pyhydrotel console command.
+
+Examples
+--------
+pyhydrotel sites --server srv --database hydrotel --mtypes flow --output sites.csv
+
+pyhydrotel extract out_folder --server srv --database hydrotel --mtypes flow rainfall --sites-file sites.csv --from-date 2000-01-01 --to-date 2020-01-01 --threads 4
+
+Running the same extract command again after an interruption only runs the tasks that are not in out_folder/manifest.csv.
+"""
+import os
+import sys
+import logging
+import argparse
+import sqlalchemy
+import pandas as pd
+from pyhydrotel import parameters as param
+from pyhydrotel.client import HydrotelClient
+
+######################################
+### Parameters
+
+password_env = 'PYHYDROTEL_PASSWORD'
+
+
+######################################
+### Functions
+
+
+def read_sites(path):
+    """
+    Function to read sites from a file. Either a csv file with an ExtSiteID column (e.g. the output of the sites command) or a text file with one site per line.
+    """
+    if path.endswith('.csv'):
+        sites1 = pd.read_csv(path, dtype=str)
+        if 'ExtSiteID' in sites1:
+            return sites1['ExtSiteID'].dropna().str.strip().unique().tolist()
+        return sites1.iloc[:, 0].dropna().str.strip().unique().tolist()
+    with open(path) as f:
+        return list(dict.fromkeys(s.strip() for s in f if s.strip()))
+
+
+def build_parser():
+    """
+    Function to create the argument parser of the console command.
+    """
+    parser = argparse.ArgumentParser(prog='pyhydrotel', description='Extract data from a Hydrotel database.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log the progress of each task.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    db = argparse.ArgumentParser(add_help=False)
+    db.add_argument('--server', help='The server where the Hydrotel database lays.')
+    db.add_argument('--database', help='The name of the Hydrotel database.')
+    db.add_argument('--username', help='The user name. Windows authentication is used if not given.')
+    db.add_argument('--password', help='The password. Defaults to the {} environment variable.'.format(password_env))
+    db.add_argument('--url', help='An SQLAlchemy URL of the database that is used instead of the server and database.')
+    db.add_argument('--cache-dir', help='The folder of the local cache (see parameters.cache_dir).')
+    db.add_argument('--mtypes', nargs='+', required=True, help='The measurement types.')
+    db.add_argument('--sites', nargs='+', help='The sites (ExtSiteIDs). All sites if neither --sites nor --sites-file is given.')
+    db.add_argument('--sites-file', help='A csv file with an ExtSiteID column or a text file with one site per line.')
+
+    sites_parser = subparsers.add_parser('sites', parents=[db], help='List the sites and mtypes with their Points and date ranges.')
+    sites_parser.add_argument('--output', help='The csv file to write. Printed if not given.')
+
+    extract = subparsers.add_parser('extract', parents=[db], help='Extract time series data into files with parallel, resumable tasks.')
+    extract.add_argument('dest', help='The output folder.')
+    extract.add_argument('--from-date', help='The start date, e.g. 2000-01-01.')
+    extract.add_argument('--to-date', help='The end date, e.g. 2020-01-01.')
+    extract.add_argument('--resample-code', help='The Pandas resampling code, e.g. D. The raw samples if not given.')
+    extract.add_argument('--period', type=int, default=1, help='The number of resampling periods.')
+    extract.add_argument('--val-round', type=int, default=3, help='The number of decimals to round the values.')
+    extract.add_argument('--points-per-task', type=int, default=100, help='The maximum number of Points per task.')
+    extract.add_argument('--time-window', default='YS', help="The pandas frequency of the time windows of the tasks, e.g. YS or MS. 'none' for one window.")
+    extract.add_argument('--format', dest='file_format', choices=['parquet', 'csv'], default='parquet', help='The file format.')
+    extract.add_argument('--threads', type=int, default=4, help='The number of tasks run concurrently (and the number of connections).')
+    extract.add_argument('--retries', type=int, default=2, help='The number of times a failed task is run again.')
+    extract.add_argument('--no-resume', dest='resume', action='store_false', help='Run all tasks again instead of skipping the finished ones.')
+
+    return parser
+
+
+def get_client(args, pool_size=None):
+    """
+    Function to create the HydrotelClient from the command line arguments.
+    """
+    if args.cache_dir is not None:
+        param.cache_dir = args.cache_dir
+    if args.url is not None:
+        engine = sqlalchemy.create_engine(args.url)
+        return HydrotelClient(args.server or engine.url.host or 'local', args.database or engine.url.database or 'hydrotel', engine=engine)
+    if (args.server is None) or (args.database is None):
+        raise ValueError('Either --server and --database or --url must be given.')
+    password = args.password if args.password is not None else os.environ.get(password_env)
+
+    return HydrotelClient(args.server, args.database, username=args.username, password=password, pool_size=pool_size)
+
+
+def main(argv=None):
+    """
+    The entry point of the pyhydrotel console command.
+
+    Parameters
+    ----------
+    argv : list of str or None
+        The command line arguments. None uses sys.argv.
+
+    Returns
+    -------
+    int
+        The exit code. 1 if any task failed.
+    """
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        logging.getLogger('pyhydrotel').setLevel(logging.INFO)
+
+    sites = args.sites
+    if args.sites_file is not None:
+        sites = list(dict.fromkeys((sites or []) + read_sites(args.sites_file)))
+
+    if args.command == 'sites':
+        client = get_client(args)
+        sites1 = client.get_sites_mtypes(args.mtypes, sites).reset_index()
+        if args.output is None:
+            sites1.to_csv(sys.stdout, index=False)
+        else:
+            sites1.to_csv(args.output, index=False)
+        client.close()
+        return 0
+
+    threads = max(min(args.threads, param.max_connections), 1)
+    time_window = None if str(args.time_window).lower() == 'none' else args.time_window
+    client = get_client(args, pool_size=threads)
+    try:
+        tasks = client.extract_ts_data(args.dest, args.mtypes, sites, args.from_date, args.to_date, args.resample_code, args.period, args.val_round, args.points_per_task, time_window, args.file_format, threads, args.retries, args.resume)
+    finally:
+        client.close()
+
+    counts = tasks.status.value_counts()
+    print('{n} tasks: {written} written, {skipped} skipped, {failed} failed, {rows} rows written to {dest}'.format(n=len(tasks), written=counts.get('written', 0), skipped=counts.get('skipped', 0), failed=counts.get('failed', 0), rows=int(tasks.rows.sum()), dest=args.dest))
+    if counts.get('failed', 0):
+        print('Run the same command again to retry the failed tasks.', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,966 @@
+# -*- coding: utf-8 -*-
+"""
+The HydrotelClient class for querying a Hydrotel database through a single pooled connection engine.
+"""
+import threading
+import pandas as pd
+import sqlalchemy
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from pdsql.mssql import rd_sql_ts
+from pdsql.util import create_engine
+from pyhydrotel import parameters as param
+from pyhydrotel.parameters import resample_dict, data_tab, points_tab, objects_tab
+from pyhydrotel.catalog import get_catalog, cached_catalog, get_catalog_subset, load_catalog_subset, invalidate_catalog, get_point_extents, merge_point_extents
+from pyhydrotel.util import fun_dict, rd_ts_agg, ts_agg_stmt, chunks, time_windows, resample_local, since_where_stmts, since_join_stmt, bulk_keys, write_stmt, compact_ts, wide_ts, ts_avail_stmt, period_range
+from pyhydrotel.tiles import TileCache
+from pyhydrotel.rollups import RollupStore, tier_codes
+from pyhydrotel.query import HydrotelQuery
+from pyhydrotel.export import partitions, export_partitions, extract_tasks, run_tasks
+from pyhydrotel.instrument import instrument_engine, stage, record, timed, current_stage
+
+######################################
+### Parameters
+
+_clients = {}
+_lock = threading.Lock()
+
+
+######################################
+### Class
+
+
+class HydrotelClient(object):
+    """
+    Class to query a Hydrotel database. The client holds one pooled SQLAlchemy engine that is shared by all of its methods (and threads), so the connection to the server is only set up once.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    username : str or None
+        The username if a trusted connection is not used.
+    password : str or None
+        The password if a trusted connection is not used.
+    engine : SQLAlchemy engine or None
+        An existing engine to use instead of creating one (e.g. for a local copy of the database). server and database are then only used as the names for the cached catalog.
+    pool_size : int or None
+        The number of pooled connections. None uses parameters.max_connections.
+    tile_cache : bool, TileCache, or None
+        Should get_ts_data read the samples through a local tile cache (see tiles.TileCache)? None uses parameters.tile_cache.
+    rollups : bool, RollupStore, or None
+        Should get_ts_data serve hourly and coarser resample_codes from a local store of hourly, daily, and monthly rollups (see rollups.RollupStore)? None uses parameters.rollups.
+    catalog_cache : bool
+        Should get_sites_mtypes load and cache the full metadata catalog (see get_catalog)? If the catalog is not cached yet and only specific sites are requested, then only the matching rows are read from the database and kept in memory for repeated lookups (see catalog.get_catalog_subset). If False, then the matching rows are read on every call (see catalog.load_catalog_subset).
+    """
+    def __init__(self, server, database, username=None, password=None, engine=None, pool_size=None, tile_cache=None, catalog_cache=True, rollups=None):
+        self.server = server
+        self.database = database
+        self.tile_cache = tile_cache
+        self.catalog_cache = catalog_cache
+        self.rollups = rollups
+        self._rollups = None
+        self._tiles = None
+
+        if engine is None:
+            if pool_size is None:
+                pool_size = param.max_connections
+            eng0 = create_engine('mssql', server, database, username=username, password=password)
+            kwargs = {'fast_executemany': True} if eng0.url.get_driver_name() == 'pyodbc' else {}
+            engine = sqlalchemy.create_engine(eng0.url, pool_size=pool_size, max_overflow=0, pool_pre_ping=True, **kwargs)
+            eng0.dispose()
+
+        self.engine = instrument_engine(engine)
+        self.dialect = engine.dialect.name
+
+    def __repr__(self):
+        return "HydrotelClient(server='{server}', database='{database}')".format(server=self.server, database=self.database)
+
+    def close(self):
+        """
+        Method to close all pooled connections of the client.
+        """
+        self.engine.dispose()
+
+    def get_tile_cache(self):
+        """
+        Method to return the TileCache used by get_ts_data, or None if the tile cache is not enabled.
+        """
+        tile_cache = param.tile_cache if self.tile_cache is None else self.tile_cache
+        if isinstance(tile_cache, TileCache):
+            return tile_cache
+        if tile_cache:
+            if self._tiles is None:
+                self._tiles = TileCache(self.server, self.database)
+            return self._tiles
+
+        return None
+
+    def get_rollup_store(self):
+        """
+        Method to return the RollupStore used by get_ts_data, or None if the rollups are not enabled.
+        """
+        rollups = param.rollups if self.rollups is None else self.rollups
+        if isinstance(rollups, RollupStore):
+            return rollups
+        if rollups:
+            if self._rollups is None:
+                self._rollups = RollupStore(self.server, self.database)
+            return self._rollups
+
+        return None
+
+    def query(self):
+        """
+        Method to start a lazy time series query (see query.HydrotelQuery). e.g. client.query().sites(['70105']).mtypes('flow').between('2018-01-01').resample('D').collect()
+
+        Returns
+        -------
+        HydrotelQuery
+        """
+        return HydrotelQuery(self)
+
+    @timed('catalog')
+    def get_catalog(self, refresh=False):
+        """
+        Method to return the cached Hydrotel metadata catalog. See catalog.get_catalog.
+        """
+        return get_catalog(self.server, self.database, refresh=refresh, con=self.engine)
+
+    def invalidate_catalog(self):
+        """
+        Method to remove the cached Hydrotel metadata catalog. See catalog.invalidate_catalog.
+        """
+        invalidate_catalog(self.server, self.database)
+
+    @timed('extents')
+    def get_point_extents(self, points, refresh=False):
+        """
+        Method to return the first and last sample dates of Points. See catalog.get_point_extents.
+        """
+        return get_point_extents(self.server, self.database, points, refresh=refresh, con=self.engine)
+
+    def get_mtypes(self):
+        """
+        Method to return a Series of measurement types that can be passed to get_sites_mtypes and get_ts_data. Returns with a count of the frequency the values exist in the database and is sorted by the count.
+
+        Returns
+        -------
+        Series
+            MType (index), count
+        """
+        objects1 = self.get_catalog()['objects']
+        objects2 = objects1.groupby('Name').Site.count().sort_values(ascending=False)
+        objects2.name = 'count'
+        objects2.index.name = 'MType'
+
+        return objects2
+
+    def _site_points(self, mtypes=None, sites=None, catalog=None):
+        """
+        Method to match the sites and mtypes to their Objects and Points without the from and to dates. See get_sites_mtypes. A catalog (e.g. of load_catalog_subset) can be passed to match against instead of the cached one.
+        """
+        if isinstance(sites, str):
+            sites = [sites]
+
+        if isinstance(mtypes, str):
+            mtypes = [mtypes]
+        elif not isinstance(mtypes, list) and (mtypes is not None):
+            raise TypeError('mtypes must be either a str, a list of str, or None')
+
+        if catalog is None:
+            if self.catalog_cache:
+                catalog = cached_catalog(self.server, self.database)
+                if catalog is None:
+                    if sites is None:
+                        catalog = self.get_catalog()
+                    else:
+                        catalog = get_catalog_subset(self.server, self.database, mtypes, sites, con=self.engine)
+            else:
+                catalog = load_catalog_subset(self.server, self.database, mtypes, sites, con=self.engine)
+
+        ## Extract hydrotel site numbers for all ECan sites
+        sites1 = catalog['sites'].copy()
+        sites1['ExtSysId'] = sites1['ExtSysId'].str.strip()
+        sites1 = sites1[sites1.ExtSysId != '']
+
+        # GW
+        names_len_bool = sites1.Name.str.upper().str.match(r'[A-Z]+\d+/\d+')
+        gw_sites = sites1[names_len_bool].copy()
+        gw_sites.ExtSysId = gw_sites.Name.str.findall(r'[A-Z]+\d+/\d+').apply(lambda x: x[0])
+
+        # Others
+        sites2 = sites1[sites1.ExtSysId.str.match(r'\d+', na=False)].drop('Name', axis=1)
+
+        # Combine and remove duplicates
+        sites3 = pd.concat([gw_sites.drop('Name', axis=1), sites2])
+        sites3 = sites3.drop_duplicates('ExtSysId')
+
+        ## objects
+        objects1 = catalog['objects'].copy()
+        if isinstance(mtypes, list):
+            objects1 = objects1[objects1.Name.str.lower().isin([m.lower() for m in mtypes])].copy()
+        objects1.ExtSysID = objects1.ExtSysID.str.strip()
+        objects1.loc[objects1.ExtSysID == '', 'ExtSysID'] = None
+
+        ## Combine objects with sites
+        sites_ob1 = pd.merge(objects1, sites3, on='Site', how='left')
+        sites_ob1.loc[sites_ob1.ExtSysID.isnull(), 'ExtSysID'] = sites_ob1.loc[sites_ob1.ExtSysID.isnull(), 'ExtSysId']
+        sites_ob1 = sites_ob1.dropna(subset=['ExtSysID']).drop('ExtSysId', axis=1)
+
+        if isinstance(sites, list):
+            sites_ob1 = sites_ob1[sites_ob1.ExtSysID.isin(sites)]
+
+        sites_ob1.Name = sites_ob1.Name.str.lower()
+        sites_ob1.rename(columns={'Name': 'MType'}, inplace=True)
+
+        ## Import object/point data
+        points1 = catalog['points']
+        point_val = points1[points1.Object.isin(sites_ob1.Object)]
+
+        # Merge
+        site_point = pd.merge(sites_ob1, point_val, on='Object')
+
+        return site_point
+
+    @timed('sites_mtypes')
+    def get_sites_mtypes(self, mtypes=None, sites=None):
+        """
+        Method to determine the available sites and associated measurement types in the Hydrotel database. The Sites, Objects, and Points tables are read from the cached catalog (see get_catalog) or, for specific sites without a cached catalog, only the rows that can match are read from the database and cached by their sites and mtypes (see catalog.get_catalog_subset). The from and to dates come from the Point extents index (see get_point_extents), which only queries the samples added since its last update and not at all within parameters.extents_ttl seconds of it.
+
+        Parameters
+        ----------
+        mtypes : str, list of str, or None
+            The measurement type(s) of the sites that should be returned.
+        sites : str, list of str, or None
+            The list of sites that should be returned. None returns all sites.
+
+        Returns
+        -------
+        DataFrame
+            ExtSysID, MType, Site, Object, ObjectVariant
+        """
+        site_point = self._site_points(mtypes, sites)
+
+        ## Get from and to dates
+        min_max_point = self.get_point_extents(site_point.Point.astype(int).tolist())
+
+        ## Combine all together
+        site_summ = pd.merge(site_point, min_max_point, on='Point', how='left')
+        site_summ.rename(columns={'ExtSysID': 'ExtSiteID'}, inplace=True)
+        site_summ.set_index(['ExtSiteID', 'MType'], inplace=True)
+
+        return site_summ
+
+    def _select_points(self, mtypes, sites, from_date=None, to_date=None):
+        """
+        Method to return the Points of the sites and mtypes that have data within the time period.
+        """
+        site_point = self.get_sites_mtypes(mtypes, sites).reset_index()
+
+        ### Select rows within time period
+        if isinstance(from_date, str):
+            site_point = site_point[site_point.ToDate > from_date]
+        if isinstance(to_date, str):
+            site_point = site_point[site_point.FromDate < to_date]
+
+        return site_point
+
+    def _get_ts_samples(self, sel, resample_code, period, res_val, val_round, from_date, to_date, min_count, server_agg, parent=None, inclusive='both'):
+        """
+        Method to extract the resampled Point, DT, SampleValue rows of the Points of one mtype (with one column per function instead of SampleValue if res_val is a list). Returns an empty DataFrame if no data was found. If inclusive is 'left' (the to_date is excluded), then the samples are always resampled on the server.
+        """
+        points = sel.Point.astype(int).tolist()
+        tiles = self.get_tile_cache() if inclusive == 'both' else None
+        rollups = self.get_rollup_store() if inclusive == 'both' else None
+        if (rollups is not None) and (resample_code not in tier_codes):
+            rollups = None
+        if inclusive != 'both':
+            server_agg = True
+
+        with stage('ts_query', parent=parent, mtype=sel.MType.iloc[0], points=len(points), from_date=from_date, to_date=to_date) as evt:
+            if rollups is not None:
+                evt['method'] = 'rollups'
+                data1 = rollups.get_ts(self.engine, points, resample_code, period, res_val, val_round, from_date, to_date, min_count)
+            elif tiles is not None:
+                evt['method'] = 'tiles'
+                data1 = tiles.get_samples(self.engine, sel, from_date, to_date)
+                data1 = resample_local(data1, resample_code, period, res_val, val_round, min_count)
+            elif server_agg or isinstance(res_val, list) or (len(points) > param.bulk_key_threshold):
+                evt['method'] = 'server_agg'
+                data1 = rd_ts_agg(self.engine, data_tab, points, resample_code, period, res_val, val_round, from_date, to_date, min_count, inclusive, bulk_threshold=param.bulk_key_threshold)
+            else:
+                evt['method'] = 'rd_sql_ts'
+                try:
+                    data1 = rd_sql_ts(self.server, self.database, data_tab, 'Point', 'DT', 'SampleValue', resample_code, period, res_val, val_round, {'Point': points}, from_date=from_date, to_date=to_date, min_count=min_count, con=self.engine).reset_index()
+                except ValueError:
+                    data1 = pd.DataFrame()
+            record(evt, data1)
+
+        return data1
+
+    def _get_ts_points(self, sel, resample_code, period, res_val, val_round, from_date, to_date, min_count, server_agg, parent=None):
+        """
+        Method to extract the time series data of the Points of one mtype. Returns an empty Series if no data was found. If res_val is a list, then a DataFrame with one column per function is returned.
+        """
+        data1 = self._get_ts_samples(sel, resample_code, period, res_val, val_round, from_date, to_date, min_count, server_agg, parent)
+
+        return self._merge_points(sel, data1, res_val, parent)
+
+    def _merge_points(self, sel, data1, res_val, parent=None):
+        """
+        Method to replace the Points of the output of _get_ts_samples with their ExtSiteID and MType. Returns an empty Series if there is no data.
+        """
+        if data1.empty:
+            return pd.Series(dtype='float64', name='Value')
+
+        with stage('ts_merge', parent=parent, mtype=sel.MType.iloc[0]) as evt:
+            data1.rename(columns={'DT': 'DateTime', 'SampleValue': 'Value'}, inplace=True)
+            data2 = pd.merge(sel[['ExtSiteID', 'MType', 'Point']], data1, on='Point').drop('Point', axis=1).set_index(['ExtSiteID', 'MType', 'DateTime'])
+            if not isinstance(res_val, list):
+                data2 = data2.Value
+            record(evt, data2)
+
+        return data2
+
+    @timed('get_ts_data')
+    def get_ts_data(self, mtypes, sites, from_date=None, to_date=None, resample_code='D', period=1, val_round=3, min_count=None, pivot=False, server_agg=False, threads=1, points_per_query=None, compact=False, aggs=None, time_window=None):
+        """
+        Method to extract time series data from the hydrotel database.
+
+        Parameters
+        ----------
+        mtypes : str or list of str
+            The measurement type(s) of the sites that should be returned. Possible options include swl, flow, gwl, and precip.
+        sites : list of str
+            The list of sites that should be returned.
+        from_date : str or None
+            The start date in the format '2000-01-01'.
+        to_date : str or None
+            The end date in the format '2000-01-01'.
+        resample_code : str
+            The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+        period : int
+            The number of resampling periods. e.g. period = 2 and resample = 'D' would be to resample the values over a 2 day period.
+        val_round : int
+            The number of decimals to round the values.
+        min_count : int or None
+            The minimum number of resampled values required for a site/mtype to be returned.
+        pivot : bool
+            Should the output be pivotted into wide format?
+        server_agg : bool
+            Should each mtype be resampled by a single aggregation statement on the server (see util.ts_agg_stmt)? The min_count filter is then applied in the same statement instead of a separate count query, so only the aggregated rows are transferred.
+        threads : int
+            The number of queries to run concurrently. It is capped at parameters.max_connections. The output is the same as with a single thread.
+        points_per_query : int or None
+            The maximum number of Points per query. None queries all Points of an mtype at once.
+        compact : bool
+            Should the output use compact dtypes (see util.compact_ts)? The ExtSiteID and MType become categoricals, the DateTime int64 nanoseconds since 1970-01-01, and the values float32 if val_round allows it.
+        aggs : str, list of str, dict, or None
+            The resampling functions (mean, sum, count, min, or max) to calculate instead of the default function of each mtype (see parameters.resample_dict). Either the function(s) for all mtypes or a dict of mtype to function(s), e.g. {'flow': ['mean', 'min', 'max', 'count']}; mtypes not in the dict use their default. All functions of an mtype are calculated in the same pass over its samples. None uses the defaults.
+        time_window : str or None
+            The pandas frequency used to split the time period into windows that are queried separately (and concurrently with threads > 1), e.g. 'YS' for yearly windows. The window boundaries must be boundaries of the resampling periods (see util.time_windows), so no period is split between windows and the stitched output is the same as with one query. The windows are resampled on the server and min_count is applied after stitching. None queries the whole time period at once.
+
+        Returns
+        -------
+        Series or DataFrame
+            A MultiIndex Pandas Series if pivot is False and a DataFrame if True. If aggs is given, then the long output is a DataFrame with one column per function and the pivoted output has the function as the first column level, e.g. tsdata['max'] is the pivoted max values. Functions that were not requested for an mtype are NaN.
+        """
+        if aggs is not None:
+            if not isinstance(aggs, dict):
+                aggs = {m: aggs for m in ([mtypes] if isinstance(mtypes, str) else mtypes)}
+            aggs = {m.lower(): ([f] if isinstance(f, str) else list(f)) for m, f in aggs.items()}
+            bad_funs = set(f for f1 in aggs.values() for f in f1).difference(fun_dict)
+            if bad_funs:
+                raise ValueError('aggs must be one or more of ' + str(list(fun_dict.keys())))
+
+        ### Import data and select the correct sites
+        site_point = self._select_points(mtypes, sites, from_date, to_date)
+
+        if site_point.empty:
+            return pd.DataFrame()
+
+        ### Pull out the ts data
+        site_point1 = site_point[['ExtSiteID', 'MType', 'Point', 'FromDate', 'ToDate']].copy()
+
+        mtypes1 = site_point.MType.unique()
+
+        ### Time windows
+        if time_window is None:
+            windows = [(from_date, to_date, 'both')]
+        else:
+            start = site_point1.FromDate.min() if from_date is None else from_date
+            end = site_point1.ToDate.max() if to_date is None else to_date
+            windows = time_windows(start, end, time_window, resample_code, period)
+        windowed = len(windows) > 1
+
+        groups = []
+        for m in mtypes1:
+            if m in resample_dict:
+                res_val = resample_dict[m]
+            else:
+                res_val = 'mean'
+            if aggs is not None:
+                res_val = aggs.get(m, [res_val])
+            sel_m = site_point1[site_point1.MType == m]
+
+            for points in chunks(sel_m.Point.astype(int).tolist(), points_per_query):
+                sel = sel_m[sel_m.Point.isin(points)]
+                groups.append((sel, res_val))
+
+        tasks = [(sel, res_val, w) for sel, res_val in groups for w in windows]
+
+        if pivot or windowed:
+            get_fun = self._get_ts_samples
+        else:
+            get_fun = self._get_ts_points
+
+        parent = current_stage()
+
+        def get_task(task):
+            sel, res_val, (start, end, inclusive) = task
+            if windowed:
+                return get_fun(sel, resample_code, period, res_val, val_round, start, end, None, True, parent, inclusive)
+            return get_fun(sel, resample_code, period, res_val, val_round, from_date, to_date, min_count, server_agg, parent)
+
+        threads = max(min(int(threads), param.max_connections, len(tasks)), 1)
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as executor:
+                tsdata_list = list(executor.map(get_task, tasks))
+        else:
+            tsdata_list = [get_task(t) for t in tasks]
+
+        ### Stitch the windows of each Point batch
+        if windowed:
+            with stage('ts_stitch', windows=len(windows)):
+                results = tsdata_list
+                tsdata_list = []
+                for i, (sel, res_val) in enumerate(groups):
+                    data_list = [d for d in results[i * len(windows):(i + 1) * len(windows)] if not d.empty]
+                    if not data_list:
+                        continue
+                    data1 = pd.concat(data_list, ignore_index=True)
+                    if isinstance(min_count, int):
+                        data1 = data1[data1.groupby('Point').Point.transform('size') >= min_count]
+                    if not pivot:
+                        data1 = self._merge_points(sel, data1, res_val, parent)
+                    tsdata_list.append(data1)
+
+        tsdata_list = [t for t in tsdata_list if not t.empty]
+        if not tsdata_list:
+            return pd.DataFrame()
+
+        with stage('ts_combine', pivot=pivot, compact=compact):
+            if pivot and (aggs is not None):
+                agg_list = [f for f in dict.fromkeys(f for g in groups for f in g[1]) if any(f in t for t in tsdata_list)]
+                wide_list = [wide_ts([t for t in tsdata_list if f in t], site_point1, f) for f in agg_list]
+                tsdata = pd.concat(wide_list, axis=1, keys=agg_list, names=['Agg'])
+            elif pivot:
+                tsdata = wide_ts(tsdata_list, site_point1)
+            elif aggs is not None:
+                agg_list = list(dict.fromkeys(f for g in groups for f in g[1]))
+                tsdata = pd.concat(tsdata_list).reindex(columns=agg_list)
+            else:
+                tsdata = pd.concat(tsdata_list)
+
+            if compact:
+                tsdata = compact_ts(tsdata, val_round)
+
+        return tsdata
+
+    def iter_ts_data(self, mtypes, sites, from_date=None, to_date=None, resample_code=None, period=1, val_round=3, points_per_chunk=100, time_window=None, chunksize=100000):
+        """
+        Generator method to extract time series data from the hydrotel database in chunks. The requested Points are split into batches of points_per_chunk and the time period into windows of time_window, and the rows of each statement are fetched from the cursor chunksize rows at a time. The memory used therefore depends on the chunk sizes rather than on the size of the request.
+
+        Parameters
+        ----------
+        mtypes : str or list of str
+            The measurement type(s) of the sites that should be returned.
+        sites : list of str
+            The list of sites that should be returned.
+        from_date : str or None
+            The start date in the format '2000-01-01'.
+        to_date : str or None
+            The end date in the format '2000-01-01'.
+        resample_code : str or None
+            The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc. None returns the samples without resampling.
+        period : int
+            The number of resampling periods. e.g. period = 2 and resample = 'D' would be to resample the values over a 2 day period.
+        val_round : int
+            The number of decimals to round the values.
+        points_per_chunk : int
+            The maximum number of Points per statement.
+        time_window : str or None
+            The pandas frequency of the time windows. e.g. 'YS' for yearly or 'MS' for monthly windows. The window boundaries must be aligned with the resampling periods. None does not split the time period.
+        chunksize : int
+            The maximum number of rows fetched from the cursor at a time.
+
+        Yields
+        ------
+        Series
+            A MultiIndex Pandas Series of ExtSiteID, MType, and DateTime for each chunk. The chunks are in the order of mtype, Point batch, and time window.
+        """
+        ### Import data and select the correct sites
+        site_point = self._select_points(mtypes, sites, from_date, to_date)
+
+        if site_point.empty:
+            return
+
+        site_point1 = site_point[['ExtSiteID', 'MType', 'Point']].copy()
+
+        ### Time windows
+        if time_window is None:
+            windows = [(from_date, to_date, 'both')]
+        else:
+            start = site_point.FromDate.min() if from_date is None else from_date
+            end = site_point.ToDate.max() if to_date is None else to_date
+            windows = time_windows(start, end, time_window, resample_code, period)
+
+        ### Stream the ts data
+        with self.engine.connect().execution_options(stream_results=True) as conn:
+            for m in site_point1.MType.unique():
+                if m in resample_dict:
+                    res_val = resample_dict[m]
+                else:
+                    res_val = 'mean'
+                sel_m = site_point1[site_point1.MType == m]
+
+                for points in chunks(sel_m.Point.astype(int).tolist(), points_per_chunk):
+                    sel = sel_m[sel_m.Point.isin(points)]
+                    if len(points) > param.bulk_key_threshold:
+                        keys_cm = bulk_keys(conn, pd.DataFrame({'Point': pd.Series(points, dtype='int64')}), 'keys_point')
+                    else:
+                        keys_cm = nullcontext((conn, None))
+                    with keys_cm as (conn1, keys_table):
+                        for start, end, inclusive in windows:
+                            stmt = ts_agg_stmt(data_tab, points, resample_code, period, res_val, val_round, start, end, dialect=self.dialect, inclusive=inclusive, keys_table=keys_table)
+                            for data1 in pd.read_sql_query(stmt, conn1, chunksize=chunksize):
+                                data1['DT'] = pd.to_datetime(data1['DT'])
+                                data1.rename(columns={'DT': 'DateTime', 'SampleValue': 'Value'}, inplace=True)
+                                data2 = pd.merge(sel, data1, on='Point').drop('Point', axis=1).set_index(['ExtSiteID', 'MType', 'DateTime']).Value
+                                yield data2
+
+    @timed('export_ts_data')
+    def export_ts_data(self, dest, mtypes, sites=None, from_date=None, to_date=None, file_format='parquet', threads=4, chunksize=100000, resume=True):
+        """
+        Method to export the raw samples into files partitioned by site, mtype, Point, and year (dest/ExtSiteID=.../MType=.../Point=.../year=.../part-0.parquet) without loading them all into memory. The samples of each partition are streamed from the database in chunks, the partitions are written by parallel writers, and a partition file only exists once it is complete, so an interrupted export continues where it stopped when run again.
+
+        Parameters
+        ----------
+        dest : str
+            The base folder of the export.
+        mtypes : str or list of str
+            The measurement type(s) of the sites that should be exported.
+        sites : list of str or None
+            The list of sites that should be exported. None exports all sites.
+        from_date : str or None
+            The start date in the format '2000-01-01'.
+        to_date : str or None
+            The end date in the format '2000-01-01'.
+        file_format : str
+            Either parquet (needs pyarrow) or csv.
+        threads : int
+            The number of partitions written concurrently. It is capped at parameters.max_connections.
+        chunksize : int
+            The maximum number of rows held in memory per writer.
+        resume : bool
+            Should partitions that already have a file be skipped?
+
+        Returns
+        -------
+        DataFrame
+            ExtSiteID, MType, Point, year, start, end, path, status, rows, and seconds of each partition.
+        """
+        site_point = self._select_points(mtypes, sites, from_date, to_date)
+        parts = partitions(site_point, from_date, to_date)
+
+        return export_partitions(self.engine, dest, parts, file_format, threads, chunksize, resume)
+
+    @timed('extract_ts_data')
+    def extract_ts_data(self, dest, mtypes, sites=None, from_date=None, to_date=None, resample_code=None, period=1, val_round=3, points_per_task=100, time_window='YS', file_format='parquet', threads=4, retries=2, resume=True):
+        """
+        Method for large extractions into files. The Points are split into (Point batch x time window) tasks (see export.extract_tasks) that are run on a pool of threads, each task reading its (resampled) samples with one statement and writing them to dest/{task}.parquet with the columns ExtSiteID, MType, DateTime, and Value. Finished tasks are recorded in dest/manifest.csv, so running the same extraction again after an interruption only runs the remaining tasks (see export.run_tasks).
+
+        Parameters
+        ----------
+        dest : str
+            The folder of the extraction.
+        mtypes : str or list of str
+            The measurement type(s) of the sites that should be extracted.
+        sites : list of str or None
+            The list of sites that should be extracted. None extracts all sites.
+        from_date : str or None
+            The start date in the format '2000-01-01'.
+        to_date : str or None
+            The end date in the format '2000-01-01'.
+        resample_code : str or None
+            The Pandas time series resampling code. None extracts the raw samples.
+        period : int
+            The number of resampling periods.
+        val_round : int
+            The number of decimals to round the values.
+        points_per_task : int
+            The maximum number of Points per task.
+        time_window : str or None
+            The pandas frequency of the time windows of the tasks. e.g. 'YS' for yearly or 'MS' for monthly windows. None uses one window.
+        file_format : str
+            Either parquet (needs pyarrow) or csv.
+        threads : int
+            The number of tasks run concurrently. It is capped at parameters.max_connections.
+        retries : int
+            The number of times a failed task is run again before it is left for the next run.
+        resume : bool
+            Should the tasks recorded in the manifest be skipped? A ValueError is raised if dest has an extraction with other arguments.
+
+        Returns
+        -------
+        DataFrame
+            The task, MType, Points, start, end, inclusive, path, status (written, skipped, or failed), rows, seconds, and error of each task.
+        """
+        site_point = self._select_points(mtypes, sites, from_date, to_date)
+        tasks = extract_tasks(site_point, from_date, to_date, points_per_task, time_window, resample_code, period)
+        arguments = {'mtypes': sorted([mtypes] if isinstance(mtypes, str) else mtypes), 'sites': None if sites is None else sorted(sites), 'from_date': from_date, 'to_date': to_date, 'points_per_task': points_per_task, 'time_window': time_window}
+
+        return run_tasks(self.engine, dest, site_point, tasks, resample_code, period, val_round, file_format, threads, retries, resume, arguments)
+
+    @timed('get_ts_updates')
+    def get_ts_updates(self, mtypes=None, sites=None, points=None, since=None, points_per_query=None):
+        """
+        Method to extract only the samples that are newer than a watermark per Point. All Points are batched into one statement (or one per points_per_query Points), so the cost scales with the number of new samples rather than the length of a time window.
+
+        Parameters
+        ----------
+        mtypes : str, list of str, or None
+            The measurement type(s) of the sites that should be returned.
+        sites : str, list of str, or None
+            The list of sites that should be returned.
+        points : list of int or None
+            The Points that should be returned. Can be used instead of or together with sites and mtypes.
+        since : str, Timestamp, dict, Series, or None
+            The watermark(s). Either one date for all Points or a dict/Series of Point to date (e.g. the watermarks returned by the previous call). Points without a watermark return all of their samples.
+        points_per_query : int or None
+            The maximum number of Points per statement. None queries all Points at once.
+
+        Returns
+        -------
+        Series
+            A MultiIndex Pandas Series of ExtSiteID, MType, and DateTime of the new samples.
+        Series
+            The new watermarks with the Point as the index. Pass them to since in the next call.
+        """
+        ## Resolve the Points through the catalog only; the new samples make the extents unnecessary
+        site_point = self._site_points(mtypes, sites).rename(columns={'ExtSysID': 'ExtSiteID'})
+        if points is not None:
+            site_point = site_point[site_point.Point.isin(points)]
+        site_point = site_point[['ExtSiteID', 'MType', 'Point']].copy()
+        point_list = site_point.Point.astype(int).tolist()
+
+        ## Watermarks
+        if isinstance(since, (dict, pd.Series)):
+            watermarks = pd.to_datetime(pd.Series(since, dtype='object')).reindex(point_list)
+        else:
+            watermarks = pd.Series(pd.NaT if since is None else pd.Timestamp(since), index=point_list)
+        watermarks.index.name = 'Point'
+        watermarks.name = 'Watermark'
+
+        if not point_list:
+            return pd.Series(dtype='float64', name='Value'), watermarks
+
+        ## New samples
+        data_list = []
+        for batch in chunks(point_list, points_per_query):
+            if len(batch) > param.bulk_key_threshold:
+                keys = pd.DataFrame({'Point': pd.Series(batch, dtype='int64'), 'Watermark': watermarks.loc[batch].astype('datetime64[ns]').values})
+                with bulk_keys(self.engine, keys, 'keys_updates') as (conn, keys_table):
+                    stmt = since_join_stmt(data_tab, keys_table, 'samples')
+                    data_list.append(pd.read_sql_query(stmt, conn))
+            else:
+                stmt = "select Point, DT, SampleValue from {tab} where {where}".format(tab=data_tab, where=' or '.join(since_where_stmts(watermarks.loc[batch])))
+                data_list.append(pd.read_sql_query(stmt, self.engine))
+        data1 = pd.concat(data_list, ignore_index=True)
+        data1['DT'] = pd.to_datetime(data1['DT'])
+
+        ## Remove samples within the second of the watermark
+        wm = data1.Point.map(watermarks)
+        data1 = data1[wm.isnull() | (data1.DT > wm)].sort_values(['Point', 'DT'])
+
+        ## New watermarks
+        watermarks = pd.concat([watermarks, data1.groupby('Point').DT.max()], axis=1).max(axis=1)
+        watermarks = watermarks.reindex(point_list)
+        watermarks.index.name = 'Point'
+        watermarks.name = 'Watermark'
+
+        data1.rename(columns={'DT': 'DateTime', 'SampleValue': 'Value'}, inplace=True)
+        data2 = pd.merge(site_point, data1, on='Point').drop('Point', axis=1).set_index(['ExtSiteID', 'MType', 'DateTime']).Value
+
+        return data2, watermarks
+
+    @timed('get_ts_availability')
+    def get_ts_availability(self, mtypes, sites=None, from_date=None, to_date=None, resample_code='M', period=1):
+        """
+        Method to summarise the availability of samples without reading them. The number of samples and the largest gap between consecutive samples of every Point are calculated per resampling period with one grouped statement on the server (see util.ts_avail_stmt), so only one row per Point and period is transferred.
+
+        Parameters
+        ----------
+        mtypes : str or list of str
+            The measurement type(s) of the sites that should be returned.
+        sites : str, list of str, or None
+            The list of sites that should be returned. None returns all sites.
+        from_date : str or None
+            The start date in the format '2000-01-01'.
+        to_date : str or None
+            The end date in the format '2000-01-01'.
+        resample_code : str
+            The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+        period : int
+            The number of resampling periods.
+
+        Returns
+        -------
+        DataFrame
+            The number of samples (int32) with the periods (DateTime) as the index and ExtSiteID and MType as the columns. Periods without samples are 0.
+        DataFrame
+            The largest gap (Timedelta) between consecutive samples in the same shape. A gap is assigned to the period of the sample that ends it, so periods without samples are NaT and the gap shows up in the next period with samples.
+        """
+        site_point = self._site_points(mtypes, sites).rename(columns={'ExtSysID': 'ExtSiteID'})
+        site_point = site_point[['ExtSiteID', 'MType', 'Point']].drop_duplicates().sort_values(['ExtSiteID', 'MType'])
+        site_point['Point'] = site_point.Point.astype('int64')
+        points = site_point.Point.drop_duplicates().tolist()
+        columns = pd.MultiIndex.from_frame(site_point[['ExtSiteID', 'MType']])
+
+        if points:
+            if len(points) > param.bulk_key_threshold:
+                with bulk_keys(self.engine, pd.DataFrame({'Point': pd.Series(points, dtype='int64')}), 'keys_point') as (conn, keys_table):
+                    stmt = ts_avail_stmt(data_tab, points, resample_code, period, from_date, to_date, self.dialect, keys_table)
+                    data1 = pd.read_sql_query(stmt, conn)
+            else:
+                stmt = ts_avail_stmt(data_tab, points, resample_code, period, from_date, to_date, self.dialect)
+                data1 = pd.read_sql_query(stmt, self.engine)
+            data1['DT'] = pd.to_datetime(data1['DT'])
+        else:
+            data1 = pd.DataFrame(columns=['Point', 'DT', 'Count', 'MaxGap'])
+
+        ## The periods
+        start = from_date if from_date is not None else data1.DT.min()
+        end = to_date if to_date is not None else data1.DT.max()
+        if pd.isnull(start) or pd.isnull(end):
+            index = pd.DatetimeIndex([], name='DateTime')
+        else:
+            index = period_range(start, end, resample_code, period).rename('DateTime')
+
+        ## The matrices
+        counts = data1.pivot(index='DT', columns='Point', values='Count').reindex(index=index, columns=site_point.Point)
+        counts = counts.fillna(0).astype('int32')
+        counts.columns = columns
+        gaps = data1.pivot(index='DT', columns='Point', values='MaxGap').reindex(index=index, columns=site_point.Point)
+        gaps = gaps.apply(lambda x: pd.to_timedelta(x, unit='s')).astype('timedelta64[ns]')
+        gaps.columns = columns
+
+        return counts, gaps
+
+    @timed('write_ts_data')
+    def write_ts_data(self, data, upsert=True, batch_size=50000):
+        """
+        Method to write time series data into the Samples table. The sites and mtypes are resolved to Points through the catalog, and the samples are loaded in batches into a staging temp table (with fast_executemany on SQL Server) and then copied into the Samples table with one set-based statement per batch (MERGE on SQL Server). All batches are written in a single transaction.
+
+        Parameters
+        ----------
+        data : Series
+            A MultiIndex Pandas Series of ExtSiteID, MType, and DateTime as returned by get_ts_data. Null values are not written. Each site and mtype must have exactly one Point. The DateTimes must not be more precise than the DT column (see parameters.dt_precision), and of duplicate DateTimes the last value is written.
+        upsert : bool
+            Should existing samples of the same Point and DateTime be updated? If False, then existing samples raise an error and nothing is written.
+        batch_size : int
+            The number of samples per batch.
+
+        Returns
+        -------
+        int
+            The number of samples written.
+        """
+        data1 = data.dropna().reset_index()
+        data1.columns = ['ExtSiteID', 'MType', 'DateTime', 'Value']
+        data1['MType'] = data1.MType.str.lower()
+        if data1.empty:
+            return 0
+
+        ## Resolve the points
+        keys = data1[['ExtSiteID', 'MType']].drop_duplicates()
+        site_point = self._site_points(keys.MType.unique().tolist(), keys.ExtSiteID.unique().tolist()).rename(columns={'ExtSysID': 'ExtSiteID'})
+        site_point = site_point.drop_duplicates(['ExtSiteID', 'MType', 'Point'])
+        dup_bool = site_point.duplicated(['ExtSiteID', 'MType'], keep=False)
+        if dup_bool.any():
+            ambiguous = site_point[dup_bool].drop_duplicates(['ExtSiteID', 'MType'])
+            raise ValueError('The following sites and mtypes have more than one Point, so the Point to write to is ambiguous: ' + str(list(zip(ambiguous.ExtSiteID, ambiguous.MType))))
+        keys1 = pd.merge(keys, site_point[['ExtSiteID', 'MType', 'Point']], on=['ExtSiteID', 'MType'], how='left')
+        if keys1.Point.isnull().any():
+            missing = keys1[keys1.Point.isnull()]
+            raise ValueError('The following sites and mtypes do not exist: ' + str(list(zip(missing.ExtSiteID, missing.MType))))
+
+        ## The DateTimes are not truncated, as the truncated samples would no longer match the existing ones
+        dt = pd.to_datetime(data1.DateTime).astype('datetime64[ns]')
+        precision = param.dt_precision.get(self.dialect, 's')
+        fine_bool = dt != dt.dt.floor(precision)
+        if fine_bool.any():
+            raise ValueError('The DT column of the {dialect} Samples table stores the DateTimes to the {precision}, but {n} DateTimes are more precise (e.g. {ex}). Round them before writing.'.format(dialect=self.dialect, precision=precision, n=int(fine_bool.sum()), ex=dt[fine_bool].iloc[0]))
+        data1['DateTime'] = dt
+
+        samples = pd.merge(data1, keys1, on=['ExtSiteID', 'MType'])
+        samples = pd.DataFrame({'Point': samples.Point.astype('int64'), 'DT': samples.DateTime, 'SampleValue': samples.Value.astype('float64')})
+        samples = samples.drop_duplicates(['Point', 'DT'], keep='last').sort_values(['Point', 'DT'])
+
+        ## Write the batches
+        with self.engine.begin() as conn:
+            for start in range(0, len(samples), batch_size):
+                batch = samples.iloc[start:start + batch_size]
+                with bulk_keys(conn, batch, 'stage_samples') as (conn1, stage_table):
+                    conn1.execute(sqlalchemy.text(write_stmt(data_tab, stage_table, self.dialect, upsert)))
+
+        ## Update the extents index and tile cache
+        ext1 = samples.groupby('Point').DT.agg(['min', 'max']).rename(columns={'min': 'FromDate', 'max': 'ToDate'}).reset_index()
+        merge_point_extents(self.server, self.database, ext1)
+        rollups = self.get_rollup_store()
+        if rollups is not None:
+            rollups.invalidate(ext1.Point.tolist())
+        tiles = self.get_tile_cache()
+        if tiles is not None:
+            tiles.invalidate(list(samples.set_index(['Point', samples.DT.dt.to_period('M').dt.to_timestamp()]).index.unique()))
+
+        return len(samples)
+
+    def create_site_mtype(self, site, ref_point, new_mtype):
+        """
+        Method to create a new mtype for a specific site. A reference point number of an existing mtype of the same site must be used for creation. Run get_sites_mtypes to find a good reference point. See create_site_mtypes for creating many at once.
+
+        Parameters
+        ----------
+        site : str
+            The site to create the new mtype on.
+        ref_point : int
+            The reference point from another mtype on the same site.
+        new_mtype : str
+            The new mtype name. Must be unique for the associated site.
+
+        Returns
+        -------
+        DataFrame
+            The new object and point values in the format of get_sites_mtypes.
+        """
+        return self.create_site_mtypes([(site, ref_point, new_mtype)])
+
+    @timed('create_site_mtypes')
+    def create_site_mtypes(self, specs):
+        """
+        Method to create new mtypes for many sites at once. All specs are validated against a fresh read of their sites within the insert transaction, and the new Objects and Points are inserted in bulk within a single transaction, so either all or none of them are created.
+
+        Parameters
+        ----------
+        specs : DataFrame or list of tuple
+            The site, ref_point, and new_mtype of each new mtype (see create_site_mtype). Either a DataFrame with those columns or a list of (site, ref_point, new_mtype) tuples.
+
+        Returns
+        -------
+        DataFrame
+            The new object and point values in the format of get_sites_mtypes.
+        """
+        if isinstance(specs, pd.DataFrame):
+            specs1 = specs[['site', 'ref_point', 'new_mtype']].copy()
+        else:
+            specs1 = pd.DataFrame(list(specs), columns=['site', 'ref_point', 'new_mtype'])
+        if specs1.empty:
+            raise ValueError('specs must contain at least one new mtype')
+        specs1['site'] = specs1['site'].astype(str)
+        specs1['ref_point'] = specs1['ref_point'].astype('int64')
+        specs1['mtype'] = specs1['new_mtype'].str.lower()
+
+        if specs1.duplicated(['site', 'mtype']).any():
+            raise ValueError('The same new mtype is given more than once for a site')
+
+        with self.engine.begin() as conn:
+            ## Checks against a fresh read of the sites, as the cached catalog can miss mtypes created since it was loaded
+            sites = specs1.site.unique().tolist()
+            catalog = load_catalog_subset(self.server, self.database, sites=sites, con=conn)
+            site_mtypes = self._site_points(sites=sites, catalog=catalog).rename(columns={'ExtSysID': 'ExtSiteID'})
+
+            ref_bool = specs1.set_index(['site', 'ref_point']).index.isin(site_mtypes.set_index(['ExtSiteID', 'Point']).index)
+            if not ref_bool.all():
+                raise ValueError('model_point must be a Point that exists within the mtypes of the site: ' + str(specs1[~ref_bool].site.tolist()))
+            exist_bool = specs1.set_index(['site', 'mtype']).index.isin(site_mtypes.set_index(['ExtSiteID', 'MType']).index)
+            if exist_bool.any():
+                raise ValueError('new_name already exists as an mtype, please use a different name: ' + str(specs1[exist_bool].site.tolist()))
+
+            ## Import object/point data
+            point_val = pd.read_sql_query('select * from {tab} where Point in ({points})'.format(tab=points_tab, points=', '.join(str(int(p)) for p in specs1.ref_point.unique())), conn)
+            obj_val = pd.read_sql_query('select * from {tab} where Object in ({objects})'.format(tab=objects_tab, objects=', '.join(str(int(o)) for o in point_val.Object.unique())), conn)
+            obj_sites = obj_val.Site.unique().tolist()
+            treeindex_stmt = 'select Site, max(TreeIndex) as TreeIndex from {tab} where Site in ({sites}) group by Site'.format(tab=objects_tab, sites=', '.join(str(int(s)) for s in obj_sites))
+            treeindex1 = pd.read_sql_query(treeindex_stmt, conn).set_index('Site').TreeIndex
+
+            ## Assign new object data
+            ref1 = pd.merge(specs1, point_val[['Point', 'Object']].rename(columns={'Point': 'ref_point'}), on='ref_point')
+            ref1 = pd.merge(ref1, obj_val[['Object', 'Site', 'ObjectVariant']], on='Object')
+            obj_val2 = pd.merge(ref1[['Object', 'new_mtype']], obj_val, on='Object')
+            obj_val2['Name'] = obj_val2.pop('new_mtype')
+            obj_val2['TreeIndex'] = obj_val2.Site.map(treeindex1).astype('int64') + obj_val2.groupby('Site').cumcount() + 1
+
+            obj_val2.drop('Object', axis=1).to_sql(objects_tab, conn, if_exists='append', index=False, chunksize=1000)
+
+            ## Find out what the new object values are
+            new_obj_stmt = "select Object as NewObject, Site, Name as new_mtype, TreeIndex from {tab} where Site in ({sites}) and TreeIndex > {min_index}".format(tab=objects_tab, sites=', '.join(str(int(s)) for s in obj_sites), min_index=int(treeindex1.min()))
+            new_obj = pd.read_sql_query(new_obj_stmt, conn)
+            new_obj = new_obj[new_obj.TreeIndex > new_obj.Site.map(treeindex1)]
+            ref2 = pd.merge(ref1, new_obj, on=['Site', 'new_mtype'])
+
+            ## Assign new point data
+            point_val2 = pd.merge(ref2[['ref_point', 'new_mtype', 'NewObject']], point_val.drop(columns='Name', errors='ignore').rename(columns={'Point': 'ref_point'}), on='ref_point').drop(['ref_point', 'Object'], axis=1)
+            point_val2.rename(columns={'NewObject': 'Object', 'new_mtype': 'Name'}, inplace=True)
+
+            point_val2.to_sql(points_tab, conn, if_exists='append', index=False, chunksize=1000)
+
+            ## Find out what the new point values are
+            new_point_stmt = 'select Point, Object as NewObject from {tab} where Object in ({objects})'.format(tab=points_tab, objects=', '.join(str(int(o)) for o in ref2.NewObject))
+            new_point = pd.read_sql_query(new_point_stmt, conn)
+
+        ## The catalog is only stale once the insert is committed
+        self.invalidate_catalog()
+
+        ## Return new values
+        site_mtypes = pd.merge(ref2, new_point, on='NewObject')
+        site_mtypes = site_mtypes.drop('Object', axis=1).rename(columns={'site': 'ExtSiteID', 'mtype': 'MType', 'NewObject': 'Object'})
+        site_mtypes['FromDate'] = pd.NaT
+        site_mtypes['ToDate'] = pd.NaT
+        cols = [c for c in param.objects_col if c not in ('Name', 'ExtSysID')] + [c for c in param.points_col if c != 'Object'] + ['FromDate', 'ToDate']
+        site_mtypes = site_mtypes.set_index(['ExtSiteID', 'MType'])[cols]
+
+        return site_mtypes
+
+
+######################################
+### Functions
+
+
+def get_client(server, database):
+    """
+    Function to return the shared HydrotelClient of a server and database. The client is created on the first call and reused afterwards, so the module-level functions only set up the connection once per process.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+
+    Returns
+    -------
+    HydrotelClient
+    """
+    key = (server.lower(), database.lower())
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = HydrotelClient(server, database)
+            _clients[key] = client
+
+    return client
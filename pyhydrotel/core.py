@@ -5,28 +5,8 @@ Created on Tue Jan 02 10:05:15 2018
 @author: MichaelEK
 Functions to read hydrotel data.
 """
-import pandas as pd
-from pdsql.mssql import rd_sql, rd_sql_ts, to_mssql
-
-######################################
-### Parameters
-## mtypes dict
-#mtypes = ['flow', 'water level', 'rainfall', 'non-hydro release lc', 'Rakaia FH modified']
-#mtypes_list = ['Barometric Pressure', 'Conductivity', 'Flow Rate', 'Groundwater level', 'Rainfall Depth', 'Solar Radiation', 'Temperature', 'Turbidity', 'Water Level', 'Water Temperature', 'Wind Speed', 'Air Temperature']
-resample_dict = {'rainfall': 'sum'}
-
-## Database parameters
-data_tab = 'Samples'
-points_tab = 'Points'
-objects_tab = 'Objects'
-mtypes_tab = 'ObjectVariants'
-sites_tab = 'Sites'
-
-data_col = ['Point', 'DT', 'SampleValue']
-points_col = ['Point', 'Object']
-objects_col = ['Object', 'Site', 'ObjectVariant', 'Name', 'ExtSysID']
-mtypes_col = ['ObjectVariant', 'Name']
-sites_col = ['Site', 'Name', 'ExtSysId']
+from pyhydrotel.parameters import resample_dict, data_tab, points_tab, objects_tab, mtypes_tab, sites_tab, data_col, points_col, objects_col, mtypes_col, sites_col
+from pyhydrotel.client import HydrotelClient, get_client
 
 
 def get_mtypes(server, database):
@@ -51,17 +31,12 @@ def get_mtypes(server, database):
     Series
         MType (index), count
     """
-    objects1 = rd_sql(server, database, objects_tab, objects_col)
-    objects2 = objects1.groupby('Name').Site.count().sort_values(ascending=False)
-    objects2.name = 'count'
-    objects2.index.name = 'MType'
-
-    return objects2
+    return get_client(server, database).get_mtypes()
 
 
 def get_sites_mtypes(server, database, mtypes=None, sites=None):
     """
-    Function to determine the available sites and associated measurement types in the Hydrotel database.
+    Function to determine the available sites and associated measurement types in the Hydrotel database. The Sites, Objects, and Points tables are read from the cached catalog (see get_catalog), and the from and to dates come from the Point extents index (see get_point_extents), which only queries the samples added since its last update.
 
     Parameters
     ----------
@@ -79,76 +54,10 @@ def get_sites_mtypes(server, database, mtypes=None, sites=None):
     DataFrame
         ExtSysID, MType, Site, Object, ObjectVariant
     """
-    if isinstance(sites, str):
-        sites = [sites]
-
-    if isinstance(mtypes, str):
-        mtype_dict = {'Name': [mtypes]}
-    elif isinstance(mtypes, list):
-        mtype_dict = {'Name': mtypes}
-    elif mtypes is None:
-        mtype_dict = None
-    else:
-        raise TypeError('mtypes must be either a str, a list of str, or None')
-
-    ## Extract hydrotel site numbers for all ECan sites
-    sites1 = rd_sql(server, database, sites_tab, sites_col)
-    sites1['ExtSysId'] = sites1['ExtSysId'].str.strip()
-    sites1 = sites1[sites1.ExtSysId != '']
-#    sites1.rename(columns={'ExtSysId': 'ExtSysID'}, inplace=True)
-
-    # GW
-    names_len_bool = sites1.Name.str.upper().str.match('[A-Z]+\d+/\d+')
-    gw_sites = sites1[names_len_bool].copy()
-    gw_sites.ExtSysId = gw_sites.Name.str.findall('[A-Z]+\d+/\d+').apply(lambda x: x[0])
-#    gw_sites['MType'] = 'gwl'
-
-    # Others
-    sites2 = sites1[sites1.ExtSysId.str.match('\d+', na=False)].drop('Name', axis=1)
-#    sites3 = ob1[ob1.ExtSysID.str.contains('\d+', na=False)]
-
-    # Combine and remove duplicates
-    sites3 = pd.concat([gw_sites.drop('Name', axis=1), sites2])
-    sites3 = sites3.drop_duplicates('ExtSysId')
-
-    ## objects
-    objects1 = rd_sql(server, database, objects_tab, objects_col, mtype_dict)
-    objects1.ExtSysID = objects1.ExtSysID.str.strip()
-    objects1.loc[objects1.ExtSysID == '', 'ExtSysID'] = None
-
-    ## Combine objects with sites
-    sites_ob1 = pd.merge(objects1, sites3, on='Site', how='left')
-    sites_ob1.loc[sites_ob1.ExtSysID.isnull(), 'ExtSysID'] = sites_ob1.loc[sites_ob1.ExtSysID.isnull(), 'ExtSysId']
-    sites_ob1 = sites_ob1.dropna(subset=['ExtSysID']).drop('ExtSysId', axis=1)
-
-    if isinstance(sites, list):
-        sites_ob1 = sites_ob1[sites_ob1.ExtSysID.isin(sites)]
-
-    sites_ob1.Name = sites_ob1.Name.str.lower()
-    sites_ob1.rename(columns={'Name': 'MType'}, inplace=True)
-
-    ## Import object/point data
-    point_val = rd_sql(server, database, points_tab, points_col, where_in={'Object': sites_ob1.Object.astype(int).tolist()})
-
-    # Merge
-    site_point = pd.merge(sites_ob1, point_val, on='Object')
-
-    ## Get from and to dates
-    sql_stmt = """select Point, min(DT) as FromDate, max(DT) as ToDate
-                from Hydrotel.dbo.Samples
-                where Point in ({sites})
-                group by Point""".format(sites=str(site_point.Point.astype(int).tolist())[1:-1])
-    min_max_point = rd_sql(server, database, stmt=sql_stmt)
-
-    ## Combine all together
-    site_summ = pd.merge(site_point, min_max_point, on='Point', how='left')
-    site_summ.rename(columns={'ExtSysID': 'ExtSiteID'}, inplace=True)
-    site_summ.set_index(['ExtSiteID', 'MType'], inplace=True)
-
-    return site_summ
-
-
-def get_ts_data(server, database, mtypes, sites, from_date=None, to_date=None, resample_code='D', period=1, val_round=3, min_count=None, pivot=False):
+    return get_client(server, database).get_sites_mtypes(mtypes, sites)
+
+
+def get_ts_data(server, database, mtypes, sites, from_date=None, to_date=None, resample_code='D', period=1, val_round=3, min_count=None, pivot=False, server_agg=False, threads=1, points_per_query=None, compact=False, aggs=None, time_window=None):
     """
     Function to extract time series data from the hydrotel database.
 
@@ -172,53 +81,241 @@ def get_ts_data(server, database, mtypes, sites, from_date=None, to_date=None, r
         The number of resampling periods. e.g. period = 2 and resample = 'D' would be to resample the values over a 2 day period.
     val_round : int
         The number of decimals to round the values.
+    min_count : int or None
+        The minimum number of resampled values required for a site/mtype to be returned.
     pivot : bool
         Should the output be pivotted into wide format?
+    server_agg : bool
+        Should each mtype be resampled by a single aggregation statement on the server (see util.ts_agg_stmt)? The min_count filter is then applied in the same statement instead of a separate count query, so only the aggregated rows are transferred.
+    threads : int
+        The number of queries to run concurrently. It is capped at parameters.max_connections. The output is the same as with a single thread.
+    points_per_query : int or None
+        The maximum number of Points per query. None queries all Points of an mtype at once.
+    compact : bool
+        Should the output use compact dtypes (see util.compact_ts)? The ExtSiteID and MType become categoricals, the DateTime int64 nanoseconds since 1970-01-01, and the values float32 if val_round allows it.
+    aggs : str, list of str, dict, or None
+        The resampling functions (mean, sum, count, min, or max) to calculate instead of the default function of each mtype. Either the function(s) for all mtypes or a dict of mtype to function(s), e.g. {'flow': ['mean', 'min', 'max', 'count']}. All functions of an mtype are calculated in the same pass over its samples.
+    time_window : str or None
+        The pandas frequency used to split the time period into windows that are queried separately (and concurrently with threads > 1), e.g. 'YS' for yearly windows. The window boundaries must be boundaries of the resampling periods, so the stitched output is the same as with one query. None queries the whole time period at once.
 
     Returns
     -------
     Series or DataFrame
-        A MultiIndex Pandas Series if pivot is False and a DataFrame if True
+        A MultiIndex Pandas Series if pivot is False and a DataFrame if True. If aggs is given, then the long output has one column per function and the pivoted output has the function as the first column level.
     """
-    ### Import data and select the correct sites
-    site_point = get_sites_mtypes(server, database, mtypes, sites).reset_index()
+    return get_client(server, database).get_ts_data(mtypes, sites, from_date, to_date, resample_code, period, val_round, min_count, pivot, server_agg, threads, points_per_query, compact, aggs, time_window)
 
-    ### Select rows within time period
-    if isinstance(from_date, str):
-        site_point = site_point[site_point.ToDate > from_date]
-    if isinstance(to_date, str):
-        site_point = site_point[site_point.FromDate < to_date]
 
-    if site_point.empty:
-        return pd.DataFrame()
+def iter_ts_data(server, database, mtypes, sites, from_date=None, to_date=None, resample_code=None, period=1, val_round=3, points_per_chunk=100, time_window=None, chunksize=100000):
+    """
+    Generator to extract time series data from the hydrotel database in chunks. The requested Points are split into batches of points_per_chunk and the time period into windows of time_window, and the rows of each statement are fetched from the cursor chunksize rows at a time. The memory used therefore depends on the chunk sizes rather than on the size of the request.
 
-    ### Pull out the ts data
-    site_point1 = site_point[['ExtSiteID', 'MType', 'Point']].copy()
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    mtypes : str or list of str
+        The measurement type(s) of the sites that should be returned.
+    sites : list of str
+        The list of sites that should be returned.
+    from_date : str or None
+        The start date in the format '2000-01-01'.
+    to_date : str or None
+        The end date in the format '2000-01-01'.
+    resample_code : str or None
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc. None returns the samples without resampling.
+    period : int
+        The number of resampling periods. e.g. period = 2 and resample = 'D' would be to resample the values over a 2 day period.
+    val_round : int
+        The number of decimals to round the values.
+    points_per_chunk : int
+        The maximum number of Points per statement.
+    time_window : str or None
+        The pandas frequency of the time windows. e.g. 'YS' for yearly or 'MS' for monthly windows. The window boundaries must be aligned with the resampling periods. None does not split the time period.
+    chunksize : int
+        The maximum number of rows fetched from the cursor at a time.
+
+    Yields
+    ------
+    Series
+        A MultiIndex Pandas Series of ExtSiteID, MType, and DateTime for each chunk. The chunks are in the order of mtype, Point batch, and time window.
+    """
+    return get_client(server, database).iter_ts_data(mtypes, sites, from_date, to_date, resample_code, period, val_round, points_per_chunk, time_window, chunksize)
 
-    tsdata_list = []
 
-    mtypes1 = site_point.MType.unique()
+def get_ts_updates(server, database, mtypes=None, sites=None, points=None, since=None, points_per_query=None):
+    """
+    Function to extract only the samples that are newer than a watermark per Point. All Points are batched into one statement (or one per points_per_query Points), so the cost scales with the number of new samples rather than the length of a time window.
 
-    for m in mtypes1:
-        if m in resample_dict:
-            res_val = resample_dict[m]
-        else:
-            res_val = 'mean'
-        sel = site_point1[site_point1.MType == m]
-        points = sel.Point.astype(int).tolist()
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    mtypes : str, list of str, or None
+        The measurement type(s) of the sites that should be returned.
+    sites : str, list of str, or None
+        The list of sites that should be returned.
+    points : list of int or None
+        The Points that should be returned. Can be used instead of or together with sites and mtypes.
+    since : str, Timestamp, dict, Series, or None
+        The watermark(s). Either one date for all Points or a dict/Series of Point to date (e.g. the watermarks returned by the previous call). Points without a watermark return all of their samples.
+    points_per_query : int or None
+        The maximum number of Points per statement. None queries all Points at once.
 
-        data1 = rd_sql_ts(server, database, data_tab, 'Point', 'DT', 'SampleValue', resample_code, period, res_val, val_round, {'Point': points}, from_date=from_date, to_date=to_date, min_count=min_count).reset_index()
+    Returns
+    -------
+    Series
+        A MultiIndex Pandas Series of ExtSiteID, MType, and DateTime of the new samples.
+    Series
+        The new watermarks with the Point as the index. Pass them to since in the next call.
+    """
+    return get_client(server, database).get_ts_updates(mtypes, sites, points, since, points_per_query)
 
-        data1.rename(columns={'DT': 'DateTime', 'SampleValue': 'Value'}, inplace=True)
-        data2 = pd.merge(sel, data1, on='Point').drop('Point', axis=1).set_index(['ExtSiteID', 'MType', 'DateTime']).Value
-        tsdata_list.append(data2)
 
-    tsdata = pd.concat(tsdata_list)
+def get_ts_availability(server, database, mtypes, sites=None, from_date=None, to_date=None, resample_code='M', period=1):
+    """
+    Function to summarise the availability of samples without reading them. The number of samples and the largest gap between consecutive samples of every Point are calculated per resampling period with one grouped statement on the server, so only one row per Point and period is transferred.
 
-    if pivot:
-        tsdata = tsdata.unstack([0, 1])
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    mtypes : str or list of str
+        The measurement type(s) of the sites that should be returned.
+    sites : str, list of str, or None
+        The list of sites that should be returned. None returns all sites.
+    from_date : str or None
+        The start date in the format '2000-01-01'.
+    to_date : str or None
+        The end date in the format '2000-01-01'.
+    resample_code : str
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+    period : int
+        The number of resampling periods.
 
-    return tsdata
+    Returns
+    -------
+    DataFrame
+        The number of samples with the periods (DateTime) as the index and ExtSiteID and MType as the columns.
+    DataFrame
+        The largest gap (Timedelta) between consecutive samples in the same shape.
+    """
+    return get_client(server, database).get_ts_availability(mtypes, sites, from_date, to_date, resample_code, period)
+
+
+def export_ts_data(server, database, dest, mtypes, sites=None, from_date=None, to_date=None, file_format='parquet', threads=4, chunksize=100000, resume=True):
+    """
+    Function to export the raw samples into files partitioned by site, mtype, Point, and year (dest/ExtSiteID=.../MType=.../Point=.../year=.../part-0.parquet) without loading them all into memory. The samples of each partition are streamed from the database in chunks, the partitions are written by parallel writers, and a partition file only exists once it is complete, so an interrupted export continues where it stopped when run again.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    dest : str
+        The base folder of the export.
+    mtypes : str or list of str
+        The measurement type(s) of the sites that should be exported.
+    sites : list of str or None
+        The list of sites that should be exported. None exports all sites.
+    from_date : str or None
+        The start date in the format '2000-01-01'.
+    to_date : str or None
+        The end date in the format '2000-01-01'.
+    file_format : str
+        Either parquet (needs pyarrow) or csv.
+    threads : int
+        The number of partitions written concurrently. It is capped at parameters.max_connections.
+    chunksize : int
+        The maximum number of rows held in memory per writer.
+    resume : bool
+        Should partitions that already have a file be skipped?
+
+    Returns
+    -------
+    DataFrame
+        ExtSiteID, MType, Point, year, start, end, path, status, rows, and seconds of each partition.
+    """
+    return get_client(server, database).export_ts_data(dest, mtypes, sites, from_date, to_date, file_format, threads, chunksize, resume)
+
+
+def extract_ts_data(server, database, dest, mtypes, sites=None, from_date=None, to_date=None, resample_code=None, period=1, val_round=3, points_per_task=100, time_window='YS', file_format='parquet', threads=4, retries=2, resume=True):
+    """
+    Function for large extractions into files. The Points are split into (Point batch x time window) tasks that are run on a pool of threads, each task writing one file to dest. Finished tasks are recorded in dest/manifest.csv, so running the same extraction again after an interruption only runs the remaining tasks.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    dest : str
+        The folder of the extraction.
+    mtypes : str or list of str
+        The measurement type(s) of the sites that should be extracted.
+    sites : list of str or None
+        The list of sites that should be extracted. None extracts all sites.
+    from_date : str or None
+        The start date in the format '2000-01-01'.
+    to_date : str or None
+        The end date in the format '2000-01-01'.
+    resample_code : str or None
+        The Pandas time series resampling code. None extracts the raw samples.
+    period : int
+        The number of resampling periods.
+    val_round : int
+        The number of decimals to round the values.
+    points_per_task : int
+        The maximum number of Points per task.
+    time_window : str or None
+        The pandas frequency of the time windows of the tasks. e.g. 'YS' for yearly or 'MS' for monthly windows.
+    file_format : str
+        Either parquet (needs pyarrow) or csv.
+    threads : int
+        The number of tasks run concurrently. It is capped at parameters.max_connections.
+    retries : int
+        The number of times a failed task is run again before it is left for the next run.
+    resume : bool
+        Should the tasks recorded in the manifest be skipped? A ValueError is raised if dest has an extraction with other arguments.
+
+    Returns
+    -------
+    DataFrame
+        The tasks with their status (written, skipped, or failed), rows, and seconds.
+    """
+    return get_client(server, database).extract_ts_data(dest, mtypes, sites, from_date, to_date, resample_code, period, val_round, points_per_task, time_window, file_format, threads, retries, resume)
+
+
+def write_ts_data(server, database, data, upsert=True, batch_size=50000):
+    """
+    Function to write time series data into the Samples table. The sites and mtypes are resolved to Points through the catalog, and the samples are bulk loaded in batches and upserted within a single transaction.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    data : Series
+        A MultiIndex Pandas Series of ExtSiteID, MType, and DateTime as returned by get_ts_data. Null values are not written.
+    upsert : bool
+        Should existing samples of the same Point and DateTime be updated? If False, then existing samples raise an error and nothing is written.
+    batch_size : int
+        The number of samples per batch.
+
+    Returns
+    -------
+    int
+        The number of samples written.
+    """
+    return get_client(server, database).write_ts_data(data, upsert, batch_size)
 
 
 def create_site_mtype(server, database, site, ref_point, new_mtype):
@@ -243,39 +340,25 @@ def create_site_mtype(server, database, site, ref_point, new_mtype):
     DataFrame
         New object and point values extracted by the get_sites_mtypes function.
     """
-    ## Checks
-    site_mtypes = get_sites_mtypes(server, database, sites=site).reset_index()
-
-    if not (site_mtypes.Point == ref_point).any():
-        raise ValueError('model_point must be a Point that exists within the mtypes of the site')
-    if (site_mtypes.MType == new_mtype.lower()).any():
-        raise ValueError('new_name already exists as an mtype, please use a different name')
-
-    ## Import object/point data
-    point_val = rd_sql(server, database, points_tab, where_in={'Point': [ref_point]})
-    obj_val = rd_sql(server, database, objects_tab, where_in={'Object': point_val.Object.tolist()})
+    return get_client(server, database).create_site_mtype(site, ref_point, new_mtype)
 
-    treeindex1 = int(rd_sql(server, database, stmt='select max(TreeIndex) from {tab} where Site = {site}'.format(tab=objects_tab, site=int(obj_val.Site))).iloc[0])
 
-    ## Assign new object data
-    obj_val2 = obj_val.drop('Object', axis=1).copy()
-    obj_val2['Name'] = new_mtype
-    obj_val2['TreeIndex'] = treeindex1 + 1
-
-    to_mssql(obj_val2, server, database, objects_tab)
-
-    ## Find out what the new object value is
-    new_obj = int(rd_sql(server, database, objects_tab, where_in={'Site': obj_val.Site.tolist(), 'Name': [new_mtype]}).Object)
-
-    ## Assign new point data
-    point_val2 = point_val.drop('Point', axis=1).copy()
-    point_val2['Name'] = new_mtype
-    point_val2['Object'] = new_obj
-
-    to_mssql(point_val2, server, database, points_tab)
-
-    ## Return new values
-    site_mtypes = get_sites_mtypes(server, database, sites=site, mtypes=new_mtype)
+def create_site_mtypes(server, database, specs):
+    """
+    Function to create new mtypes for many sites at once. All specs are validated against a single catalog read, and the new Objects and Points are inserted in bulk within a single transaction.
 
-    return site_mtypes
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    specs : DataFrame or list of tuple
+        The site, ref_point, and new_mtype of each new mtype (see create_site_mtype). Either a DataFrame with those columns or a list of (site, ref_point, new_mtype) tuples.
 
+    Returns
+    -------
+    DataFrame
+        New object and point values extracted by the get_sites_mtypes function.
+    """
+    return get_client(server, database).create_site_mtypes(specs)
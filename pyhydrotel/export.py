@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to export the samples of a Hydrotel database to partitioned Parquet or CSV files.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from pyhydrotel import parameters as param
+from pyhydrotel.parameters import resample_dict
+from pyhydrotel.util import ts_where_stmts, ts_agg_stmt, time_windows, chunks, bulk_keys, dialect_name
+from pyhydrotel.instrument import stage, current_stage
+
+######################################
+### Parameters
+
+partition_path = os.path.join('ExtSiteID={site}', 'MType={mtype}', 'Point={point}', 'year={year}', 'part-0.{ext}')
+file_ext = {'parquet': 'parquet', 'csv': 'csv'}
+
+tasks_file = 'tasks.csv'
+arguments_file = 'arguments.json'
+manifest_file = 'manifest.csv'
+manifest_cols = ['task', 'rows', 'seconds', 'finished']
+task_file = '{task}.{ext}'
+
+logger = logging.getLogger('pyhydrotel')
+
+
+######################################
+### Functions
+
+
+def partitions(site_point, from_date=None, to_date=None):
+    """
+    Function to split the Points into site/mtype/Point/year partitions. A site can have more than one Point of an mtype, so the Point is part of the partition.
+
+    Parameters
+    ----------
+    site_point : DataFrame
+        ExtSiteID, MType, Point, FromDate, ToDate of the Points (see get_sites_mtypes).
+    from_date : str, Timestamp, or None
+        The start date.
+    to_date : str, Timestamp, or None
+        The end date.
+
+    Returns
+    -------
+    DataFrame
+        ExtSiteID, MType, Point, year, start, end. The partition covers start <= DT < end.
+    """
+    rows = []
+    for site, mtype, p, start, end in site_point[['ExtSiteID', 'MType', 'Point', 'FromDate', 'ToDate']].itertuples(index=False):
+        if pd.isnull(start):
+            continue
+        if from_date is not None:
+            start = max(start, pd.Timestamp(from_date))
+        if to_date is not None:
+            end = min(end, pd.Timestamp(to_date))
+        if start > end:
+            continue
+        for year in range(start.year, end.year + 1):
+            part_start = max(start, pd.Timestamp(year, 1, 1))
+            part_end = min(end + pd.Timedelta('1s'), pd.Timestamp(year + 1, 1, 1))
+            rows.append((site, mtype, int(p), year, part_start, part_end))
+
+    return pd.DataFrame(rows, columns=['ExtSiteID', 'MType', 'Point', 'year', 'start', 'end'])
+
+
+def partition_file(dest, site, mtype, point, year, file_format='parquet'):
+    """
+    Function to return the file path of a partition. The site and mtype are URI encoded (e.g. L37/0000 becomes L37%2F0000) as in Hive-style partitioned datasets.
+    """
+    return os.path.join(dest, partition_path.format(site=quote(str(site), safe=''), mtype=quote(str(mtype), safe=''), point=int(point), year=year, ext=file_ext[file_format]))
+
+
+def write_partition(engine, path, point, start, end, file_format='parquet', chunksize=100000):
+    """
+    Function to stream the samples of one Point and time period from the database into a file. The rows are fetched and written chunksize rows at a time into a temporary file that is renamed once it is complete, so a partition file only exists if it has been fully written.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+        The engine of the Hydrotel database.
+    path : str
+        The file path.
+    point : int
+        The Point.
+    start : Timestamp
+        The start date (inclusive).
+    end : Timestamp
+        The end date (exclusive).
+    file_format : str
+        Either parquet or csv.
+    chunksize : int
+        The maximum number of rows held in memory.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    where_stmt = ' and '.join(ts_where_stmts([point], start, end, inclusive='left'))
+    stmt = "select DT as DateTime, SampleValue as Value from {tab} where {where} order by DT".format(tab=param.data_tab, where=where_stmt)
+
+    n_rows = 0
+    writer = None
+    try:
+        with engine.connect().execution_options(stream_results=True) as conn:
+            for data1 in pd.read_sql_query(stmt, conn, chunksize=chunksize):
+                data1['DateTime'] = pd.to_datetime(data1['DateTime']).astype('datetime64[ns]')
+                data1['Value'] = data1['Value'].astype('float64')
+                if file_format == 'parquet':
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+                    table = pa.Table.from_pandas(data1, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp_path, table.schema)
+                    writer.write_table(table)
+                else:
+                    data1.to_csv(tmp_path, mode='w' if n_rows == 0 else 'a', header=n_rows == 0, index=False)
+                n_rows += len(data1)
+        if n_rows == 0:
+            if file_format == 'parquet':
+                pd.DataFrame({'DateTime': pd.Series(dtype='datetime64[ns]'), 'Value': pd.Series(dtype='float64')}).to_parquet(tmp_path, index=False)
+            else:
+                pd.DataFrame(columns=['DateTime', 'Value']).to_csv(tmp_path, index=False)
+        if writer is not None:
+            writer.close()
+            writer = None
+        os.replace(tmp_path, path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return n_rows
+
+
+def export_partitions(engine, dest, parts, file_format='parquet', threads=4, chunksize=100000, resume=True):
+    """
+    Function to export partitions (see partitions) with parallel writers. Each writer streams one partition at a time, so at most threads * chunksize rows are held in memory.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+        The engine of the Hydrotel database.
+    dest : str
+        The base folder of the export.
+    parts : DataFrame
+        The output of partitions.
+    file_format : str
+        Either parquet or csv.
+    threads : int
+        The number of partitions written concurrently. It is capped at parameters.max_connections.
+    chunksize : int
+        The maximum number of rows held in memory per writer.
+    resume : bool
+        Should partitions that already have a file be skipped? If False, then they are written again.
+
+    Returns
+    -------
+    DataFrame
+        The parts with the path, status (written or skipped), rows, and seconds of each partition.
+    """
+    if file_format not in file_ext:
+        raise ValueError('file_format must be one of ' + str(list(file_ext.keys())))
+
+    parts1 = parts.copy()
+    parts1['path'] = [partition_file(dest, s, m, p, y, file_format) for s, m, p, y in zip(parts1.ExtSiteID, parts1.MType, parts1.Point, parts1.year)]
+    parent = current_stage()
+
+    def run(part):
+        if resume and os.path.isfile(part.path):
+            return 'skipped', None, 0.0
+        start = time.perf_counter()
+        with stage('export_partition', parent=parent, site=part.ExtSiteID, mtype=part.MType, point=part.Point, year=part.year) as evt:
+            rows = write_partition(engine, part.path, part.Point, part.start, part.end, file_format, chunksize)
+            evt['rows'] = rows
+        return 'written', rows, time.perf_counter() - start
+
+    threads = max(min(int(threads), param.max_connections, len(parts1)), 1)
+    part_list = list(parts1.itertuples(index=False))
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(run, part_list))
+    else:
+        results = [run(p) for p in part_list]
+
+    parts1['status'] = [r[0] for r in results]
+    parts1['rows'] = pd.array([r[1] for r in results], dtype='Int64')
+    parts1['seconds'] = [r[2] for r in results]
+
+    return parts1
+
+
+def extract_tasks(site_point, from_date=None, to_date=None, points_per_task=100, time_window='YS', resample_code=None, period=1):
+    """
+    Function to split an extraction into (Point batch x time window) tasks. The Points of each mtype are sorted and split into batches of points_per_task, and the time period into windows of time_window (see util.time_windows).
+
+    Parameters
+    ----------
+    site_point : DataFrame
+        ExtSiteID, MType, Point, FromDate, ToDate of the Points (see get_sites_mtypes).
+    from_date : str, Timestamp, or None
+        The start date. None uses the first sample.
+    to_date : str, Timestamp, or None
+        The end date. None uses the last sample.
+    points_per_task : int
+        The maximum number of Points per task.
+    time_window : str or None
+        The pandas frequency of the time windows. e.g. 'YS' for yearly or 'MS' for monthly windows. None uses one window.
+    resample_code : str or None
+        The resampling code the windows must be aligned with.
+    period : int
+        The number of resampling periods.
+
+    Returns
+    -------
+    DataFrame
+        task, MType, Points (space separated), start, end, inclusive. The task is the name of the task and of its output file.
+    """
+    site_point1 = site_point.dropna(subset=['FromDate'])
+    if site_point1.empty:
+        return pd.DataFrame(columns=['task', 'MType', 'Points', 'start', 'end', 'inclusive'])
+
+    start = site_point1.FromDate.min() if from_date is None else from_date
+    end = site_point1.ToDate.max() if to_date is None else to_date
+    windows = time_windows(start, end, time_window, resample_code, period)
+
+    rows = []
+    for m in sorted(site_point1.MType.unique()):
+        points = sorted(set(site_point1.loc[site_point1.MType == m, 'Point'].astype(int)))
+        for i, batch in enumerate(chunks(points, points_per_task)):
+            for w_start, w_end, inclusive in windows:
+                task = '{mtype}_{i:05d}_{start}'.format(mtype=quote(str(m), safe=''), i=i, start=pd.Timestamp(w_start).strftime('%Y%m%dT%H%M%S'))
+                rows.append((task, m, ' '.join(str(p) for p in batch), pd.Timestamp(w_start), pd.Timestamp(w_end), inclusive))
+
+    return pd.DataFrame(rows, columns=['task', 'MType', 'Points', 'start', 'end', 'inclusive'])
+
+
+def read_manifest(dest):
+    """
+    Function to read the manifest of the finished tasks of an extraction.
+
+    Parameters
+    ----------
+    dest : str
+        The folder of the extraction.
+
+    Returns
+    -------
+    DataFrame
+        task, rows, seconds, finished
+    """
+    path = os.path.join(dest, manifest_file)
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=manifest_cols)
+    ## An interrupted run can leave an incomplete last line
+    return pd.read_csv(path, on_bad_lines='skip').dropna(subset=['finished'])
+
+
+def write_task(engine, path, site_point, mtype, points, start, end, inclusive='both', resample_code=None, period=1, val_round=3):
+    """
+    Function to read the (resampled) samples of one task with one statement and write them to a file. The file is written under a temporary name and renamed once it is complete.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+        The engine of the Hydrotel database.
+    path : str
+        The file path. The format is taken from the file extension.
+    site_point : DataFrame
+        ExtSiteID, MType, Point of the Points.
+    mtype : str
+        The mtype of the Points.
+    points : list of int
+        The Points.
+    start, end, inclusive
+        The time window (see util.time_windows).
+    resample_code, period, val_round
+        See get_ts_data. The resampling function of the mtype comes from parameters.resample_dict.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    fun = resample_dict.get(mtype, 'mean')
+    if len(points) > param.bulk_key_threshold:
+        with bulk_keys(engine, pd.DataFrame({'Point': pd.Series(points, dtype='int64')}), 'keys_point') as (conn, keys_table):
+            stmt = ts_agg_stmt(param.data_tab, points, resample_code, period, fun, val_round, start, end, dialect=dialect_name(conn), inclusive=inclusive, keys_table=keys_table)
+            data1 = pd.read_sql_query(stmt, conn)
+    else:
+        stmt = ts_agg_stmt(param.data_tab, points, resample_code, period, fun, val_round, start, end, dialect=dialect_name(engine), inclusive=inclusive)
+        data1 = pd.read_sql_query(stmt, engine)
+
+    data1['DT'] = pd.to_datetime(data1['DT']).astype('datetime64[ns]')
+    data1['SampleValue'] = data1['SampleValue'].astype('float64')
+    data1.rename(columns={'DT': 'DateTime', 'SampleValue': 'Value'}, inplace=True)
+    sel = site_point.loc[(site_point.MType == mtype) & site_point.Point.isin(points), ['ExtSiteID', 'MType', 'Point']].drop_duplicates('Point')
+    data2 = pd.merge(sel, data1, on='Point').drop('Point', axis=1).sort_values(['ExtSiteID', 'DateTime'])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    try:
+        if path.endswith('.parquet'):
+            data2.to_parquet(tmp_path, index=False)
+        else:
+            data2.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return len(data2)
+
+
+def run_tasks(engine, dest, site_point, tasks, resample_code=None, period=1, val_round=3, file_format='parquet', threads=4, retries=2, resume=True, arguments=None):
+    """
+    Function to run extraction tasks (see extract_tasks) on a worker pool. Each task writes one file to dest and is then recorded in the manifest (dest/manifest.csv). The tasks are saved to dest/tasks.csv and their arguments to dest/arguments.json on the first run, and a resumed run with the same arguments uses the saved tasks and skips the ones in the manifest, so an interrupted extraction continues where it stopped. Failed tasks are retried up to retries times and are otherwise left out of the manifest for the next run.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+        The engine of the Hydrotel database.
+    dest : str
+        The folder of the extraction.
+    site_point : DataFrame
+        ExtSiteID, MType, Point of the Points.
+    tasks : DataFrame
+        The output of extract_tasks. It is ignored if resume is True and dest already has saved tasks.
+    resample_code, period, val_round
+        See get_ts_data.
+    file_format : str
+        Either parquet or csv.
+    threads : int
+        The number of tasks run concurrently. It is capped at parameters.max_connections.
+    retries : int
+        The number of times a failed task is run again.
+    resume : bool
+        Should the saved tasks be used and the finished tasks be skipped? If False, then the tasks and the manifest are replaced. A ValueError is raised if the saved arguments differ from the arguments of this run.
+    arguments : dict or None
+        Other arguments that determined the tasks (e.g. the mtypes, sites, and dates). They are saved and compared together with resample_code, period, val_round, and file_format.
+
+    Returns
+    -------
+    DataFrame
+        The tasks with the path, status (written, skipped, or failed), rows, seconds, and error of each task.
+    """
+    if file_format not in file_ext:
+        raise ValueError('file_format must be one of ' + str(list(file_ext.keys())))
+
+    os.makedirs(dest, exist_ok=True)
+    tasks_path = os.path.join(dest, tasks_file)
+    manifest_path = os.path.join(dest, manifest_file)
+    arguments_path = os.path.join(dest, arguments_file)
+
+    ## A json round trip so that the arguments compare the same as the saved ones
+    arguments1 = dict(arguments or {}, resample_code=resample_code, period=period, val_round=val_round, file_format=file_format)
+    arguments1 = json.loads(json.dumps(arguments1, default=str, sort_keys=True))
+
+    if resume and os.path.isfile(tasks_path):
+        if os.path.isfile(arguments_path):
+            with open(arguments_path) as f:
+                saved = json.load(f)
+            if saved != arguments1:
+                diff = sorted(k for k in set(saved) | set(arguments1) if saved.get(k) != arguments1.get(k))
+                raise ValueError('{dest} has an extraction with different arguments ({diff}). Use resume=False to replace it or another dest.'.format(dest=dest, diff=', '.join(diff)))
+        tasks1 = pd.read_csv(tasks_path, parse_dates=['start', 'end'], dtype={'Points': str})
+        manifest = read_manifest(dest)
+        if os.path.isfile(manifest_path):
+            manifest.to_csv(manifest_path, index=False)
+        done = set(manifest.task)
+    else:
+        tasks1 = tasks.copy()
+        tasks1.to_csv(tasks_path, index=False)
+        with open(arguments_path, 'w') as f:
+            json.dump(arguments1, f, indent=1, sort_keys=True)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+        done = set()
+
+    tasks1['path'] = [os.path.join(dest, task_file.format(task=t, ext=file_ext[file_format])) for t in tasks1.task]
+    lock = threading.Lock()
+    parent = current_stage()
+
+    def run(task):
+        if task.task in done:
+            return 'skipped', None, 0.0, None
+        points = [int(p) for p in task.Points.split()]
+        for attempt in range(int(retries) + 1):
+            start = time.perf_counter()
+            try:
+                with stage('extract_task', parent=parent, task=task.task, points=len(points)) as evt:
+                    rows = write_task(engine, task.path, site_point, task.MType, points, task.start, task.end, task.inclusive, resample_code, period, val_round)
+                    evt['rows'] = rows
+                break
+            except Exception as err:
+                logger.warning('Task %s failed (attempt %s): %s', task.task, attempt + 1, err)
+                if attempt == int(retries):
+                    return 'failed', None, time.perf_counter() - start, repr(err)
+                time.sleep(2**attempt)
+        seconds = time.perf_counter() - start
+        with lock:
+            new_file = not os.path.isfile(manifest_path)
+            pd.DataFrame([[task.task, rows, round(seconds, 3), pd.Timestamp.now().isoformat()]], columns=manifest_cols).to_csv(manifest_path, mode='a', header=new_file, index=False)
+        logger.info('Task %s written: %s rows in %.1fs', task.task, rows, seconds)
+        return 'written', rows, seconds, None
+
+    threads = max(min(int(threads), param.max_connections, len(tasks1)), 1)
+    task_list = list(tasks1.itertuples(index=False))
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(run, task_list))
+    else:
+        results = [run(t) for t in task_list]
+
+    tasks1['status'] = [r[0] for r in results]
+    tasks1['rows'] = pd.array([r[1] for r in results], dtype='Int64')
+    tasks1['seconds'] = [r[2] for r in results]
+    tasks1['error'] = [r[3] for r in results]
+
+    return tasks1
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+The HydrotelFederation class for querying several Hydrotel servers/databases as one.
+"""
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from pyhydrotel.client import HydrotelClient, get_client
+from pyhydrotel.instrument import stage, current_stage, timed
+
+######################################
+### Class
+
+
+class HydrotelFederation(object):
+    """
+    Class to query several Hydrotel databases (e.g. regional instances) as one. The sites are resolved with the combined catalog of all databases, the queries are sent to the databases that have matching sites concurrently, and the results are merged into the usual output with an extra Source level.
+
+    Parameters
+    ----------
+    targets : list or dict
+        The databases. Either a list of (server, database) tuples or HydrotelClients, or a dict of source name to (server, database) tuple or HydrotelClient. The source names of a list are 'server/database'.
+    threads : int or None
+        The number of databases queried concurrently. None queries all at once.
+    """
+    def __init__(self, targets, threads=None):
+        if not isinstance(targets, dict):
+            targets = {self._source_name(t): t for t in targets}
+        if not targets:
+            raise ValueError('targets must contain at least one (server, database).')
+
+        self.clients = {}
+        for name, t in targets.items():
+            if isinstance(t, HydrotelClient):
+                self.clients[name] = t
+            else:
+                self.clients[name] = get_client(*t)
+        self.threads = threads
+
+    def __repr__(self):
+        return 'HydrotelFederation(sources={})'.format(list(self.clients.keys()))
+
+    @staticmethod
+    def _source_name(target):
+        if isinstance(target, HydrotelClient):
+            return target.server + '/' + target.database
+        return '/'.join(target)
+
+    def _map(self, fun, sources):
+        """
+        Method to run a function with the client of each source concurrently. Returns a dict of source to output.
+        """
+        parent = current_stage()
+
+        def run(name):
+            with stage('federation_source', parent=parent, source=name):
+                return fun(self.clients[name])
+
+        threads = len(sources) if self.threads is None else max(min(int(self.threads), len(sources)), 1)
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as executor:
+                results = list(executor.map(run, sources))
+        else:
+            results = [run(s) for s in sources]
+
+        return dict(zip(sources, results))
+
+    def close(self):
+        """
+        Method to close all pooled connections of the clients.
+        """
+        for client in self.clients.values():
+            client.close()
+
+    @timed('federation_sites_mtypes')
+    def get_sites_mtypes(self, mtypes=None, sites=None):
+        """
+        Method to determine the available sites and associated measurement types in all databases (see HydrotelClient.get_sites_mtypes).
+
+        Parameters
+        ----------
+        mtypes : str, list of str, or None
+            The measurement type(s) of the sites that should be returned.
+        sites : str, list of str, or None
+            The list of sites that should be returned. None returns all sites.
+
+        Returns
+        -------
+        DataFrame
+            With Source, ExtSiteID, and MType as the index.
+        """
+        results = self._map(lambda c: c.get_sites_mtypes(mtypes, sites), list(self.clients.keys()))
+        results = {s: r for s, r in results.items() if not r.empty}
+        if not results:
+            return pd.DataFrame()
+
+        return pd.concat(results, names=['Source'])
+
+    @timed('federation_ts_data')
+    def get_ts_data(self, mtypes, sites, from_date=None, to_date=None, pivot=False, **kwargs):
+        """
+        Method to extract time series data from all databases that have the sites and mtypes. The databases are queried concurrently with HydrotelClient.get_ts_data.
+
+        Parameters
+        ----------
+        mtypes : str or list of str
+            The measurement type(s) of the sites that should be returned.
+        sites : list of str or None
+            The list of sites that should be returned. None returns all sites.
+        from_date : str or None
+            The start date in the format '2000-01-01'.
+        to_date : str or None
+            The end date in the format '2000-01-01'.
+        pivot : bool
+            Should the output be pivotted into wide format?
+        **kwargs
+            The other arguments of HydrotelClient.get_ts_data (e.g. resample_code, server_agg, threads). threads applies to each database.
+
+        Returns
+        -------
+        Series or DataFrame
+            A MultiIndex Pandas Series with Source, ExtSiteID, MType, and DateTime if pivot is False and a DataFrame with Source, ExtSiteID, and MType columns if True.
+        """
+        ## Only query the sources that have the sites and mtypes
+        site_summ = self.get_sites_mtypes(mtypes, sites)
+        if site_summ.empty:
+            return pd.DataFrame()
+        sources = [s for s in self.clients if s in site_summ.index.get_level_values('Source')]
+
+        results = self._map(lambda c: c.get_ts_data(mtypes, sites, from_date, to_date, pivot=pivot, **kwargs), sources)
+        results = {s: r for s, r in results.items() if not r.empty}
+        if not results:
+            return pd.DataFrame()
+
+        with stage('federation_combine', pivot=pivot):
+            if pivot:
+                tsdata = pd.concat(results, axis=1, names=['Source']).sort_index()
+            else:
+                tsdata = pd.concat(results, names=['Source'])
+
+        return tsdata
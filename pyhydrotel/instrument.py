@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for instrumenting pyhydrotel. Every stage of a call (e.g. loading the catalog, querying the extents, reading the samples of an mtype, merging) and every SQL round trip creates an event dict that is passed to the registered hooks and logged to the pyhydrotel logger at the DEBUG level.
+"""
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+
+######################################
+### Parameters
+
+logger = logging.getLogger('pyhydrotel')
+
+_hooks = []
+_local = threading.local()
+
+max_sql_len = 2000
+
+
+######################################
+### Functions
+
+
+def add_hook(fun):
+    """
+    Function to register a hook that is called with each event dict. The events have the keys:
+        kind : 'stage' or 'query'
+        stage : the name of the stage (for queries the stage that ran the query)
+        parent : the name of the enclosing stage or None
+        duration : seconds
+        rows : the number of rows returned or affected (None if unknown)
+        bytes : the in-memory size of the returned data (None if unknown)
+        sql : the SQL text (queries only)
+        error : the exception type name if the stage or query failed, else None
+    plus any other information given by the stage (e.g. server, database, mtype, points).
+
+    Parameters
+    ----------
+    fun : callable
+        A function that takes the event dict. Exceptions raised by it are logged and ignored.
+
+    Returns
+    -------
+    callable
+        The same function, so that add_hook can be used as a decorator.
+    """
+    if fun not in _hooks:
+        _hooks.append(fun)
+    return fun
+
+
+def remove_hook(fun=None):
+    """
+    Function to remove a registered hook.
+
+    Parameters
+    ----------
+    fun : callable or None
+        The hook. None removes all hooks.
+
+    Returns
+    -------
+    None
+    """
+    if fun is None:
+        del _hooks[:]
+    elif fun in _hooks:
+        _hooks.remove(fun)
+
+
+def enabled():
+    """
+    Function to check whether any hook is registered or the pyhydrotel logger logs DEBUG messages.
+    """
+    return bool(_hooks) or logger.isEnabledFor(logging.DEBUG)
+
+
+def emit(evt):
+    """
+    Function to pass an event dict to the hooks and the logger.
+    """
+    for fun in list(_hooks):
+        try:
+            fun(evt)
+        except Exception:
+            logger.exception('pyhydrotel instrumentation hook failed')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%(kind)s %(stage)s %(duration).3fs rows=%(rows)s', evt, extra={'pyhydrotel': evt})
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_stage():
+    """
+    Function to return the name of the innermost stage of the current thread or None.
+    """
+    stack = _stack()
+    return stack[-1]['stage'] if stack else None
+
+
+def data_size(data):
+    """
+    Function to return the number of rows and the in-memory size in bytes of a DataFrame or Series.
+    """
+    if data is None:
+        return None, None
+    mem = data.memory_usage(index=True, deep=True)
+    return len(data), int(mem.sum() if hasattr(mem, 'sum') else mem)
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Context manager that times a stage and emits a stage event on exit. The yielded dict can be updated within the stage (e.g. with rows and bytes, see record).
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+    **info
+        Other information added to the event.
+
+    Yields
+    ------
+    dict
+        The event dict.
+    """
+    stack = _stack()
+    evt = {'kind': 'stage', 'stage': name, 'parent': stack[-1]['stage'] if stack else None, 'duration': None, 'rows': None, 'bytes': None, 'error': None}
+    evt.update(info)
+
+    if not enabled():
+        yield evt
+        return
+
+    stack.append(evt)
+    start = time.perf_counter()
+    try:
+        yield evt
+    except BaseException as err:
+        evt['error'] = type(err).__name__
+        raise
+    finally:
+        evt['duration'] = time.perf_counter() - start
+        stack.pop()
+        emit(evt)
+
+
+def record(evt, data):
+    """
+    Function to add the rows and bytes of a DataFrame or Series to a stage event.
+    """
+    if enabled():
+        evt['rows'], evt['bytes'] = data_size(data)
+    return data
+
+
+def timed(name):
+    """
+    Decorator that runs a function or method as a stage (see stage). If it returns a DataFrame or Series (or a tuple starting with one), then its rows and bytes are added to the event.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+
+    Returns
+    -------
+    callable
+    """
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            with stage(name) as evt:
+                result = fun(*args, **kwargs)
+                data = result[0] if isinstance(result, tuple) and result else result
+                if hasattr(data, 'memory_usage'):
+                    record(evt, data)
+            return result
+        return wrapper
+    return decorator
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('pyhydrotel_query_start', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('pyhydrotel_query_start')
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    if not enabled():
+        return
+    stack = _stack()
+    rows = cursor.rowcount if (cursor.rowcount is not None) and (cursor.rowcount >= 0) else None
+    evt = {'kind': 'query', 'stage': stack[-1]['stage'] if stack else None, 'parent': stack[-1]['parent'] if stack else None, 'duration': duration, 'rows': rows, 'bytes': None, 'sql': statement[:max_sql_len], 'executemany': executemany, 'error': None}
+    emit(evt)
+
+
+def _handle_error(context):
+    starts = context.connection.info.get('pyhydrotel_query_start') if context.connection is not None else None
+    if starts:
+        duration = time.perf_counter() - starts.pop()
+        if enabled():
+            stack = _stack()
+            evt = {'kind': 'query', 'stage': stack[-1]['stage'] if stack else None, 'parent': stack[-1]['parent'] if stack else None, 'duration': duration, 'rows': None, 'bytes': None, 'sql': (context.statement or '')[:max_sql_len], 'executemany': None, 'error': type(context.original_exception).__name__}
+            emit(evt)
+
+
+def instrument_engine(engine):
+    """
+    Function to add the listeners that emit a query event for every SQL round trip of an SQLAlchemy engine. The query events carry the name of the stage that ran them. Engines are only instrumented once.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+
+    Returns
+    -------
+    SQLAlchemy engine
+    """
+    if not event.contains(engine, 'before_cursor_execute', _before_execute):
+        event.listen(engine, 'before_cursor_execute', _before_execute)
+        event.listen(engine, 'after_cursor_execute', _after_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+    return engine
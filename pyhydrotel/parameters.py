@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Parameters shared by the pyhydrotel modules.
+"""
+import os
+
+######################################
+### Parameters
+## mtypes dict
+#mtypes = ['flow', 'water level', 'rainfall', 'non-hydro release lc', 'Rakaia FH modified']
+#mtypes_list = ['Barometric Pressure', 'Conductivity', 'Flow Rate', 'Groundwater level', 'Rainfall Depth', 'Solar Radiation', 'Temperature', 'Turbidity', 'Water Level', 'Water Temperature', 'Wind Speed', 'Air Temperature']
+resample_dict = {'rainfall': 'sum'}
+
+## Database parameters
+data_tab = 'Samples'
+points_tab = 'Points'
+objects_tab = 'Objects'
+mtypes_tab = 'ObjectVariants'
+sites_tab = 'Sites'
+
+data_col = ['Point', 'DT', 'SampleValue']
+points_col = ['Point', 'Object']
+objects_col = ['Object', 'Site', 'ObjectVariant', 'Name', 'ExtSysID']
+mtypes_col = ['ObjectVariant', 'Name']
+sites_col = ['Site', 'Name', 'ExtSysId']
+
+## The precision of the Samples DT column by dialect: datetime on SQL Server keeps milliseconds (in 1/300 s steps), the SQLite stand-in stores seconds as text
+dt_precision = {'mssql': 'ms', 'sqlite': 's'}
+
+## Connection parameters
+max_connections = 8
+bulk_key_threshold = 1000
+
+## Local cache parameters
+cache_dir = os.environ.get('PYHYDROTEL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.pyhydrotel'))
+catalog_ttl = 3600
+extents_ttl = 60
+
+## Tile cache parameters
+tile_cache = False
+tile_ttl = 600
+tile_lag = 172800
+tile_max_bytes = 2 * 1024**3
+
+## Rollup parameters
+rollups = False
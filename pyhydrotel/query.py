@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+The lazy HydrotelQuery builder.
+"""
+import copy
+import pandas as pd
+from pyhydrotel import parameters as param
+from pyhydrotel.parameters import resample_dict, data_tab
+from pyhydrotel.util import ts_agg_stmt, bulk_keys, wide_ts, fun_dict
+from pyhydrotel.instrument import stage, record
+
+######################################
+### Class
+
+
+class HydrotelQuery(object):
+    """
+    Class for a lazy time series query of a Hydrotel database. The methods sites, mtypes, between, resample, and agg each return a new query with the added condition, and nothing is read from the database until collect is called. The sites and mtypes are then matched to their Points through the catalog (no round trip if the catalog is cached) and all Points are read and resampled with one Samples statement, in which each mtype gets its own aggregation function. Create it with HydrotelClient.query.
+
+    Parameters
+    ----------
+    client : HydrotelClient
+        The client of the database.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._sites = None
+        self._mtypes = None
+        self._from_date = None
+        self._to_date = None
+        self._resample_code = None
+        self._period = 1
+        self._fun = None
+        self._val_round = 3
+
+    def __repr__(self):
+        return 'HydrotelQuery(sites={sites}, mtypes={mtypes}, from_date={from_date}, to_date={to_date}, resample_code={code}, period={period}, fun={fun})'.format(sites=self._sites, mtypes=self._mtypes, from_date=self._from_date, to_date=self._to_date, code=self._resample_code, period=self._period, fun=self._fun)
+
+    def _copy(self):
+        return copy.copy(self)
+
+    def sites(self, *sites):
+        """
+        Method to select sites. Repeated calls add to the selected sites.
+
+        Parameters
+        ----------
+        *sites : str or list of str
+            The sites (ExtSiteIDs).
+
+        Returns
+        -------
+        HydrotelQuery
+        """
+        q = self._copy()
+        new_sites = [s for s1 in sites for s in ([s1] if isinstance(s1, str) else s1)]
+        q._sites = list(dict.fromkeys((self._sites or []) + new_sites))
+        return q
+
+    def mtypes(self, *mtypes):
+        """
+        Method to select measurement types. Repeated calls add to the selected mtypes.
+
+        Parameters
+        ----------
+        *mtypes : str or list of str
+            The measurement types.
+
+        Returns
+        -------
+        HydrotelQuery
+        """
+        q = self._copy()
+        new_mtypes = [m.lower() for m1 in mtypes for m in ([m1] if isinstance(m1, str) else m1)]
+        q._mtypes = list(dict.fromkeys((self._mtypes or []) + new_mtypes))
+        return q
+
+    def between(self, from_date=None, to_date=None):
+        """
+        Method to set the time period. Both dates are inclusive.
+
+        Parameters
+        ----------
+        from_date : str, Timestamp, or None
+            The start date.
+        to_date : str, Timestamp, or None
+            The end date.
+
+        Returns
+        -------
+        HydrotelQuery
+        """
+        q = self._copy()
+        q._from_date = from_date
+        q._to_date = to_date
+        return q
+
+    def resample(self, resample_code, period=1):
+        """
+        Method to resample the values.
+
+        Parameters
+        ----------
+        resample_code : str or None
+            The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc. None returns the raw samples.
+        period : int
+            The number of resampling periods.
+
+        Returns
+        -------
+        HydrotelQuery
+        """
+        q = self._copy()
+        q._resample_code = resample_code
+        q._period = period
+        return q
+
+    def agg(self, fun=None, val_round=3):
+        """
+        Method to set the resampling function.
+
+        Parameters
+        ----------
+        fun : str or None
+            One of mean, sum, count, min, or max. None uses the default of each mtype (see parameters.resample_dict).
+        val_round : int
+            The number of decimals to round the values.
+
+        Returns
+        -------
+        HydrotelQuery
+        """
+        if (fun is not None) and (fun not in fun_dict):
+            raise ValueError('fun must be one of ' + str(list(fun_dict.keys())))
+        q = self._copy()
+        q._fun = fun
+        q._val_round = val_round
+        return q
+
+    def _points(self):
+        """
+        Method to return the ExtSiteID, MType, and Point of the selected sites and mtypes.
+        """
+        site_point = self.client._site_points(self._mtypes, self._sites)
+        site_point = site_point.rename(columns={'ExtSysID': 'ExtSiteID'})[['ExtSiteID', 'MType', 'Point']]
+        site_point['Point'] = site_point.Point.astype('int64')
+
+        return site_point
+
+    def _funs(self, site_point):
+        """
+        Method to return the resampling function of each Point.
+        """
+        if self._fun is not None:
+            return self._fun
+        funs = site_point.set_index('Point').MType.map(lambda m: resample_dict.get(m, 'mean'))
+        if funs.nunique() == 1:
+            return funs.iloc[0]
+        return funs.to_dict()
+
+    def sql(self):
+        """
+        Method to return the Samples statement that collect would run.
+
+        Returns
+        -------
+        str
+        """
+        site_point = self._points()
+        return ts_agg_stmt(data_tab, site_point.Point.tolist(), self._resample_code, self._period, self._funs(site_point), self._val_round, self._from_date, self._to_date, dialect=self.client.dialect)
+
+    def collect(self, pivot=False):
+        """
+        Method to run the query.
+
+        Parameters
+        ----------
+        pivot : bool
+            Should the output be pivotted into wide format?
+
+        Returns
+        -------
+        Series or DataFrame
+            The same output as HydrotelClient.get_ts_data.
+        """
+        with stage('query') as evt:
+            site_point = self._points()
+            if site_point.empty:
+                return pd.DataFrame()
+            points = site_point.Point.drop_duplicates().tolist()
+            funs = self._funs(site_point)
+
+            if len(points) > param.bulk_key_threshold:
+                with bulk_keys(self.client.engine, pd.DataFrame({'Point': pd.Series(points, dtype='int64')}), 'keys_point') as (conn, keys_table):
+                    stmt = ts_agg_stmt(data_tab, points, self._resample_code, self._period, funs, self._val_round, self._from_date, self._to_date, dialect=self.client.dialect, keys_table=keys_table)
+                    data1 = pd.read_sql_query(stmt, conn)
+            else:
+                stmt = ts_agg_stmt(data_tab, points, self._resample_code, self._period, funs, self._val_round, self._from_date, self._to_date, dialect=self.client.dialect)
+                data1 = pd.read_sql_query(stmt, self.client.engine)
+
+            if data1.empty:
+                return pd.DataFrame()
+            data1['DT'] = pd.to_datetime(data1['DT'])
+
+            if pivot:
+                tsdata = wide_ts([data1], site_point)
+            else:
+                data1.rename(columns={'DT': 'DateTime', 'SampleValue': 'Value'}, inplace=True)
+                tsdata = pd.merge(site_point, data1, on='Point').drop('Point', axis=1).set_index(['ExtSiteID', 'MType', 'DateTime']).Value.sort_index()
+            record(evt, tsdata)
+
+        return tsdata
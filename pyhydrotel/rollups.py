@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+A local store of pre-aggregated (rolled up) samples at hourly, daily, and monthly resolution.
+"""
+import os
+import time
+import threading
+import pandas as pd
+from pyhydrotel import parameters as param
+from pyhydrotel.catalog import _store_path, _save_pickle
+from pyhydrotel.util import ts_where_stmts, ts_stats_stmt, combine_stats, bucket_labels, dialect_name, chunks
+
+######################################
+### Parameters
+
+rollups_folder = 'rollups'
+manifest_file = 'manifest.pkl'
+rollup_file = '{point}.parquet'
+
+## Tier name: resample code, offset to the next period
+tiers = {'hourly': ('H', pd.DateOffset(hours=1)), 'daily': ('D', pd.DateOffset(days=1)), 'monthly': ('M', pd.offsets.MonthBegin())}
+
+## The coarsest tier whose periods nest within the periods of each resample code
+tier_codes = {'H': 'hourly', 'D': 'daily', 'W': 'daily', 'M': 'monthly', 'Q': 'monthly', 'A': 'monthly'}
+
+stats_cols = ['sum', 'count', 'min', 'max']
+manifest_cols = ['Watermark', 'Rows', 'UpdatedAt']
+points_per_update = 500
+
+
+######################################
+### Class
+
+
+class RollupStore(object):
+    """
+    Class for the local store of rolled up samples of a Hydrotel database. For each tier (hourly, daily, and monthly) and Point, the sum, count, min, and max of the samples of each period are stored in a Parquet file (the mean is sum / count). The store is updated incrementally: the last period of each Point is kept open and only the samples from its start onwards are aggregated again on the next update. Samples added or changed before the last period are not seen by the updates, so the Points must then be invalidated (write_ts_data does this).
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    cache_dir : str or None
+        The base folder of the store. None uses parameters.cache_dir.
+    """
+    def __init__(self, server, database, cache_dir=None):
+        store = _store_path(server, database, cache_dir)
+        if store is None:
+            raise ValueError('The rollup store needs a cache_dir.')
+        self.path = os.path.join(store, rollups_folder)
+        self._lock = threading.RLock()
+
+        manifest_path = os.path.join(self.path, manifest_file)
+        if os.path.isfile(manifest_path):
+            self.manifest = pd.read_pickle(manifest_path)
+        else:
+            self.manifest = pd.DataFrame(columns=manifest_cols, index=pd.MultiIndex.from_tuples([], names=['Point', 'Tier']))
+
+    def _file_path(self, point, tier):
+        return os.path.join(self.path, tier, rollup_file.format(point=int(point)))
+
+    def _save_manifest(self):
+        _save_pickle(self.manifest, os.path.join(self.path, manifest_file))
+
+    def _read(self, point, tier):
+        path = self._file_path(point, tier)
+        if os.path.isfile(path):
+            return pd.read_parquet(path)
+        return pd.DataFrame({'DT': pd.Series(dtype='datetime64[ns]'), 'sum': pd.Series(dtype='float64'), 'count': pd.Series(dtype='int64'), 'min': pd.Series(dtype='float64'), 'max': pd.Series(dtype='float64')})
+
+    def update(self, con, points, tier, table=None):
+        """
+        Method to update the rollups of Points in a tier from the samples of their open (last) periods onwards. Points without rollups are aggregated in full.
+
+        Parameters
+        ----------
+        con : SQLAlchemy engine or connection
+            The connection to the Hydrotel database.
+        points : list of int
+            The Points.
+        tier : str
+            One of hourly, daily, or monthly.
+        table : str or None
+            The samples table. None uses parameters.data_tab.
+
+        Returns
+        -------
+        None
+        """
+        if tier not in tiers:
+            raise ValueError('tier must be one of ' + str(list(tiers.keys())))
+        if table is None:
+            table = param.data_tab
+        code = tiers[tier][0]
+        dialect = dialect_name(con)
+        points = [int(p) for p in points]
+
+        with self._lock:
+            keys = pd.MultiIndex.from_arrays([points, [tier] * len(points)], names=['Point', 'Tier'])
+            watermarks = self.manifest.Watermark.reindex(keys).droplevel('Tier')
+
+        for batch in chunks(points, points_per_update):
+            updated_at = time.time()
+            where_list = []
+            for p in batch:
+                wm = watermarks.loc[p]
+                where_list.append('(' + ' and '.join(ts_where_stmts([p], None if pd.isnull(wm) else wm)) + ')')
+            stmt = ts_stats_stmt(table, batch, code, dialect=dialect, where_list=where_list)
+            new1 = pd.read_sql_query(stmt, con)
+            new1['DT'] = pd.to_datetime(new1['DT']).astype('datetime64[ns]')
+            grp = dict(list(new1.groupby('Point')))
+
+            rows = []
+            for p in batch:
+                new2 = grp.get(p)
+                if new2 is None:
+                    continue
+                wm = watermarks.loc[p]
+                old1 = self._read(p, tier)
+                if not pd.isnull(wm):
+                    old1 = old1[old1.DT < wm]
+                new3 = new2[['DT'] + stats_cols].astype({'sum': 'float64', 'count': 'int64', 'min': 'float64', 'max': 'float64'})
+                data1 = pd.concat([old1, new3]).sort_values('DT').reset_index(drop=True)
+
+                path = self._file_path(p, tier)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data1.to_parquet(path + '.tmp', index=False)
+                os.replace(path + '.tmp', path)
+                rows.append(((p, tier), [data1.DT.iloc[-1], len(data1), updated_at]))
+
+            if rows:
+                with self._lock:
+                    new_man = pd.DataFrame([r[1] for r in rows], index=pd.MultiIndex.from_tuples([r[0] for r in rows], names=['Point', 'Tier']), columns=manifest_cols)
+                    self.manifest = pd.concat([self.manifest.drop(new_man.index, errors='ignore'), new_man])
+
+        with self._lock:
+            self._save_manifest()
+
+    def read(self, points, tier, from_date=None, to_date=None):
+        """
+        Method to read the rollups of Points in a tier.
+
+        Parameters
+        ----------
+        points : list of int
+            The Points.
+        tier : str
+            One of hourly, daily, or monthly.
+        from_date : Timestamp or None
+            The first period (inclusive).
+        to_date : Timestamp or None
+            The end of the periods (exclusive).
+
+        Returns
+        -------
+        DataFrame
+            Point, DT, sum, count, min, max
+        """
+        data_list = []
+        for p in points:
+            data1 = self._read(p, tier)
+            if from_date is not None:
+                data1 = data1[data1.DT >= from_date]
+            if to_date is not None:
+                data1 = data1[data1.DT < to_date]
+            data1.insert(0, 'Point', int(p))
+            data_list.append(data1)
+
+        if not data_list:
+            return self._read(-1, tier).assign(Point=pd.Series(dtype='int64'))
+
+        return pd.concat(data_list, ignore_index=True)
+
+    def get_ts(self, con, points, resample_code, period=1, fun='mean', val_round=3, from_date=None, to_date=None, min_count=None, table=None):
+        """
+        Method to resample the samples of Points from the best matching tier. The tier is updated first. Periods that are only partly within from_date and to_date are aggregated from the samples on the server, so the output is the same as resampling the samples.
+
+        Parameters
+        ----------
+        con : SQLAlchemy engine or connection
+            The connection to the Hydrotel database.
+        points : list of int
+            The Points.
+        resample_code, period, fun, val_round, from_date, to_date, min_count
+            See util.ts_agg_stmt.
+        table : str or None
+            The samples table. None uses parameters.data_tab.
+
+        Returns
+        -------
+        DataFrame or None
+            Point, DT, SampleValue sorted by Point and DT, or None if no tier matches the resample_code.
+        """
+        tier = tier_codes.get(resample_code)
+        if tier is None:
+            return None
+        if table is None:
+            table = param.data_tab
+        code, offset = tiers[tier]
+        dialect = dialect_name(con)
+
+        self.update(con, points, tier, table)
+
+        ## Split the time period into the periods within the tier and the partial periods at the edges
+        edges = []
+        start = None if from_date is None else pd.Timestamp(from_date)
+        end = None if to_date is None else pd.Timestamp(to_date)
+        i_start = start
+        i_end = None
+        if start is not None:
+            start_bucket = bucket_labels([start], code)[0]
+            if start_bucket != start:
+                i_start = start_bucket + offset
+        if end is not None:
+            i_end = bucket_labels([end], code)[0]
+
+        if (i_start is not None) and (i_end is not None) and (i_start >= i_end):
+            edges.append((start, end, 'both'))
+            stats_list = []
+        else:
+            if (start is not None) and (i_start != start):
+                edges.append((start, i_start, 'left'))
+            if end is not None:
+                edges.append((i_end, end, 'both'))
+            stats_list = [self.read(points, tier, i_start, i_end)]
+
+        for e_start, e_end, inclusive in edges:
+            stmt = ts_stats_stmt(table, points, code, from_date=e_start, to_date=e_end, dialect=dialect, inclusive=inclusive)
+            edge1 = pd.read_sql_query(stmt, con)
+            edge1['DT'] = pd.to_datetime(edge1['DT'])
+            stats_list.append(edge1[['Point', 'DT'] + stats_cols])
+
+        stats_list = [s for s in stats_list if not s.empty]
+        if not stats_list:
+            return pd.DataFrame(columns=['Point', 'DT', 'SampleValue'])
+        stats = pd.concat(stats_list, ignore_index=True)
+
+        return combine_stats(stats, resample_code, period, fun, val_round, min_count)
+
+    def invalidate(self, points):
+        """
+        Method to remove the rollups of Points in all tiers, so that they are aggregated in full on the next update.
+
+        Parameters
+        ----------
+        points : list of int
+            The Points.
+        """
+        points = [int(p) for p in points]
+        with self._lock:
+            remove = self.manifest.index[self.manifest.index.get_level_values('Point').isin(points)]
+            for p, tier in remove:
+                path = self._file_path(p, tier)
+                if os.path.isfile(path):
+                    os.remove(path)
+            if len(remove):
+                self.manifest = self.manifest.drop(remove)
+                self._save_manifest()
+
+    def clear(self):
+        """
+        Method to remove all rollups from the store.
+        """
+        self.invalidate(self.manifest.index.get_level_values('Point').unique().tolist())
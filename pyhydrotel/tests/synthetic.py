@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to create a synthetic Hydrotel database (e.g. in SQLite) for local tests and benchmarks.
+"""
+import os
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import text
+
+###############################
+### Parameters
+
+schema = ["create table Sites (Site integer primary key, Name varchar(100), ExtSysId varchar(50))",
+          "create table ObjectVariants (ObjectVariant integer primary key, Name varchar(100))",
+          "create table Objects (Object integer primary key, Site integer, ObjectVariant integer, Name varchar(100), ExtSysID varchar(50), TreeIndex integer)",
+          "create table Points (Point integer primary key, Object integer, Name varchar(100))",
+          "create table Samples (Point integer, DT datetime, SampleValue float, primary key (Point, DT))"]
+
+mtypes = ['Flow', 'Water Level', 'Rainfall', 'Water Temperature', 'Conductivity', 'Groundwater Level']
+
+## Data sizes for the benchmarks: n_sites, n_mtypes, from_date, to_date, freq
+scales = {'small': dict(n_sites=10, n_mtypes=3, from_date='2018-01-01', to_date='2018-03-01', freq='15min'),
+          'medium': dict(n_sites=100, n_mtypes=4, from_date='2018-01-01', to_date='2018-07-01', freq='15min'),
+          'large': dict(n_sites=500, n_mtypes=6, from_date='2017-01-01', to_date='2019-01-01', freq='15min')}
+
+###############################
+### Functions
+
+
+def site_names(n_sites):
+    """
+    Function to create the ExtSiteIDs of the synthetic sites. Every fourth site is a groundwater site with a well number (e.g. L37/0004) and the others have numeric ids.
+    """
+    names = ['L37/{:04d}'.format(i) if i % 4 == 0 else str(60000 + i) for i in range(n_sites)]
+    return names
+
+
+def create_hydrotel_db(engine, n_sites=10, from_date='2018-01-01', to_date='2018-03-01', freq='15min', seed=0, n_mtypes=3):
+    """
+    Function to create and fill the Sites, ObjectVariants, Objects, Points, and Samples tables of a synthetic Hydrotel database. Every site gets an object and point for each of the first n_mtypes mtypes.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+        An engine to an empty database.
+    n_sites : int
+        The number of sites.
+    from_date : str
+        The first sample date.
+    to_date : str
+        The last sample date.
+    freq : str
+        The pandas frequency of the samples.
+    seed : int
+        The random seed.
+    n_mtypes : int
+        The number of mtypes (at most len(mtypes)).
+
+    Returns
+    -------
+    DataFrame
+        ExtSiteID, MType, Site, Object, Point of the created points.
+    """
+    rng = np.random.default_rng(seed)
+    names = site_names(n_sites)
+
+    ## Metadata
+    sites = pd.DataFrame({'Site': np.arange(1, n_sites + 1), 'Name': [n + ' at somewhere' if '/' in n else 'River at ' + n for n in names], 'ExtSysId': [' ' + n + ' ' for n in names]})
+    mtypes1 = mtypes[:n_mtypes]
+    variants = pd.DataFrame({'ObjectVariant': np.arange(1, len(mtypes1) + 1), 'Name': mtypes1})
+    objects = pd.DataFrame([(s, v, m, '', i) for s in sites.Site for i, (v, m) in enumerate(zip(variants.ObjectVariant, mtypes1))], columns=['Site', 'ObjectVariant', 'Name', 'ExtSysID', 'TreeIndex'])
+    objects.insert(0, 'Object', np.arange(1, len(objects) + 1))
+    points = pd.DataFrame({'Point': objects.Object.values, 'Object': objects.Object.values, 'Name': objects.Name.values})
+
+    ## Samples
+    dt = pd.date_range(from_date, to_date, freq=freq)
+    dt_str = dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    with engine.begin() as conn:
+        for stmt in schema:
+            conn.execute(text(stmt))
+        sites.to_sql('Sites', conn, if_exists='append', index=False)
+        variants.to_sql('ObjectVariants', conn, if_exists='append', index=False)
+        objects.to_sql('Objects', conn, if_exists='append', index=False)
+        points.to_sql('Points', conn, if_exists='append', index=False)
+
+        for p in points.Point:
+            keep = rng.random(len(dt)) > 0.1
+            values = np.round(rng.gamma(2, 5, keep.sum()), 3)
+            conn.exec_driver_sql('insert into Samples (Point, DT, SampleValue) values (?, ?, ?)', list(zip([int(p)] * len(values), dt_str[keep], values.tolist())))
+
+    site_point = pd.merge(objects[['Object', 'Site', 'Name']], points[['Point', 'Object']], on='Object')
+    site_point['ExtSiteID'] = [names[s - 1] for s in site_point.Site]
+    site_point['MType'] = site_point.Name.str.lower()
+
+    return site_point[['ExtSiteID', 'MType', 'Site', 'Object', 'Point']]
+
+
+def create_scale_db(path, scale='small', seed=0):
+    """
+    Function to return an engine to a synthetic SQLite Hydrotel database of one of the benchmark scales. The database file is only created if it does not exist yet, so the larger scales are only generated once per folder.
+
+    Parameters
+    ----------
+    path : str
+        The folder of the database files.
+    scale : str or dict
+        One of the keys of scales or a dict of the create_hydrotel_db parameters.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    SQLAlchemy engine
+    """
+    if isinstance(scale, str):
+        name = scale
+        scale = scales[scale]
+    else:
+        name = '_'.join(str(v) for v in scale.values()).replace(':', '').replace(' ', '')
+
+    db_path = os.path.join(path, 'hydrotel_{name}_{seed}.db'.format(name=name, seed=seed))
+    exists = os.path.isfile(db_path)
+    if not exists:
+        os.makedirs(path, exist_ok=True)
+        tmp_path = db_path + '.tmp'
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        tmp_engine = sqlalchemy.create_engine('sqlite:///' + tmp_path)
+        create_hydrotel_db(tmp_engine, seed=seed, **scale)
+        tmp_engine.dispose()
+        os.replace(tmp_path, db_path)
+
+    return sqlalchemy.create_engine('sqlite:///' + db_path)
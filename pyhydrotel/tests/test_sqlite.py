@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+"""
+Tests against a local SQLite stand-in of the Hydrotel database.
+"""
+import os
+import pytest
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from pyhydrotel import parameters as param
+from pyhydrotel import HydrotelClient, HydrotelFederation
+from pyhydrotel.aio import AsyncHydrotelClient
+from pyhydrotel.instrument import add_hook, remove_hook
+from pyhydrotel.tiles import TileCache
+from pyhydrotel.util import rd_ts_agg, bucket_labels, period_range, resample_local
+from pyhydrotel.export import read_manifest, partition_file
+from pyhydrotel.catalog import cached_catalog
+from pyhydrotel.cli import main
+from pyhydrotel.tests.synthetic import create_hydrotel_db
+
+###############################
+### Parameters
+
+data_tab = 'Samples'
+points = [1, 2, 3]
+from_date = '2018-01-03'
+to_date = '2018-02-20'
+
+mtypes = ['flow', 'rainfall']
+sites = ['L37/0000', '60001', '60002']
+
+###############################
+### Fixtures
+
+
+@pytest.fixture(scope='module')
+def samples():
+    """
+    Irregular 5-minute samples for three Points.
+    """
+    rng = np.random.default_rng(10)
+    data_list = []
+    for p in points:
+        dt = pd.date_range('2018-01-01', '2018-03-01', freq='5min')
+        dt = dt[rng.random(len(dt)) > 0.2 * p]
+        data_list.append(pd.DataFrame({'Point': p, 'DT': dt, 'SampleValue': rng.normal(10, 3, len(dt))}))
+    return pd.concat(data_list, ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def engine(samples):
+    engine = sqlalchemy.create_engine('sqlite://')
+    samples1 = samples.copy()
+    samples1['DT'] = samples1.DT.dt.strftime('%Y-%m-%d %H:%M:%S')
+    samples1.to_sql(data_tab, engine, index=False)
+    return engine
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    """
+    A client of a synthetic Hydrotel database with its own cache folder.
+    """
+    path = tmp_path_factory.mktemp('hydrotel')
+    engine = sqlalchemy.create_engine('sqlite:///' + str(path / 'hydrotel.db'))
+    create_hydrotel_db(engine, n_sites=8)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(param, 'cache_dir', str(path / 'cache'))
+        yield HydrotelClient('local', 'hydrotel', engine=engine)
+
+
+def pandas_resample(samples, freq, fun, val_round=3):
+    sel = samples[(samples.DT >= from_date) & (samples.DT <= to_date)]
+    data1 = sel.set_index('DT').groupby('Point').SampleValue.resample(freq).agg(fun).dropna()
+    if fun == 'sum':
+        data1 = data1[sel.set_index('DT').groupby('Point').SampleValue.resample(freq).count() > 0]
+    return data1.round(val_round).reset_index()
+
+###############################
+### Tests
+
+
+@pytest.mark.parametrize('resample_code,freq,fun', [('D', 'D', 'mean'), ('D', 'D', 'sum'), ('H', 'h', 'max'), ('M', 'MS', 'mean')])
+def test_server_agg(engine, samples, resample_code, freq, fun):
+    data1 = rd_ts_agg(engine, data_tab, points, resample_code, 1, fun, 3, from_date, to_date)
+    data2 = pandas_resample(samples, freq, fun)
+
+    assert data1[['Point', 'DT']].equals(data2[['Point', 'DT']])
+    assert np.allclose(data1.SampleValue, data2.SampleValue, atol=0.0015)
+
+
+def test_server_agg_min_count(engine, samples):
+    data1 = rd_ts_agg(engine, data_tab, points, 'W', 1, 'mean', 3, from_date, to_date, min_count=8)
+    data2 = rd_ts_agg(engine, data_tab, points, 'W', 1, 'mean', 3, from_date, to_date)
+    counts = data2.groupby('Point').size()
+
+    assert set(data1.Point) == set(counts[counts >= 8].index)
+    assert (data1.DT.dt.dayofweek == 0).all()
+
+
+def test_server_agg_min_count_nulls(samples, client):
+    ## Point 1 has only null samples for a week, so those days count for count(*) but not for the non-null count
+    samples1 = samples.copy()
+    samples1.loc[(samples1.Point == 1) & (samples1.DT >= '2018-01-03') & (samples1.DT < '2018-01-11'), 'SampleValue'] = np.nan
+    engine = sqlalchemy.create_engine('sqlite://')
+    samples2 = samples1.copy()
+    samples2['DT'] = samples2.DT.dt.strftime('%Y-%m-%d %H:%M:%S')
+    samples2.to_sql(data_tab, engine, index=False)
+    sel = samples1[(samples1.DT >= from_date) & (samples1.DT <= to_date)]
+
+    data1 = rd_ts_agg(engine, data_tab, points, 'D', 1, 'mean', 3, from_date, to_date, min_count=45)
+    data2 = resample_local(sel, 'D', 1, 'mean', 3, min_count=45)
+    counts = pandas_resample(samples1, 'D', 'mean').groupby('Point').SampleValue.count()
+
+    assert set(data1.Point) == set(counts[counts >= 45].index) == {2, 3}
+    assert data1.equals(data2)
+
+    ## The server and the local (tile cache) paths of get_ts_data
+    pytest.importorskip('pyarrow')
+    tile_client = HydrotelClient('local', 'hydrotel', engine=client.engine, tile_cache=True)
+    for code, n in [('D', 45), ('W', 8)]:
+        tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, code, min_count=n, server_agg=True)
+        tsdata2 = tile_client.get_ts_data(mtypes, sites, from_date, to_date, code, min_count=n)
+        assert tsdata1.sort_index().equals(tsdata2.sort_index())
+
+
+def test_bulk_keys(engine, client, monkeypatch):
+    data1 = rd_ts_agg(engine, data_tab, points, 'D', 1, 'mean', 3, from_date, to_date)
+    data2 = rd_ts_agg(engine, data_tab, points, 'D', 1, 'mean', 3, from_date, to_date, bulk_threshold=0)
+    site_point = client.get_sites_mtypes(mtypes, sites).reset_index()
+    ext1 = client.get_point_extents(site_point.Point, refresh=True)
+    upd1, wm1 = client.get_ts_updates(mtypes, sites, since='2018-02-27')
+    iter1 = pd.concat(client.iter_ts_data(mtypes, sites, from_date, to_date, 'D'))
+
+    monkeypatch.setattr(param, 'bulk_key_threshold', 0)
+    ext2 = client.get_point_extents(site_point.Point, refresh=True)
+    upd2, wm2 = client.get_ts_updates(mtypes, sites, since='2018-02-27')
+    iter2 = pd.concat(client.iter_ts_data(mtypes, sites, from_date, to_date, 'D'))
+
+    assert data1.equals(data2)
+    assert ext1.equals(ext2)
+    assert upd1.sort_index().equals(upd2.sort_index())
+    assert wm1.equals(wm2)
+    assert iter1.sort_index().equals(iter2.sort_index())
+
+
+def test_get_sites_mtypes(client):
+    sites_mtypes = client.get_sites_mtypes(mtypes, sites)
+
+    assert sorted(sites_mtypes.index.tolist()) == sorted([(s, m) for s in sites for m in mtypes])
+    assert sites_mtypes.FromDate.notnull().all()
+
+
+def test_point_extents_threads(client):
+    points1 = client.get_sites_mtypes().Point.astype(int).tolist()
+    ext1 = client.get_point_extents(points1, refresh=True).set_index('Point')
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda p: client.get_point_extents(p, refresh=True), [points1[i::4] for i in range(4)]))
+    ext2 = client.get_point_extents(points1).set_index('Point')
+
+    assert ext2.equals(ext1)
+
+
+def test_catalog_subset(client):
+    subset_client = HydrotelClient('local', 'hydrotel', engine=client.engine, catalog_cache=False)
+    sites_mtypes1 = client.get_sites_mtypes(mtypes, sites)
+    sites_mtypes2 = subset_client.get_sites_mtypes(mtypes, sites)
+    sites_mtypes3 = subset_client.get_sites_mtypes(sites=sites)
+
+    assert sites_mtypes2.sort_index().equals(sites_mtypes1.sort_index())
+    assert sorted(set(sites_mtypes3.index.get_level_values('ExtSiteID'))) == sorted(sites)
+
+    ## One round trip per table
+    events = []
+    hook = add_hook(events.append)
+    try:
+        client.get_catalog(refresh=True)
+    finally:
+        remove_hook(hook)
+    assert len([e for e in events if e['kind'] == 'query']) == 3
+
+
+def test_catalog_subset_cache(client):
+    cold_client = HydrotelClient('local', 'hydrotel_subset', engine=client.engine)
+    n_queries = []
+    for i in range(3):
+        events = []
+        hook = add_hook(events.append)
+        try:
+            sites_mtypes = cold_client.get_sites_mtypes(['flow'], ['60001'])
+        finally:
+            remove_hook(hook)
+        n_queries.append(len([e for e in events if e['kind'] == 'query']))
+
+    assert sites_mtypes.index.tolist() == [('60001', 'flow')]
+    assert n_queries[0] > 0
+    assert n_queries[1:] == [0, 0]
+    assert cached_catalog('local', 'hydrotel_subset') is None
+
+    ## Invalidating removes the cached subsets
+    cold_client.invalidate_catalog()
+    events = []
+    hook = add_hook(events.append)
+    try:
+        cold_client.get_sites_mtypes(['flow'], ['60001'])
+    finally:
+        remove_hook(hook)
+    assert len([e for e in events if (e['kind'] == 'query') and (e['stage'] == 'sites_mtypes')]) == 3
+
+
+def test_get_ts_data_threads(client):
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    tsdata2 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, threads=4, points_per_query=1)
+
+    assert tsdata1.equals(tsdata2)
+    assert set(tsdata1.index.get_level_values('ExtSiteID')) == set(sites)
+
+
+def test_time_window(client):
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, min_count=40)
+    tsdata2 = client.get_ts_data(mtypes, sites, from_date, to_date, min_count=40, threads=4, time_window='MS')
+    wide1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, pivot=True)
+    wide2 = client.get_ts_data(mtypes, sites, from_date, to_date, pivot=True, threads=4, time_window='7D')
+    raw1 = client.get_ts_data(mtypes, sites, from_date, to_date, None)
+    raw2 = client.get_ts_data(mtypes, sites, from_date, to_date, None, threads=4, time_window='MS')
+
+    assert not tsdata1.empty
+    assert tsdata2.sort_index().equals(tsdata1.sort_index())
+    assert wide2.equals(wide1)
+    assert raw2.sort_index().equals(raw1.sort_index())
+    with pytest.raises(ValueError):
+        client.get_ts_data(mtypes, sites, from_date, to_date, 'W', time_window='MS')
+
+
+def test_pivot(client):
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    wide1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, pivot=True)
+
+    pd.testing.assert_frame_equal(wide1, tsdata1.unstack([0, 1]))
+
+
+def test_compact(client):
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    tsdata2 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, compact=True)
+    wide2 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, pivot=True, compact=True)
+
+    assert tsdata2.dtype == 'float32'
+    assert np.allclose(tsdata2.astype('float64').round(3), tsdata1)
+    assert isinstance(tsdata2.index.levels[0], pd.CategoricalIndex)
+    assert pd.to_datetime(tsdata2.index.levels[2]).equals(tsdata1.index.levels[2].as_unit('ns'))
+    assert wide2.shape == tsdata1.unstack([0, 1]).shape
+    assert tsdata2.reset_index().memory_usage(deep=True).sum() < tsdata1.reset_index().memory_usage(deep=True).sum() / 2
+
+
+def test_instrument(client):
+    events = []
+    hook = add_hook(events.append)
+    try:
+        tsdata = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, threads=2)
+    finally:
+        remove_hook(hook)
+    n_events = len(events)
+    client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+
+    stages = {e['stage']: e for e in events if e['kind'] == 'stage'}
+    queries = [e for e in events if e['kind'] == 'query']
+    ts_queries = [e for e in events if (e['kind'] == 'stage') and (e['stage'] == 'ts_query')]
+
+    assert stages['get_ts_data']['rows'] == len(tsdata)
+    assert {e['parent'] for e in ts_queries} == {'get_ts_data'}
+    assert sum(e['rows'] for e in ts_queries) == len(tsdata)
+    assert any(e['stage'] == 'ts_query' and 'Samples' in e['sql'] for e in queries)
+    assert len(events) == n_events
+    assert stages['get_ts_data']['duration'] >= max(e['duration'] for e in ts_queries)
+
+
+def test_aggs(client):
+    aggs = {'flow': ['mean', 'min', 'max', 'count']}
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, aggs=aggs)
+
+    events = []
+    hook = add_hook(events.append)
+    try:
+        tsdata2 = client.get_ts_data(mtypes, sites, from_date, to_date, aggs=aggs)
+    finally:
+        remove_hook(hook)
+    wide1 = client.get_ts_data(mtypes, sites, from_date, to_date, pivot=True, aggs=aggs)
+
+    assert tsdata1.columns.tolist() == ['mean', 'min', 'max', 'count', 'sum']
+    pd.testing.assert_frame_equal(tsdata1, tsdata2)
+    assert len([e for e in events if (e['kind'] == 'query') and (e['stage'] == 'ts_query')]) == 2
+    flow_points = client.get_sites_mtypes('flow', sites).Point.astype(int).tolist()
+    for f in aggs['flow']:
+        single1 = rd_ts_agg(client.engine, data_tab, flow_points, 'D', fun=f, from_date=from_date, to_date=to_date)
+        assert np.allclose(np.sort(single1.SampleValue.values), np.sort(tsdata1.xs('flow', level='MType')[f].values))
+    assert tsdata1.xs('rainfall', level='MType')['mean'].isnull().all()
+    assert wide1['max'].shape[1] == len(sites)
+    assert wide1['sum'].columns.get_level_values('MType').unique().tolist() == ['rainfall']
+    assert wide1['mean'].stack([0, 1]).sort_index().equals(tsdata1['mean'].dropna().reorder_levels([2, 0, 1]).sort_index())
+
+
+def test_query(client):
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    wide1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, pivot=True)
+    q = client.query().sites(sites[:1]).mtypes(mtypes[0])
+    q = q.sites(sites[1:]).mtypes(mtypes[1]).between(from_date, to_date).resample('D')
+
+    client.get_catalog()
+    events = []
+    hook = add_hook(events.append)
+    try:
+        tsdata2 = q.collect()
+    finally:
+        remove_hook(hook)
+    wide2 = q.collect(pivot=True)
+
+    assert tsdata2.equals(tsdata1.sort_index())
+    assert wide2.sort_index(axis=1).equals(wide1.sort_index(axis=1))
+    assert len([e for e in events if e['kind'] == 'query']) == 1
+    assert 'case when Point in' in q.sql()
+    assert q.agg('max').collect().xs('flow', level='MType').ge(tsdata2.xs('flow', level='MType')).all()
+
+
+def test_ts_availability(client):
+    raw1 = client.get_ts_data(mtypes, sites, from_date, to_date, None, server_agg=True).reset_index()
+    counts, gaps = client.get_ts_availability(mtypes, sites, from_date, to_date, 'W')
+
+    raw1['DT'] = bucket_labels(raw1.DateTime, 'W')
+    raw1['Gap'] = raw1.groupby(['ExtSiteID', 'MType']).DateTime.diff()
+    counts1 = raw1.groupby(['DT', 'ExtSiteID', 'MType']).size().unstack([1, 2])
+    gaps1 = raw1.groupby(['DT', 'ExtSiteID', 'MType']).Gap.max().unstack([1, 2])
+
+    assert counts.index.equals(period_range(from_date, to_date, 'W').rename('DateTime'))
+    assert counts.dtypes.eq('int32').all()
+    assert (counts.sum() > 0).all()
+    assert counts.reindex(columns=counts1.columns).equals(counts1.reindex(counts.index).fillna(0).astype('int32'))
+    pd.testing.assert_frame_equal(gaps.reindex(columns=gaps1.columns), gaps1.reindex(gaps.index).astype('timedelta64[ns]'), check_names=False, check_freq=False)
+
+
+def test_create_site_mtype(client):
+    ref_point = int(client.get_sites_mtypes('flow', '60001').Point.iloc[0])
+    new1 = client.create_site_mtype('60001', ref_point, 'Flow Derived')
+
+    assert new1.index.tolist() == [('60001', 'flow derived')]
+    assert new1.equals(client.get_sites_mtypes('flow derived', '60001'))
+    with pytest.raises(ValueError):
+        client.create_site_mtype('60001', ref_point, 'Flow Derived')
+
+
+def test_create_site_mtypes(client):
+    site_point = client.get_sites_mtypes('flow', sites).reset_index()
+    specs = [(s, int(p), 'Flow Sim') for s, p in zip(site_point.ExtSiteID, site_point.Point)]
+    new1 = client.create_site_mtypes(specs)
+
+    assert sorted(new1.index.tolist()) == sorted([(s, 'flow sim') for s in sites])
+    assert new1.Object.is_unique
+    with pytest.raises(ValueError):
+        client.create_site_mtypes([(sites[0], specs[0][1], 'Flow Sim 2'), (sites[1], specs[0][1], 'Flow Sim 2')])
+    assert client.get_sites_mtypes('flow sim 2', sites).empty
+
+
+def test_create_site_mtype_stale_catalog(client):
+    ref_point = int(client.get_sites_mtypes('flow', '60002').Point.iloc[0])
+    client.get_catalog()
+    other = HydrotelClient('other', 'hydrotel', engine=client.engine)
+    other.create_site_mtype('60002', ref_point, 'Flow Stale')
+
+    assert client.get_sites_mtypes('flow stale', '60002').empty
+    with pytest.raises(ValueError):
+        client.create_site_mtype('60002', ref_point, 'Flow Stale')
+    assert len(other.get_sites_mtypes('flow stale', '60002')) == 1
+
+
+def test_tile_cache(client):
+    pytest.importorskip('pyarrow')
+    tile_client = HydrotelClient('local', 'hydrotel', engine=client.engine, tile_cache=True)
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    tsdata2 = tile_client.get_ts_data(mtypes, sites, from_date, to_date)
+    site_point = tile_client.get_sites_mtypes(mtypes, sites).reset_index()
+
+    assert tsdata1.index.equals(tsdata2.index)
+    assert np.allclose(tsdata1, tsdata2, atol=0.0015)
+    assert not tile_client.get_tile_cache().missing_tiles(site_point, from_date, to_date)
+
+    missing = tile_client.get_tile_cache().missing_tiles(site_point)
+    expected = [(int(p), m) for p, f, t in site_point[['Point', 'FromDate', 'ToDate']].itertuples(index=False) for m in pd.date_range(f.to_period('M').to_timestamp(), t, freq='MS') if not (pd.Timestamp(from_date).to_period('M').to_timestamp() <= m <= pd.Timestamp(to_date))]
+    assert missing == expected
+
+
+def test_tile_cache_threads(client, tmp_path):
+    pytest.importorskip('pyarrow')
+    tiles = TileCache('local', 'hydrotel', cache_dir=str(tmp_path), max_bytes=20000)
+    tile_client = HydrotelClient('local', 'hydrotel', engine=client.engine, tile_cache=tiles)
+    tsdata1 = client.get_ts_data(mtypes, sites, '2018-01-01', '2018-03-01', resample_code=None)
+    for i in range(3):
+        tsdata2 = tile_client.get_ts_data(mtypes, sites, '2018-01-01', '2018-03-01', resample_code=None, threads=4, points_per_query=2)
+        assert tsdata2.sort_index().equals(tsdata1.sort_index())
+
+    assert tiles.size() <= tiles.max_bytes
+    assert not tiles._pins
+
+
+def test_rollups(client):
+    pytest.importorskip('pyarrow')
+    rollup_client = HydrotelClient('local', 'hydrotel', engine=client.engine, rollups=True)
+    for code, from_date1, to_date1 in [('D', from_date, to_date), ('M', '2018-01-03 06:30', '2018-02-20 12:00'), ('H', '2018-01-03 06:30', '2018-01-10'), ('W', None, None)]:
+        tsdata1 = client.get_ts_data(mtypes, sites, from_date1, to_date1, code, server_agg=True)
+        tsdata2 = rollup_client.get_ts_data(mtypes, sites, from_date1, to_date1, code)
+
+        assert tsdata1.index.equals(tsdata2.index)
+        assert np.allclose(tsdata1, tsdata2, atol=0.0015)
+
+    ## Incremental update with samples after the open period
+    point = int(client.get_sites_mtypes('flow', sites[0]).Point.iloc[0])
+    with client.engine.begin() as conn:
+        conn.execute(sqlalchemy.text("insert into Samples (Point, DT, SampleValue) values ({p}, '2018-03-01 00:30:00', 1000), ({p}, '2018-03-02 00:00:00', 1000)".format(p=point)))
+    tsdata1 = client.get_ts_data('flow', sites[0], resample_code='D', server_agg=True)
+    tsdata2 = rollup_client.get_ts_data('flow', sites[0], resample_code='D')
+    manifest = rollup_client.get_rollup_store().manifest
+
+    assert np.allclose(tsdata1, tsdata2, atol=0.0015)
+    assert manifest.loc[(point, 'daily'), 'Watermark'] == pd.Timestamp('2018-03-02')
+
+
+def test_get_ts_updates(client):
+    data1, wm1 = client.get_ts_updates(mtypes, sites, since='2018-02-27')
+    data2, wm2 = client.get_ts_updates(mtypes, sites, since=wm1)
+    wm0 = wm1 - pd.Timedelta('1h')
+    data3, wm3 = client.get_ts_updates(mtypes, sites, since=wm0)
+
+    assert (data1.index.get_level_values('DateTime') > '2018-02-27').all()
+    assert data2.empty
+    assert wm2.equals(wm1)
+    assert len(data3) <= 4 * len(wm0)
+    assert wm3.equals(wm1)
+
+    events = []
+    hook = add_hook(events.append)
+    try:
+        data4, wm4 = client.get_ts_updates(mtypes, sites, since=wm0, points=wm0.index[:1])
+    finally:
+        remove_hook(hook)
+    assert not any('FromDate' in e['sql'] for e in events if e['kind'] == 'query')
+    assert set(wm4.index) == set(wm0.index[:1])
+
+
+def test_write_ts_data(client):
+    tsdata = client.get_ts_data(mtypes, sites, '2018-01-03', '2018-01-05', resample_code=None)
+    new1 = (tsdata + 1).iloc[::2]
+    new2 = tsdata.iloc[:3].copy()
+    new2.index = new2.index.set_levels(new2.index.levels[2] + pd.Timedelta('1000D'), level=2)
+    events = []
+    hook = add_hook(events.append)
+    try:
+        n = client.write_ts_data(pd.concat([new1, new2]), batch_size=100)
+    finally:
+        remove_hook(hook)
+    tsdata2 = client.get_ts_data(mtypes, sites, '2018-01-03', '2018-01-05', resample_code=None)
+    ext = client.get_sites_mtypes(mtypes, sites)
+
+    assert n == len(new1) + len(new2)
+    assert np.allclose(tsdata2.loc[new1.index], new1)
+    assert tsdata2.index.equals(tsdata.index)
+    assert (ext.ToDate > '2020-01-01').sum() == 1
+    assert not any('FromDate' in e['sql'] for e in events if e['kind'] == 'query')
+    with pytest.raises(Exception):
+        client.write_ts_data(new1, upsert=False)
+
+    new3 = new2.copy()
+    new3.index = new3.index.set_levels(new3.index.levels[2] + pd.Timedelta('500ms'), level=2)
+    with pytest.raises(ValueError, match='more precise'):
+        client.write_ts_data(new3)
+    assert client.get_ts_data(mtypes, sites, '2018-01-03', '2018-01-05', resample_code=None).equals(tsdata2)
+
+
+def test_write_ts_data_ambiguous(tmp_path):
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'dup.db'))
+    create_hydrotel_db(engine, n_sites=2)
+    client2 = HydrotelClient('local', 'dup', engine=engine)
+    point = int(client2.get_sites_mtypes('flow', '60001').Point.iloc[0])
+    with engine.begin() as conn:
+        conn.exec_driver_sql('insert into Points (Point, Object, Name) select 1000, Object, Name from Points where Point = {}'.format(point))
+    client2.invalidate_catalog()
+    data = pd.Series([1.0], index=pd.MultiIndex.from_tuples([('60001', 'flow', pd.Timestamp('2019-01-01'))], names=['ExtSiteID', 'MType', 'DateTime']))
+
+    with pytest.raises(ValueError, match='60001'):
+        client2.write_ts_data(data)
+    assert client2.get_ts_data('flow', ['60001'], '2019-01-01', '2019-01-02', resample_code=None).empty
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'csv'])
+def test_export_ts_data(client, tmp_path, file_format):
+    if file_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    tsdata = client.get_ts_data(mtypes, sites, from_date, to_date, resample_code=None)
+    parts1 = client.export_ts_data(str(tmp_path), mtypes, sites, from_date, to_date, file_format, threads=2, chunksize=500)
+    os.remove(parts1.path.iloc[0])
+    parts2 = client.export_ts_data(str(tmp_path), mtypes, sites, from_date, to_date, file_format, threads=2, chunksize=500)
+
+    data_list = []
+    for part in parts1.itertuples():
+        data1 = pd.read_parquet(part.path) if file_format == 'parquet' else pd.read_csv(part.path, parse_dates=['DateTime'])
+        data1['ExtSiteID'] = part.ExtSiteID
+        data1['MType'] = part.MType
+        data_list.append(data1)
+    data2 = pd.concat(data_list).set_index(['ExtSiteID', 'MType', 'DateTime']).Value.sort_index()
+
+    assert (parts1.status == 'written').all()
+    assert parts1.path.is_unique
+    assert partition_file('dest', '60001', 'flow', 1, 2018) != partition_file('dest', '60001', 'flow', 2, 2018)
+    assert parts2.status.tolist() == ['written'] + ['skipped'] * (len(parts2) - 1)
+    assert parts1.rows.sum() == len(tsdata)
+    assert np.allclose(data2, tsdata.sort_index())
+    assert data2.index.equals(tsdata.sort_index().index)
+
+
+def test_extract_cli(client, tmp_path):
+    pytest.importorskip('pyarrow')
+    dest = str(tmp_path / 'extract')
+    tsdata = client.get_ts_data(mtypes, sites, from_date, to_date, 'D', server_agg=True)
+    argv = ['extract', dest, '--url', str(client.engine.url), '--mtypes'] + mtypes + ['--sites'] + sites + ['--from-date', from_date, '--to-date', to_date, '--resample-code', 'D', '--points-per-task', '2', '--time-window', 'MS', '--threads', '2']
+
+    assert main(argv) == 0
+    manifest = read_manifest(dest)
+    tasks1 = pd.read_csv(os.path.join(dest, 'tasks.csv'))
+    assert sorted(manifest.task) == sorted(tasks1.task)
+    assert len(tasks1) == 2 * 2 * 2
+
+    ## An interrupted run
+    with open(os.path.join(dest, 'manifest.csv')) as f:
+        lines = f.readlines()
+    with open(os.path.join(dest, 'manifest.csv'), 'w') as f:
+        f.writelines(lines[:-1] + [lines[-1][:5]])
+    tasks2 = client.extract_ts_data(dest, mtypes, sites, from_date, to_date, 'D', points_per_task=2, time_window='MS')
+
+    data1 = pd.concat([pd.read_parquet(p) for p in tasks2.path]).set_index(['ExtSiteID', 'MType', 'DateTime']).Value.sort_index()
+    assert (tasks2.status == 'written').sum() == 1
+    assert len(read_manifest(dest)) == len(tasks2)
+    assert data1.equals(tsdata.sort_index())
+    with pytest.raises(ValueError, match='time_window'):
+        client.extract_ts_data(dest, mtypes, sites, from_date, to_date, 'D', points_per_task=2, time_window='YS')
+    tasks3 = client.extract_ts_data(dest, mtypes, sites, from_date, to_date, 'D', points_per_task=2, time_window='YS', resume=False)
+    assert (tasks3.status == 'written').all()
+    assert (client.extract_ts_data(dest, mtypes, sites, from_date, to_date, 'D', points_per_task=2, time_window='YS').status == 'skipped').all()
+
+
+def test_federation(client, tmp_path):
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'region2.db'))
+    create_hydrotel_db(engine, n_sites=4, seed=1)
+    client2 = HydrotelClient('local', 'region2', engine=engine)
+    fed = HydrotelFederation({'region1': client, 'region2': client2})
+
+    site_summ = fed.get_sites_mtypes(mtypes, sites)
+    tsdata = fed.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    wide = fed.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True, pivot=True)
+    tsdata1 = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+    tsdata2 = client2.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+
+    assert site_summ.index.names == ['Source', 'ExtSiteID', 'MType']
+    assert tsdata.index.names == ['Source', 'ExtSiteID', 'MType', 'DateTime']
+    assert tsdata.loc['region1'].equals(tsdata1)
+    assert tsdata.loc['region2'].equals(tsdata2)
+    assert wide.columns.names == ['Source', 'ExtSiteID', 'MType']
+    assert np.allclose(wide.stack([0, 1, 2]).reorder_levels([1, 2, 3, 0]).sort_index(), tsdata.sort_index())
+    assert fed.get_ts_data(mtypes, ['60005'], from_date, to_date, server_agg=True).index.get_level_values('Source').unique().tolist() == ['region1']
+
+
+def test_aio(client):
+    async def run():
+        async with AsyncHydrotelClient(client=HydrotelClient('local', 'hydrotel', engine=client.engine), max_concurrency=2) as aclient:
+            results = await asyncio.gather(*[aclient.get_ts_data(mtypes, [s], from_date=from_date, to_date=to_date, server_agg=True) for s in sites])
+            chunks = [c async for c in aclient.iter_ts_data(mtypes, sites, from_date=from_date, to_date=to_date, resample_code='D')]
+        return results, chunks
+
+    results, chunks = asyncio.run(run())
+    tsdata = client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True)
+
+    assert pd.concat(results).sort_index().equals(tsdata.sort_index())
+    assert pd.concat(chunks).sort_index().equals(tsdata.sort_index())
+
+
+def test_aio_loops(client):
+    aclient = AsyncHydrotelClient(client=HydrotelClient('local', 'hydrotel', engine=client.engine), max_concurrency=1)
+
+    async def run():
+        return await asyncio.gather(*[aclient.get_ts_data(mtypes, [s], from_date=from_date, to_date=to_date, server_agg=True) for s in sites])
+
+    pool = client.engine.pool
+    results1 = asyncio.run(run())
+    results2 = asyncio.run(run())
+    asyncio.run(aclient.aclose())
+
+    assert all(r1.equals(r2) for r1, r2 in zip(results1, results2))
+    assert client.engine.pool is pool
+
+
+def test_aio_iter_slots(client):
+    engine = sqlalchemy.create_engine('sqlite:///' + client.engine.url.database, pool_size=1, max_overflow=0, pool_timeout=5)
+
+    async def run():
+        async with AsyncHydrotelClient(client=HydrotelClient('local', 'hydrotel', engine=engine), max_concurrency=1) as aclient:
+            chunks = aclient.iter_ts_data(mtypes, sites, from_date=from_date, to_date=to_date, resample_code='D', points_per_chunk=1)
+            chunk1 = await chunks.__anext__()
+            task = asyncio.ensure_future(aclient.get_ts_data(mtypes, sites[:1], from_date=from_date, to_date=to_date, server_agg=True))
+            rest = [c async for c in chunks]
+            tsdata1 = await asyncio.wait_for(task, 10)
+        return [chunk1] + rest, tsdata1
+
+    chunks, tsdata1 = asyncio.run(run())
+    engine.dispose()
+
+    assert pd.concat(chunks).sort_index().equals(client.get_ts_data(mtypes, sites, from_date, to_date, server_agg=True).sort_index())
+    assert not tsdata1.empty
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+A local cache of the Samples table stored as Parquet tiles of one Point and one month.
+"""
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from pyhydrotel import parameters as param
+from pyhydrotel.catalog import _store_path, _save_pickle
+from pyhydrotel.util import ts_where_stmts, chunks
+
+######################################
+### Parameters
+
+tiles_folder = 'tiles'
+manifest_file = 'manifest.pkl'
+tile_file = '{month}.parquet'
+
+manifest_cols = ['FetchedAt', 'Complete', 'Rows', 'Bytes', 'LastUsed']
+points_per_fetch = 500
+
+
+######################################
+### Class
+
+
+class TileCache(object):
+    """
+    Class for the local cache of the Samples table of a Hydrotel database. The samples are stored as one Parquet file per Point and month (a tile) together with a manifest of the tiles. Tiles of months that ended more than parameters.tile_lag seconds before they were fetched are complete and never refetched; other tiles are refetched once they are older than the ttl. The least recently used tiles are removed once the cache is larger than max_bytes, except for the tiles that a read on another thread is using.
+
+    Parameters
+    ----------
+    server : str
+        The server where the Hydrotel database lays.
+    database : str
+        The name of the Hydrotel database.
+    cache_dir : str or None
+        The base folder of the cache. None uses parameters.cache_dir.
+    max_bytes : int or None
+        The maximum size of the tiles on disk. None uses parameters.tile_max_bytes.
+    ttl : int or None
+        The number of seconds that incomplete tiles remain valid. None uses parameters.tile_ttl.
+    """
+    def __init__(self, server, database, cache_dir=None, max_bytes=None, ttl=None):
+        store = _store_path(server, database, cache_dir)
+        if store is None:
+            raise ValueError('The tile cache needs a cache_dir.')
+        self.path = os.path.join(store, tiles_folder)
+        self.max_bytes = param.tile_max_bytes if max_bytes is None else max_bytes
+        self.ttl = param.tile_ttl if ttl is None else ttl
+        self._lock = threading.RLock()
+        self._pins = {}
+
+        manifest_path = os.path.join(self.path, manifest_file)
+        if os.path.isfile(manifest_path):
+            self.manifest = pd.read_pickle(manifest_path)
+        else:
+            self.manifest = pd.DataFrame(columns=manifest_cols, index=pd.MultiIndex.from_tuples([], names=['Point', 'Month']))
+
+    def _tile_path(self, point, month):
+        return os.path.join(self.path, str(int(point)), tile_file.format(month=month.strftime('%Y-%m')))
+
+    def _save_manifest(self):
+        _save_pickle(self.manifest, os.path.join(self.path, manifest_file))
+
+    def _pin(self, tiles):
+        """
+        Method to keep tiles from being evicted while they are fetched and read. Every pin must be undone with _unpin.
+        """
+        with self._lock:
+            for key in tiles:
+                self._pins[key] = self._pins.get(key, 0) + 1
+
+    def _unpin(self, tiles):
+        with self._lock:
+            for key in tiles:
+                n = self._pins.pop(key) - 1
+                if n:
+                    self._pins[key] = n
+
+    def _expected_tiles(self, extents, from_date=None, to_date=None):
+        """
+        Method to return the (Point, Month) MultiIndex of all tiles of Points within a time period.
+        """
+        ext = extents[['Point', 'FromDate', 'ToDate']].dropna(subset=['FromDate'])
+        start = ext.FromDate if from_date is None else ext.FromDate.clip(lower=pd.Timestamp(from_date))
+        end = ext.ToDate if to_date is None else ext.ToDate.clip(upper=pd.Timestamp(to_date))
+        keep = (start <= end).values
+
+        ## The months as month numbers since year 0
+        start_m = (start.dt.year * 12 + start.dt.month - 1).values[keep]
+        n_months = (end.dt.year * 12 + end.dt.month - 1).values[keep] - start_m + 1
+        offsets = np.arange(n_months.sum()) - np.repeat(np.cumsum(n_months) - n_months, n_months)
+        month_n = np.repeat(start_m, n_months) + offsets
+        months = pd.to_datetime(pd.DataFrame({'year': month_n // 12, 'month': month_n % 12 + 1, 'day': 1}))
+
+        return pd.MultiIndex.from_arrays([np.repeat(ext.Point.values[keep].astype('int64'), n_months), months], names=['Point', 'Month'])
+
+    def size(self):
+        """
+        Method to return the size of the tiles on disk in bytes.
+        """
+        return int(self.manifest.Bytes.sum())
+
+    def missing_tiles(self, extents, from_date=None, to_date=None):
+        """
+        Method to determine the tiles that are missing or stale for Points within a time period.
+
+        Parameters
+        ----------
+        extents : DataFrame
+            Point, FromDate, ToDate of the Points (see catalog.get_point_extents).
+        from_date : str, Timestamp, or None
+            The start date.
+        to_date : str, Timestamp, or None
+            The end date.
+
+        Returns
+        -------
+        list of tuple
+            (Point, Month) of the tiles that need to be fetched.
+        """
+        expected = self._expected_tiles(extents, from_date, to_date)
+        if expected.empty:
+            return []
+
+        now = time.time()
+        with self._lock:
+            manifest = self.manifest
+            fresh = manifest.index[manifest.Complete.astype(bool).values | (now - manifest.FetchedAt.astype(float).values < self.ttl)]
+
+        return expected[~expected.isin(fresh)].tolist()
+
+    def fetch(self, con, tiles, table=None):
+        """
+        Method to fetch tiles from the database and save them in the cache. Tiles of consecutive months with the same Points are fetched with a single statement.
+
+        Parameters
+        ----------
+        con : SQLAlchemy engine or connection
+            The connection to the Hydrotel database.
+        tiles : list of tuple
+            (Point, Month) of the tiles (see missing_tiles).
+        table : str or None
+            The samples table. None uses parameters.data_tab.
+
+        Returns
+        -------
+        None
+        """
+        if not tiles:
+            return
+        if table is None:
+            table = param.data_tab
+
+        ## Group the tiles into statements
+        month_points = {}
+        for p, month in tiles:
+            month_points.setdefault(month, set()).add(p)
+
+        groups = []
+        for month in sorted(month_points):
+            points = sorted(month_points[month])
+            if groups and (groups[-1][0] == points) and (groups[-1][2] == month):
+                groups[-1][2] = month + pd.offsets.MonthBegin()
+            else:
+                groups.append([points, month, month + pd.offsets.MonthBegin()])
+
+        ## Fetch and save the tiles
+        for points0, start, end in groups:
+            for points in chunks(points0, points_per_fetch):
+                fetched_at = time.time()
+                where_stmt = ' and '.join(ts_where_stmts(points, start, end, inclusive='left'))
+                stmt = "select Point, DT, SampleValue from {tab} where {where}".format(tab=table, where=where_stmt)
+                data1 = pd.read_sql_query(stmt, con)
+                data1['DT'] = pd.to_datetime(data1['DT'])
+                data1['Month'] = data1.DT.dt.to_period('M').dt.to_timestamp()
+                grp = dict(list(data1.groupby(['Point', 'Month'])))
+
+                complete = pd.Timestamp(fetched_at - param.tile_lag, unit='s')
+                rows = []
+                for p in points:
+                    for month in pd.date_range(start, end, freq='MS', inclusive='left'):
+                        tile = grp.get((p, month), data1.iloc[:0])
+                        path = self._tile_path(p, month)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        tile[['Point', 'DT', 'SampleValue']].to_parquet(path, index=False)
+                        rows.append(((p, month), [fetched_at, month + pd.offsets.MonthBegin() <= complete, len(tile), os.path.getsize(path), fetched_at]))
+
+                with self._lock:
+                    new1 = pd.DataFrame([r[1] for r in rows], index=pd.MultiIndex.from_tuples([r[0] for r in rows], names=['Point', 'Month']), columns=manifest_cols)
+                    self.manifest = pd.concat([self.manifest.drop(new1.index, errors='ignore'), new1])
+
+        with self._lock:
+            self._save_manifest()
+
+    def read(self, points, from_date=None, to_date=None):
+        """
+        Method to read the cached samples of Points within a time period. The tiles must already be in the cache. The selected tiles are pinned until they are read, so that an evict on another thread does not remove them.
+
+        Parameters
+        ----------
+        points : list of int
+            The Points.
+        from_date : str, Timestamp, or None
+            The start date (inclusive).
+        to_date : str, Timestamp, or None
+            The end date (inclusive).
+
+        Returns
+        -------
+        DataFrame
+            Point, DT, SampleValue
+        """
+        with self._lock:
+            sel = self.manifest[self.manifest.index.get_level_values('Point').isin(points) & (self.manifest.Rows > 0)]
+            if from_date is not None:
+                sel = sel[sel.index.get_level_values('Month') + pd.offsets.MonthBegin() > pd.Timestamp(from_date)]
+            if to_date is not None:
+                sel = sel[sel.index.get_level_values('Month') <= pd.Timestamp(to_date)]
+            self.manifest.loc[sel.index, 'LastUsed'] = time.time()
+            tiles = sel.index.tolist()
+            self._pin(tiles)
+
+        if sel.empty:
+            self._unpin(tiles)
+            return pd.DataFrame(columns=['Point', 'DT', 'SampleValue'])
+
+        try:
+            data1 = pd.concat([pd.read_parquet(self._tile_path(p, m)) for p, m in tiles], ignore_index=True)
+        finally:
+            self._unpin(tiles)
+        if from_date is not None:
+            data1 = data1[data1.DT >= pd.Timestamp(from_date)]
+        if to_date is not None:
+            data1 = data1[data1.DT <= pd.Timestamp(to_date)]
+
+        return data1
+
+    def get_samples(self, con, extents, from_date=None, to_date=None):
+        """
+        Method to return the samples of Points within a time period. Only the missing or stale tiles are fetched from the database; the rest are read from the cache. All tiles of the request are pinned from before the fetch until they are read, so concurrent calls cannot evict them in between. The cache is trimmed to max_bytes afterwards.
+
+        Parameters
+        ----------
+        con : SQLAlchemy engine or connection
+            The connection to the Hydrotel database.
+        extents : DataFrame
+            Point, FromDate, ToDate of the Points (see catalog.get_point_extents).
+        from_date : str, Timestamp, or None
+            The start date (inclusive).
+        to_date : str, Timestamp, or None
+            The end date (inclusive).
+
+        Returns
+        -------
+        DataFrame
+            Point, DT, SampleValue
+        """
+        tiles = self._expected_tiles(extents, from_date, to_date).tolist()
+        self._pin(tiles)
+        try:
+            self.fetch(con, self.missing_tiles(extents, from_date, to_date))
+            data1 = self.read(extents.Point.astype(int).tolist(), from_date, to_date)
+        finally:
+            self._unpin(tiles)
+
+        with self._lock:
+            self.evict()
+            self._save_manifest()
+
+        return data1
+
+    def evict(self):
+        """
+        Method to remove the least recently used tiles until the cache is no larger than max_bytes. Pinned tiles are skipped, so the cache can stay larger while they are in use.
+        """
+        with self._lock:
+            if self.size() <= self.max_bytes:
+                return
+            lru = self.manifest[~self.manifest.index.isin(list(self._pins))].sort_values('LastUsed')
+            over = lru.Bytes.cumsum() - (self.size() - self.max_bytes)
+            remove = lru.index[:(over < 0).sum() + 1]
+            for p, m in remove:
+                path = self._tile_path(p, m)
+                if os.path.isfile(path):
+                    os.remove(path)
+            self.manifest = self.manifest.drop(remove)
+
+    def invalidate(self, tiles):
+        """
+        Method to remove tiles from the cache (e.g. after their samples have been changed), so that they are fetched again on the next read.
+
+        Parameters
+        ----------
+        tiles : list of tuple
+            (Point, Month) of the tiles. Month is the Timestamp of the first day of the month.
+        """
+        with self._lock:
+            remove = self.manifest.index.intersection(pd.MultiIndex.from_tuples([(int(p), pd.Timestamp(m)) for p, m in tiles], names=['Point', 'Month']))
+            for p, m in remove:
+                path = self._tile_path(p, m)
+                if os.path.isfile(path):
+                    os.remove(path)
+            if len(remove):
+                self.manifest = self.manifest.drop(remove)
+                self._save_manifest()
+
+    def clear(self):
+        """
+        Method to remove all tiles from the cache.
+        """
+        with self._lock:
+            for p, m in self.manifest.index:
+                path = self._tile_path(p, m)
+                if os.path.isfile(path):
+                    os.remove(path)
+            self.manifest = self.manifest.iloc[:0]
+            self._save_manifest()
@@ -0,0 +1,799 @@
+# -*- coding: utf-8 -*-
+"""
+Utility functions for building the SQL statements used by the other pyhydrotel modules.
+"""
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from sqlalchemy import text
+
+######################################
+### Parameters
+
+sql_units = {'T': 'minute', 'H': 'hour', 'D': 'day', 'W': 'week', 'M': 'month', 'Q': 'quarter', 'A': 'year'}
+sec_units = {'T': 60, 'H': 3600, 'D': 86400}
+fun_dict = {'mean': 'avg', 'sum': 'sum', 'count': 'count', 'min': 'min', 'max': 'max'}
+
+## Seconds between 1900-01-01 (day 0 in SQL Server) and 1970-01-01
+epoch_1900 = 2208988800
+
+######################################
+### Functions
+
+
+def sql_date(date):
+    """
+    Function to convert a date into a quoted SQL date literal (to the second) that SQL Server can compare with datetime columns.
+
+    Parameters
+    ----------
+    date : str or Timestamp
+        The date.
+
+    Returns
+    -------
+    str
+    """
+    return pd.Timestamp(date).strftime('%Y-%m-%d %H:%M:%S').join(['\'', '\''])
+
+
+def chunks(values, size):
+    """
+    Function to split a list into consecutive lists of at most size values.
+
+    Parameters
+    ----------
+    values : list
+        The list to be split.
+    size : int or None
+        The maximum length of each list. None returns the whole list as one chunk.
+
+    Returns
+    -------
+    list of list
+    """
+    if not size:
+        return [values]
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def dialect_name(con):
+    """
+    Function to return the SQLAlchemy dialect name (e.g. mssql or sqlite) of an engine or connection.
+    """
+    return con.dialect.name
+
+
+def bucket_expr(date_col, resample_code, period=1, dialect='mssql'):
+    """
+    Function to create the SQL expression that assigns each date to the start of its resampling period. The periods are counted from 1900-01-01 in the same way as the DATEADD/DATEDIFF expression used by pdsql.
+
+    Parameters
+    ----------
+    date_col : str
+        The date column in the table.
+    resample_code : str
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+    period : int
+        The number of resampling periods.
+    dialect : str
+        The SQL dialect. Either mssql or sqlite.
+
+    Returns
+    -------
+    str
+    """
+    if resample_code not in sql_units:
+        raise ValueError('resample_code must be one of ' + str(list(sql_units.keys())))
+    period = int(period)
+
+    if dialect == 'mssql':
+        unit = sql_units[resample_code]
+        expr = "DATEADD({unit}, DATEDIFF({unit}, 0, {col}) / {p} * {p}, 0)".format(unit=unit, col=date_col, p=period)
+    elif dialect == 'sqlite':
+        sec = "(CAST(strftime('%s', {col}) AS INTEGER) + {epoch})".format(col=date_col, epoch=epoch_1900)
+        year = "(CAST(strftime('%Y', {col}) AS INTEGER) - 1900)".format(col=date_col)
+        month = "(CAST(strftime('%m', {col}) AS INTEGER) - 1)".format(col=date_col)
+        if resample_code in sec_units:
+            n = sec_units[resample_code] * period
+            expr = "datetime({sec} / {n} * {n} - {epoch}, 'unixepoch')".format(sec=sec, n=n, epoch=epoch_1900)
+        elif resample_code == 'W':
+            w = "(({sec} / 86400 + 1) / 7 / {p} * {p})".format(sec=sec, p=period)
+            expr = "datetime({w} * 604800 - {epoch}, 'unixepoch')".format(w=w, epoch=epoch_1900)
+        elif resample_code == 'M':
+            m = "(({y} * 12 + {m}) / {p} * {p})".format(y=year, m=month, p=period)
+            expr = "datetime(printf('%04d-%02d-01', 1900 + {m} / 12, {m} % 12 + 1))".format(m=m)
+        elif resample_code == 'Q':
+            q = "(({y} * 4 + {m} / 3) / {p} * {p})".format(y=year, m=month, p=period)
+            expr = "datetime(printf('%04d-%02d-01', 1900 + {q} / 4, {q} % 4 * 3 + 1))".format(q=q)
+        else:
+            a = "({y} / {p} * {p})".format(y=year, p=period)
+            expr = "datetime(printf('%04d-01-01', 1900 + {a}))".format(a=a)
+    else:
+        raise ValueError('dialect must be either mssql or sqlite')
+
+    return expr
+
+
+def bucket_labels(dates, resample_code, period=1):
+    """
+    Function to assign dates to the start of their resampling period in pandas. It is the equivalent of bucket_expr.
+
+    Parameters
+    ----------
+    dates : DatetimeIndex, Series, or list
+        The dates.
+    resample_code : str
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+    period : int
+        The number of resampling periods.
+
+    Returns
+    -------
+    DatetimeIndex
+    """
+    if resample_code not in sql_units:
+        raise ValueError('resample_code must be one of ' + str(list(sql_units.keys())))
+    period = int(period)
+    dates = pd.DatetimeIndex(dates)
+    origin = pd.Timestamp('1900-01-01')
+
+    if resample_code in sec_units:
+        n = sec_units[resample_code] * period
+        sec = (dates - origin) // pd.Timedelta(seconds=1)
+        labels = origin + pd.to_timedelta(sec // n * n, unit='s')
+    elif resample_code == 'W':
+        days = (dates - origin).days
+        labels = origin + pd.to_timedelta((days + 1) // 7 // period * period * 7, unit='D')
+    else:
+        if resample_code == 'M':
+            n = (dates.year - 1900) * 12 + dates.month - 1
+            n = n // period * period
+            year = 1900 + n // 12
+            month = n % 12 + 1
+        elif resample_code == 'Q':
+            n = (dates.year - 1900) * 4 + (dates.month - 1) // 3
+            n = n // period * period
+            year = 1900 + n // 4
+            month = n % 4 * 3 + 1
+        else:
+            year = 1900 + (dates.year - 1900) // period * period
+            month = 1
+        labels = pd.DatetimeIndex(pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1})))
+
+    return labels
+
+
+def period_range(from_date, to_date, resample_code, period=1):
+    """
+    Function to return the start of every resampling period (see bucket_labels) from the period of from_date to the period of to_date.
+
+    Parameters
+    ----------
+    from_date : str or Timestamp
+        The start date.
+    to_date : str or Timestamp
+        The end date.
+    resample_code : str
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+    period : int
+        The number of resampling periods.
+
+    Returns
+    -------
+    DatetimeIndex
+    """
+    start, end = bucket_labels([from_date, to_date], resample_code, period)
+    period = int(period)
+
+    if resample_code in sec_units:
+        freq = str(sec_units[resample_code] * period) + 's'
+    elif resample_code == 'W':
+        freq = str(7 * period) + 'D'
+    else:
+        freq = str({'M': 1, 'Q': 3, 'A': 12}[resample_code] * period) + 'MS'
+
+    return pd.date_range(start, end, freq=freq)
+
+
+def time_windows(from_date, to_date, freq, resample_code=None, period=1):
+    """
+    Function to split a date range into consecutive windows at the boundaries of a pandas frequency. If resample_code is given, then the window boundaries must also be boundaries of the resampling periods so that no resampling period is split between windows.
+
+    Parameters
+    ----------
+    from_date : str or Timestamp
+        The start date.
+    to_date : str or Timestamp
+        The end date.
+    freq : str or None
+        The pandas frequency of the window boundaries. e.g. 'YS' for yearly or 'MS' for monthly windows. None returns the whole date range as one window.
+    resample_code : str or None
+        The resampling code the windows must be aligned with.
+    period : int
+        The number of resampling periods.
+
+    Returns
+    -------
+    list of tuple
+        (from_date, to_date, inclusive) for each window. inclusive is 'left' for all but the last window, which is 'both'.
+    """
+    from_date = pd.Timestamp(from_date)
+    to_date = pd.Timestamp(to_date)
+
+    if freq is None:
+        return [(from_date, to_date, 'both')]
+
+    edges = pd.date_range(from_date, to_date, freq=freq)
+    edges = edges[(edges > from_date) & (edges <= to_date)]
+
+    if (resample_code is not None) and (len(edges) > 0):
+        if not (bucket_labels(edges, resample_code, period) == edges).all():
+            raise ValueError('The time windows must start at the start of a resampling period.')
+
+    starts = [from_date] + edges.tolist()
+    ends = edges.tolist() + [to_date]
+    windows = [(s, e, 'left') for s, e in zip(starts[:-1], ends[:-1])]
+    windows.append((starts[-1], ends[-1], 'both'))
+
+    return windows
+
+
+def load_keys(conn, keys, name='keys'):
+    """
+    Function to load keys (e.g. Points) into a temporary table of the connection's session, so that large key sets can be joined against instead of being written into the SQL statement.
+
+    Parameters
+    ----------
+    conn : SQLAlchemy connection
+        The connection. The table only exists in its session.
+    keys : DataFrame
+        The keys. Integer columns become int columns, float columns float columns, datetime columns datetime columns, and all others varchar columns.
+    name : str
+        The name of the table.
+
+    Returns
+    -------
+    str
+        The table name to use in statements on the same connection.
+    """
+    dialect = dialect_name(conn)
+    if dialect == 'mssql':
+        table = '#' + name
+        drop_stmt = "if object_id('tempdb..{table}') is not null drop table {table}"
+        create_stmt = "create table {table} ({cols})"
+    else:
+        table = name
+        drop_stmt = "drop table if exists {table}"
+        create_stmt = "create temp table {table} ({cols})"
+
+    cols = []
+    keys1 = keys.astype(object)
+    for col, dtype in keys.dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            cols.append(col + ' int')
+        elif pd.api.types.is_float_dtype(dtype):
+            cols.append(col + ' float')
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            cols.append(col + ' datetime')
+            if dialect == 'mssql':
+                keys1[col] = pd.Series(keys[col].dt.to_pydatetime(), index=keys.index, dtype=object)
+            else:
+                keys1[col] = keys[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            cols.append(col + ' varchar(200)')
+    keys1 = keys1.where(keys.notnull(), None)
+
+    ## A table of the same name can be left over on a pooled connection
+    conn.execute(text(drop_stmt.format(table=table)))
+    conn.execute(text(create_stmt.format(table=table, cols=', '.join(cols))))
+    insert_stmt = "insert into {table} ({cols}) values ({params})".format(table=table, cols=', '.join(keys.columns), params=', '.join(':' + c for c in keys.columns))
+    conn.execute(text(insert_stmt), keys1.to_dict('records'))
+
+    return table
+
+
+@contextmanager
+def bulk_keys(con, keys, name='keys'):
+    """
+    Context manager that opens a connection (if con is an engine), loads keys into a temporary table (see load_keys), and drops the table again on exit.
+
+    Parameters
+    ----------
+    con : SQLAlchemy engine or connection
+        The connection to the database.
+    keys : DataFrame
+        The keys.
+    name : str
+        The name of the table.
+
+    Yields
+    ------
+    conn : SQLAlchemy connection
+        The connection that holds the table.
+    table : str
+        The table name.
+    """
+    if hasattr(con, 'connect'):
+        with con.connect() as conn, conn.begin():
+            with bulk_keys(conn, keys, name) as (conn1, table):
+                yield conn1, table
+    else:
+        table = load_keys(con, keys, name)
+        try:
+            yield con, table
+        finally:
+            con.execute(text('drop table ' + table))
+
+
+def ts_where_stmts(points, from_date=None, to_date=None, date_col='DT', inclusive='both', keys_table=None):
+    """
+    Function to create the where conditions for selecting samples of Points within a date range. Both dates are inclusive by default like in pdsql.
+
+    Parameters
+    ----------
+    points : list of int
+        The Points.
+    from_date : str, Timestamp, or None
+        The start date.
+    to_date : str, Timestamp, or None
+        The end date.
+    date_col : str
+        The date column in the table.
+    inclusive : str
+        Either 'both' or 'left'. 'left' excludes the to_date.
+    keys_table : str or None
+        A temporary table with the Points in a Point column (see load_keys). If given, then points is ignored.
+
+    Returns
+    -------
+    list of str
+    """
+    if keys_table is None:
+        where_lst = ['Point in ({points})'.format(points=', '.join(str(int(p)) for p in points))]
+    else:
+        where_lst = ['Point in (select Point from {table})'.format(table=keys_table)]
+    if from_date is not None:
+        where_lst.append(date_col + ' >= ' + sql_date(from_date))
+    if to_date is not None:
+        if inclusive == 'both':
+            where_lst.append(date_col + ' <= ' + sql_date(to_date))
+        else:
+            where_lst.append(date_col + ' < ' + sql_date(to_date))
+
+    return where_lst
+
+
+def since_where_stmts(watermarks, date_col='DT'):
+    """
+    Function to create a where condition per Point that selects the samples newer than the Point's watermark. The conditions should be joined by OR.
+
+    Parameters
+    ----------
+    watermarks : Series or dict
+        Point to the last date already seen. Points with a null watermark select all of their samples.
+    date_col : str
+        The date column in the table.
+
+    Returns
+    -------
+    list of str
+    """
+    where_lst = []
+    for p, date in dict(watermarks).items():
+        if pd.isnull(date):
+            where_lst.append('(Point = {p})'.format(p=int(p)))
+        else:
+            where_lst.append('(Point = {p} and {col} > {date})'.format(p=int(p), col=date_col, date=sql_date(date)))
+
+    return where_lst
+
+
+def since_join_stmt(table, keys_table, select):
+    """
+    Function to create a statement that joins the samples table with a temporary table of Point and Watermark columns (see load_keys) and only selects the samples newer than the watermarks. It is the large key set version of since_where_stmts.
+
+    Parameters
+    ----------
+    table : str
+        The samples table.
+    keys_table : str
+        The temporary table.
+    select : str
+        Either 'samples' for the Point, DT, and SampleValue of the samples or 'extents' for the min and max DT per Point.
+
+    Returns
+    -------
+    str
+    """
+    join_stmt = "from {tab} s inner join {keys} k on s.Point = k.Point where (k.Watermark is null or s.DT > k.Watermark)".format(tab=table, keys=keys_table)
+    if select == 'samples':
+        stmt = "select s.Point, s.DT, s.SampleValue " + join_stmt
+    elif select == 'extents':
+        stmt = "select s.Point, min(s.DT) as FromDate, max(s.DT) as ToDate " + join_stmt + " group by s.Point"
+    else:
+        raise ValueError('select must be either samples or extents')
+
+    return stmt
+
+
+def write_stmt(table, stage_table, dialect='mssql', upsert=True):
+    """
+    Function to create the statement that copies the samples of a staging table (see load_keys) into the samples table.
+
+    Parameters
+    ----------
+    table : str
+        The samples table.
+    stage_table : str
+        The staging table with Point, DT, and SampleValue columns.
+    dialect : str
+        The SQLAlchemy dialect name. Either mssql (MERGE) or sqlite (INSERT OR REPLACE).
+    upsert : bool
+        Should existing samples (same Point and DT) be updated? If False, then the samples are only inserted and existing samples make the statement fail.
+
+    Returns
+    -------
+    str
+    """
+    if not upsert:
+        stmt = "insert into {tab} (Point, DT, SampleValue) select Point, DT, SampleValue from {stage}"
+    elif dialect == 'mssql':
+        stmt = "merge {tab} as t using {stage} as s on t.Point = s.Point and t.DT = s.DT when matched then update set t.SampleValue = s.SampleValue when not matched then insert (Point, DT, SampleValue) values (s.Point, s.DT, s.SampleValue);"
+    elif dialect == 'sqlite':
+        stmt = "insert or replace into {tab} (Point, DT, SampleValue) select Point, DT, SampleValue from {stage}"
+    else:
+        raise ValueError('Upserts are only implemented for the mssql and sqlite dialects')
+
+    return stmt.format(tab=table, stage=stage_table)
+
+
+def ts_agg_stmt(table, points, resample_code=None, period=1, fun='mean', val_round=3, from_date=None, to_date=None, min_count=None, dialect='mssql', inclusive='both', keys_table=None):
+    """
+    Function to create a single SQL statement that resamples the samples of Points on the server. The min_count filter is applied in the same statement with a window count of the non-null aggregated values (as in pdsql's rd_sql_ts).
+
+    Parameters
+    ----------
+    table : str
+        The samples table.
+    points : list of int
+        The Points.
+    resample_code : str or None
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc. None returns the samples without resampling.
+    period : int
+        The number of resampling periods.
+    fun : str, list of str, or dict
+        The resampling function. i.e. mean, sum, count, min, or max. A list of functions calculates all of them in the same pass over the samples and returns one column per function (named by the function) instead of SampleValue. A dict of Point to function resamples each Point with its own function in the same statement.
+    val_round : int
+        The number of decimals to round the values.
+    from_date : str, Timestamp, or None
+        The start date.
+    to_date : str, Timestamp, or None
+        The end date.
+    min_count : int or None
+        The minimum number of non-null resampled values required for a Point to be returned. If fun is a list, then the values of the first function are counted.
+    dialect : str
+        The SQL dialect. Either mssql or sqlite.
+    inclusive : str
+        Either 'both' or 'left'. 'left' excludes the to_date.
+    keys_table : str or None
+        A temporary table with the Points (see load_keys). If given, then points is ignored.
+
+    Returns
+    -------
+    str
+    """
+    where_stmt = ' and '.join(ts_where_stmts(points, from_date, to_date, inclusive=inclusive, keys_table=keys_table))
+
+    if resample_code is None:
+        stmt = "select Point, DT, SampleValue from {tab} where {where}".format(tab=table, where=where_stmt)
+        return stmt
+
+    funs = set(fun.values()) if isinstance(fun, dict) else set(fun) if isinstance(fun, list) else {fun}
+    if not funs.issubset(fun_dict):
+        raise ValueError('fun must be one of ' + str(list(fun_dict.keys())))
+    bucket = bucket_expr('DT', resample_code, period, dialect)
+
+    if isinstance(fun, dict):
+        fun_points = pd.Series(fun)
+        fun_counts = fun_points.value_counts()
+        case_list = ["when Point in ({points}) then round({fun}(SampleValue), {r})".format(points=', '.join(str(int(p)) for p in fun_points[fun_points == f].index), fun=fun_dict[f], r=int(val_round)) for f in fun_counts.index[1:]]
+        val_stmt = "round({fun}(SampleValue), {r})".format(fun=fun_dict[fun_counts.index[0]], r=int(val_round))
+        if case_list:
+            val_stmt = "case {cases} else {val} end".format(cases=' '.join(case_list), val=val_stmt)
+    elif isinstance(fun, list):
+        val_stmt = ', '.join("round({fun}(SampleValue), {r}) as [{name}]".format(fun=fun_dict[f], r=int(val_round), name=f) for f in fun)
+        count_val = "{fun}(SampleValue)".format(fun=fun_dict[fun[0]])
+    else:
+        val_stmt = "round({fun}(SampleValue), {r})".format(fun=fun_dict[fun], r=int(val_round))
+
+    if isinstance(fun, list):
+        val_cols = ', '.join('[' + f + ']' for f in fun)
+    else:
+        count_val = val_stmt
+        val_stmt = val_stmt + ' as SampleValue'
+        val_cols = 'SampleValue'
+
+    if isinstance(min_count, int):
+        stmt = "select Point, DT, {cols} from (select Point, {bucket} as DT, {val}, count({count_val}) over (partition by Point) as n_periods from {tab} where {where} group by Point, {bucket}) agg where n_periods >= {n}".format(cols=val_cols, bucket=bucket, val=val_stmt, count_val=count_val, tab=table, where=where_stmt, n=min_count)
+    else:
+        stmt = "select Point, {bucket} as DT, {val} from {tab} where {where} group by Point, {bucket}".format(bucket=bucket, val=val_stmt, tab=table, where=where_stmt)
+
+    return stmt
+
+
+def ts_stats_stmt(table, points, resample_code, period=1, from_date=None, to_date=None, dialect='mssql', inclusive='both', where_list=None):
+    """
+    Function to create a single SQL statement that returns the sum, count, min, and max of the samples of Points per resampling period. They can be combined into coarser periods without going back to the samples (e.g. the mean is sum / count).
+
+    Parameters
+    ----------
+    table : str
+        The samples table.
+    points : list of int
+        The Points.
+    resample_code : str
+        The Pandas time series resampling code. e.g. 'H' for hour, 'D' for day, 'M' for month, etc.
+    period : int
+        The number of resampling periods.
+    from_date : str, Timestamp, or None
+        The start date.
+    to_date : str, Timestamp, or None
+        The end date.
+    dialect : str
+        The SQL dialect. Either mssql or sqlite.
+    inclusive : str
+        Either 'both' or 'left'. 'left' excludes the to_date.
+    where_list : list of str or None
+        Where conditions that are joined by OR and used instead of the points and dates (e.g. from since_where_stmts).
+
+    Returns
+    -------
+    str
+        The statement returns Point, DT, sum, count, min, max, and LastDT (the last sample date of the period).
+    """
+    if where_list is None:
+        where_stmt = ' and '.join(ts_where_stmts(points, from_date, to_date, inclusive=inclusive))
+    else:
+        where_stmt = '(' + ' or '.join(where_list) + ')'
+    bucket = bucket_expr('DT', resample_code, period, dialect)
+
+    stmt = "select Point, {bucket} as DT, sum(SampleValue) as [sum], count(SampleValue) as [count], min(SampleValue) as [min], max(SampleValue) as [max], max(DT) as LastDT from {tab} where {where} group by Point, {bucket}".format(bucket=bucket, tab=table, where=where_stmt)
+
+    return stmt
+
+
+def ts_avail_stmt(table, points, resample_code, period=1, from_date=None, to_date=None, dialect='mssql', keys_table=None):
+    """
+    Function to create a single SQL statement that returns the number of samples and the largest gap between consecutive samples of Points per resampling period. The gaps are calculated with LAG over the samples of each Point within the dates, and a gap is assigned to the period of the sample that ends it.
+
+    Parameters
+    ----------
+    table : str
+        The samples table.
+    points : list of int
+        The Points.
+    resample_code : str
+        The Pandas time series resampling code. e.g. 'D' for day, 'W' for week, 'M' for month, etc.
+    period : int
+        The number of resampling periods.
+    from_date : str, Timestamp, or None
+        The start date.
+    to_date : str, Timestamp, or None
+        The end date.
+    dialect : str
+        The SQL dialect. Either mssql or sqlite.
+    keys_table : str or None
+        A temporary table with the Points in a Point column (see load_keys). If given, then points is ignored.
+
+    Returns
+    -------
+    str
+        The statement returns Point, DT, Count, and MaxGap (in seconds, null if the period has only the first sample).
+    """
+    where_stmt = ' and '.join(ts_where_stmts(points, from_date, to_date, keys_table=keys_table))
+    bucket = bucket_expr('DT', resample_code, period, dialect)
+
+    if dialect == 'mssql':
+        gap = 'DATEDIFF(second, PrevDT, DT)'
+    elif dialect == 'sqlite':
+        gap = "(CAST(strftime('%s', DT) AS INTEGER) - CAST(strftime('%s', PrevDT) AS INTEGER))"
+    else:
+        raise ValueError('dialect must be either mssql or sqlite')
+
+    stmt = "select Point, DT, count(SampleValue) as Count, max(Gap) as MaxGap from (select Point, {bucket} as DT, SampleValue, {gap} as Gap from (select Point, DT, SampleValue, LAG(DT) over (partition by Point order by DT) as PrevDT from {tab} where {where}) as s1) as s2 group by Point, DT".format(bucket=bucket, gap=gap, tab=table, where=where_stmt)
+
+    return stmt
+
+
+def combine_stats(stats, resample_code, period=1, fun='mean', val_round=3, min_count=None):
+    """
+    Function to combine the sum, count, min, and max of periods (see ts_stats_stmt) into coarser periods and to calculate the resampled values from them. The periods of the stats must nest within the output periods.
+
+    Parameters
+    ----------
+    stats : DataFrame
+        Point, DT, sum, count, min, max
+    resample_code, period, fun, val_round, min_count
+        See ts_agg_stmt.
+
+    Returns
+    -------
+    DataFrame
+        Point, DT, SampleValue (or one column per function if fun is a list) sorted by Point and DT.
+    """
+    funs = fun if isinstance(fun, list) else [fun]
+    if not set(funs).issubset(fun_dict):
+        raise ValueError('fun must be one of ' + str(list(fun_dict.keys())))
+
+    stats1 = stats[['Point', 'sum', 'count', 'min', 'max']].copy()
+    stats1['DT'] = bucket_labels(stats['DT'], resample_code, period).values
+    stats2 = stats1.groupby(['Point', 'DT']).agg({'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'})
+    stats2 = stats2[stats2['count'] > 0]
+
+    vals = {}
+    for f in funs:
+        if f == 'mean':
+            vals[f] = stats2['sum'] / stats2['count']
+        else:
+            vals[f] = stats2[f]
+    data2 = pd.DataFrame(vals).astype('float64').round(int(val_round))
+    if not isinstance(fun, list):
+        data2.columns = ['SampleValue']
+    data2 = data2.reset_index()
+
+    if isinstance(min_count, int):
+        n_periods = data2.groupby('Point')[data2.columns[2]].transform('count')
+        data2 = data2[n_periods >= min_count]
+
+    return data2.sort_values(['Point', 'DT']).reset_index(drop=True)
+
+
+def rd_ts_agg(con, table, points, resample_code=None, period=1, fun='mean', val_round=3, from_date=None, to_date=None, min_count=None, inclusive='both', bulk_threshold=None):
+    """
+    Function to read the resampled samples of Points with a single server-side statement (see ts_agg_stmt). If there are more Points than bulk_threshold, then they are loaded into a temporary table that the statement joins against (see load_keys).
+
+    Parameters
+    ----------
+    con : SQLAlchemy engine or connection
+        The connection to the Hydrotel database.
+    table, points, resample_code, period, fun, val_round, from_date, to_date, min_count, inclusive
+        See ts_agg_stmt.
+    bulk_threshold : int or None
+        The number of Points above which a temporary table is used. None never uses one.
+
+    Returns
+    -------
+    DataFrame
+        Point, DT, SampleValue (or one column per function if fun is a list) sorted by Point and DT.
+    """
+    if (bulk_threshold is not None) and (len(points) > bulk_threshold):
+        with bulk_keys(con, pd.DataFrame({'Point': pd.Series(points, dtype='int64')}), 'keys_point') as (conn, keys_table):
+            stmt = ts_agg_stmt(table, points, resample_code, period, fun, val_round, from_date, to_date, min_count, dialect_name(conn), inclusive, keys_table)
+            df = pd.read_sql_query(stmt, conn)
+    else:
+        stmt = ts_agg_stmt(table, points, resample_code, period, fun, val_round, from_date, to_date, min_count, dialect_name(con), inclusive)
+        df = pd.read_sql_query(stmt, con)
+    df['DT'] = pd.to_datetime(df['DT'])
+    df = df.sort_values(['Point', 'DT']).reset_index(drop=True)
+
+    return df
+
+
+def resample_local(data, resample_code=None, period=1, fun='mean', val_round=3, min_count=None):
+    """
+    Function to resample samples in pandas in the same way as ts_agg_stmt does on the server.
+
+    Parameters
+    ----------
+    data : DataFrame
+        Point, DT, SampleValue
+    resample_code, period, fun, val_round, min_count
+        See ts_agg_stmt.
+
+    Returns
+    -------
+    DataFrame
+        Point, DT, SampleValue (or one column per function if fun is a list) sorted by Point and DT.
+    """
+    if resample_code is None:
+        return data[['Point', 'DT', 'SampleValue']].sort_values(['Point', 'DT']).reset_index(drop=True)
+
+    funs = fun if isinstance(fun, list) else [fun]
+    if not set(funs).issubset(fun_dict):
+        raise ValueError('fun must be one of ' + str(list(fun_dict.keys())))
+
+    data1 = data[['Point', 'SampleValue']].copy()
+    data1['DT'] = bucket_labels(data['DT'], resample_code, period).values
+    data2 = data1.groupby(['Point', 'DT']).SampleValue.agg(fun).round(int(val_round))
+    if isinstance(fun, list):
+        data2 = data2.astype('float64')
+    data2 = data2.reset_index()
+
+    if isinstance(min_count, int):
+        n_periods = data2.groupby('Point')[data2.columns[2]].transform('count')
+        data2 = data2[n_periods >= min_count].reset_index(drop=True)
+
+    return data2
+
+
+def wide_ts(data_list, site_point, value_col='SampleValue'):
+    """
+    Function to build the pivoted (wide) output of get_ts_data directly from the resampled rows. The (DateTime x ExtSiteID/MType) array is allocated once and the values are written into it by their integer row and column positions, so the long MultiIndex Series is never created. The output is the same as unstacking the long output.
+
+    Parameters
+    ----------
+    data_list : list of DataFrame
+        The Point, DT, and SampleValue rows.
+    site_point : DataFrame
+        The ExtSiteID, MType, and Point of the Points.
+    value_col : str
+        The column of the values.
+
+    Returns
+    -------
+    DataFrame
+    """
+    point_arr = np.concatenate([d['Point'].to_numpy('int64') for d in data_list])
+    dt_arr = pd.to_datetime(np.concatenate([pd.to_datetime(d['DT']).to_numpy() for d in data_list]))
+    val_arr = np.concatenate([d[value_col].to_numpy('float64') for d in data_list])
+
+    ## Columns of the Points with data, in the order that unstack gives them (by mtype, then by the first appearance of the site)
+    site_point1 = site_point.drop_duplicates('Point').set_index('Point')
+    site_point1 = site_point1.loc[site_point1.index.isin(point_arr), ['ExtSiteID', 'MType']]
+    mtype_codes = pd.factorize(site_point1.MType)[0]
+    site_point1 = site_point1.iloc[np.argsort(mtype_codes, kind='stable')]
+    site_codes = pd.factorize(site_point1.ExtSiteID)[0]
+    mtype_codes = pd.factorize(site_point1.MType)[0]
+    pairs = site_point1.assign(mtype_code=mtype_codes, site_code=site_codes).drop_duplicates(['ExtSiteID', 'MType'])
+    pairs = pairs.sort_values(['mtype_code', 'site_code'])
+    columns = pd.MultiIndex.from_frame(pairs[['ExtSiteID', 'MType']])
+    col_codes = columns.get_indexer(pd.MultiIndex.from_frame(site_point1))
+    col_pos = pd.Series(col_codes, index=site_point1.index).loc[point_arr].to_numpy()
+
+    ## Rows
+    row_codes, index = pd.factorize(dt_arr, sort=True)
+    index.name = 'DateTime'
+
+    arr = np.full((len(index), len(columns)), np.nan)
+    arr[row_codes, col_pos] = val_arr
+
+    return pd.DataFrame(arr, index=index, columns=columns)
+
+
+def compact_ts(data, val_round=3):
+    """
+    Function to convert the output of get_ts_data to compact dtypes. The ExtSiteID and MType become categoricals, the DateTime becomes int64 nanoseconds since 1970-01-01 (pd.to_datetime converts them back), and the values become float32 if all of them can be stored to val_round decimals (i.e. fewer than 2**24 steps of 10**-val_round).
+
+    Parameters
+    ----------
+    data : Series or DataFrame
+        The long (Series) or pivoted (DataFrame) output of get_ts_data.
+    val_round : int or None
+        The number of decimals the values were rounded to. None keeps float64 values.
+
+    Returns
+    -------
+    Series or DataFrame
+    """
+    def compact_index(index):
+        if isinstance(index, pd.MultiIndex):
+            levels = [compact_index(index.levels[i]) for i in range(index.nlevels)]
+            return index.set_levels(levels)
+        if isinstance(index, pd.DatetimeIndex):
+            return pd.Index(index.as_unit('ns').asi8, name=index.name)
+        if index.dtype == object or pd.api.types.is_string_dtype(index.dtype):
+            return pd.CategoricalIndex(index, name=index.name)
+        return index
+
+    data1 = data.copy()
+    data1.index = compact_index(data1.index)
+    if isinstance(data1, pd.DataFrame):
+        data1.columns = compact_index(data1.columns)
+
+    if val_round is not None:
+        max_val = np.nanmax(np.abs(data1.values)) if data1.size else 0
+        if np.isnan(max_val) or (max_val * 10**val_round < 2**24):
+            data1 = data1.astype('float32')
+
+    return data1
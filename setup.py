@@ -149,10 +149,10 @@ setup(
     #
     # Similar to `install_requires` above, these must be valid existing
     # projects.
-    #extras_require={  # Optional
-    #    'dev': ['check-manifest'],
-    #    'test': ['coverage'],
-    #},
+    extras_require={  # Optional
+        'cache': ['pyarrow'],
+        'bench': ['pytest', 'pytest-benchmark'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.
@@ -177,9 +177,9 @@ setup(
     #
     # For example, the following would provide a command called `sample` which
     # executes the function `main` from this package when invoked:
-    # entry_points={  # Optional
-    #    'console_scripts': [
-    #        'sample=sample.command_line:t3',
-    #    ],
-    # },
+    entry_points={  # Optional
+       'console_scripts': [
+           'pyhydrotel=pyhydrotel.cli:main',
+       ],
+    },
 )